@@ -1,6 +1,7 @@
+import functools
 import logging
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
@@ -18,8 +19,17 @@ from telegram.error import BadRequest
 
 # Importar funciones de base de datos y otros módulos necesarios
 import database as db
+import async_db as adb # Acceso a BD sin bloquear el event loop
 # Importar desde utils.py
-from utils import ADMIN_USER_ID, get_back_to_menu_keyboard, delete_message_later, DELETE_DELAY_SECONDS, generic_cancel_conversation # Actualizar importación
+from utils import ADMIN_USER_ID, get_back_to_menu_keyboard, schedule_message_deletion, DELETE_DELAY_SECONDS, generic_cancel_conversation # Actualizar importación
+from utils import PAGE_SIZE, get_pagination_keyboard, parse_page_callback, split_page
+from utils import deletion_scheduler, abandoned_flows
+from utils import get_conversation_timeout, build_timeout_handlers, remember_prompt
+from rate_limiter import send_rate_limiter
+from update_processor import update_processor
+from persistence import sqlite_persistence
+from metrics import bot_metrics, register_state_names
+from query_log import query_stats
 
 logger = logging.getLogger(__name__)
 
@@ -31,17 +41,32 @@ CALLBACK_ADMIN_ADD_USER_PROMPT = 'admin_add_user_prompt'
 CALLBACK_ADMIN_LIST_USERS = 'admin_list_users'
 CALLBACK_ADMIN_EDIT_USER_PROMPT = 'admin_edit_user_prompt' # Para botón Editar Usuario (placeholder)
 CALLBACK_ADMIN_DELETE_USER_START = 'admin_delete_user_start' # Para iniciar conversación de borrado desde botón
+CALLBACK_ADMIN_USERS_PAGE = 'usrpg_' # Prefijo de navegación del listado de usuarios
+CALLBACK_USER_PICKER_PAGE = 'upick_' # Prefijo de navegación del selector de usuarios
+CALLBACK_USER_PICKER_CLEAR = 'upick_clear' # Quitar la búsqueda del selector
+
+# --- Textos del Selector de Usuarios ---
+DELETE_USER_PICKER_TITLE = "🗑️ Selecciona el usuario que deseas eliminar 👇:"
+EDIT_USER_PICKER_TITLE = "✏️ Selecciona el usuario que deseas editar 👇:"
 
 # --- Estados para Conversaciones ---
 # add_user
 GET_USER_ID, GET_NAME, GET_DAYS = range(3)
+register_state_names("add_user", GET_USER_ID=GET_USER_ID, GET_NAME=GET_NAME, GET_DAYS=GET_DAYS)
 # delete_user
 SELECT_USER_TO_DELETE, CONFIRM_USER_DELETE = range(3, 5) # Nuevos estados
+register_state_names("delete_user", SELECT_USER_TO_DELETE=SELECT_USER_TO_DELETE, CONFIRM_USER_DELETE=CONFIRM_USER_DELETE)
 # edit_user (Nuevos estados)
 SELECT_USER_TO_EDIT, CHOOSE_FIELD_TO_EDIT, GET_NEW_NAME, GET_NEW_DAYS = range(5, 9)
+register_state_names(
+    "edit_user",
+    SELECT_USER_TO_EDIT=SELECT_USER_TO_EDIT, CHOOSE_FIELD_TO_EDIT=CHOOSE_FIELD_TO_EDIT,
+    GET_NEW_NAME=GET_NEW_NAME, GET_NEW_DAYS=GET_NEW_DAYS,
+)
 
 # --- Decorador Admin Required ---
 def admin_required(func):
+    @functools.wraps(func) # Conserva el nombre del handler (logs y métricas por handler)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user_id = update.effective_user.id
         if ADMIN_USER_ID is None:
@@ -87,7 +112,7 @@ async def add_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         try:
             # Pasar todos los argumentos requeridos, incluyendo el nuevo payment_method
-            db.add_user_db(user_id, name, payment_method, registration_ts, expiry_ts)
+            await adb.add_user_db(user_id, name, payment_method, registration_ts, expiry_ts)
             expiry_date = datetime.fromtimestamp(expiry_ts).strftime('%d/%m/%Y')
             success_message = f"✅ Usuario `{user_id}` ({name}) añadido/actualizado. Acceso válido hasta: {expiry_date}."
             await update.message.reply_text(success_message, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_to_menu_keyboard())
@@ -104,7 +129,7 @@ async def add_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             pass # No es necesario responder de nuevo
         message_text = "Por favor, dime el ID de Telegram del usuario que quieres añadir o actualizar:"
         # Usar None como teclado al editar el mensaje inicial de la conversación
-        await _send_paginated_or_edit(update, context, message_text, None, schedule_delete=False)
+        remember_prompt(context, await _send_paginated_or_edit(update, context, message_text, None, schedule_delete=False))
         logger.info(f"Admin {admin_id} iniciando conversación add_user. Pidiendo USER_ID.")
         return GET_USER_ID
 
@@ -126,18 +151,18 @@ async def received_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         except Exception as e:
             logger.warning(f"No se pudo borrar el mensaje del usuario (ID) {user_message_id}: {e}")
 
-        await update.message.reply_text(
+        remember_prompt(context, await update.message.reply_text(
             f"🆔 ¡Entendido! ID: `{target_user_id}`.\n"
             "2️⃣ Ahora, envíame el *nombre* que quieres asignarle.",
             parse_mode=ParseMode.MARKDOWN
-        )
+        ))
         return GET_NAME
     except ValueError:
         logger.warning(f"Admin {admin_id} en add_user: Entrada inválida para ID: {user_input}")
-        await update.message.reply_text(
+        remember_prompt(context, await update.message.reply_text(
             "Eso no parece un ID de Telegram válido. Debe ser un número entero.\n"
             "Por favor, envíame el ID de Telegram del usuario (solo números)."
-        )
+        ))
         return GET_USER_ID # Permanecer en el mismo estado
 
 async def received_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -155,11 +180,11 @@ async def received_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     except Exception as e:
         logger.warning(f"No se pudo borrar el mensaje del usuario (nombre) {user_message_id}: {e}")
 
-    await update.message.reply_text(
+    remember_prompt(context, await update.message.reply_text(
         f"👤 ¡Genial! Nombre: {name}.\n"
         "3️⃣ Finalmente, ¿cuántos *días* de acceso quieres darle? (Introduce solo el número).",
         parse_mode=ParseMode.MARKDOWN
-    )
+    ))
     return GET_DAYS
 
 async def received_days(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -168,12 +193,11 @@ async def received_days(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     admin_id = update.effective_user.id
     user_message_id = update.message.message_id # ID del mensaje del usuario
     chat_id = update.effective_chat.id
-    job_queue = context.job_queue # Obtener JobQueue
 
     try:
         days_active = int(user_input)
         if days_active <= 0:
-            await update.message.reply_text("El número de días debe ser positivo. Intenta de nuevo.")
+            remember_prompt(context, await update.message.reply_text("El número de días debe ser positivo. Intenta de nuevo."))
             # No borrar mensaje de error del bot
             return GET_DAYS
 
@@ -202,7 +226,7 @@ async def received_days(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         payment_method = 'N/A' # Valor por defecto para el nuevo campo
 
         # add_user_db actúa como REPLACE, por lo que actualiza si ya existe
-        db.add_user_db(target_user_id, name, payment_method, registration_ts, expiry_ts)
+        await adb.add_user_db(target_user_id, name, payment_method, registration_ts, expiry_ts)
 
         name_escaped = db.escape_markdown(name)
 
@@ -222,12 +246,7 @@ async def received_days(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
         # Programar borrado del mensaje de confirmación después de X segundos
         delay = 15 # Segundos
-        job_queue.run_once(
-            delete_message_later,
-            when=timedelta(seconds=delay),
-            data={'chat_id': chat_id, 'message_id': confirmation_message_id},
-            name=f'delete_{chat_id}_{confirmation_message_id}'
-        )
+        schedule_message_deletion(chat_id, confirmation_message_id, delay)
         logger.info(f"Programado borrado del mensaje {confirmation_message_id} en {delay} segundos.")
 
         context.user_data.clear() # Limpiar datos temporales
@@ -257,10 +276,118 @@ adduser_conv_handler = ConversationHandler(
         GET_USER_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_user_id)],
         GET_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_name)],
         GET_DAYS: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_days)],
+        ConversationHandler.TIMEOUT: build_timeout_handlers("add_user", ('target_user_id', 'target_name')),
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: generic_cancel_conversation(u, c, "add_user"))], # Usar cancelador genérico
+    name="add_user",
+    conversation_timeout=get_conversation_timeout("add_user"),
+    persistent=True,
 )
 
+# --- Selector Paginado de Usuarios ---
+# Usado por /deleteuser y /edituser: una página de botones, navegación ◀️/▶️ y búsqueda por prefijo
+# de nombre escribiendo texto. Cada página es una consulta keyset, sin importar cuántos usuarios haya.
+
+async def show_user_picker(update: Update, context: ContextTypes.DEFAULT_TYPE, select_prefix: str, title: str) -> bool:
+    """
+    Muestra (enviando o editando) la página pedida del selector de usuarios.
+    Cada botón de usuario lleva callback_data '<select_prefix><user_id>'.
+    Devuelve False si no hay ningún usuario seleccionable (sin filtro de búsqueda activo).
+    """
+    query = update.callback_query
+    admin_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    picker = context.user_data.setdefault('user_picker', {})
+    search = picker.get('search')
+
+    direction, cursor = parse_page_callback(query.data if query else None, CALLBACK_USER_PICKER_PAGE)
+    users = await _fetch_picker_page(direction, cursor, search, admin_id)
+    if not users and direction:
+        # El usuario usado como cursor ya no existe: volver a la primera página
+        direction = None
+        users = await _fetch_picker_page(None, None, search, admin_id)
+    users, has_prev, has_next = split_page(users, direction, PAGE_SIZE)
+
+    if not users and not search:
+        return False
+
+    buttons = [
+        [InlineKeyboardButton(f"ID: {user['user_id']} - {user['name']}", callback_data=f"{select_prefix}{user['user_id']}")]
+        for user in users
+    ]
+    nav_row = []
+    if has_prev:
+        nav_row.append(InlineKeyboardButton("◀️ Anterior", callback_data=f"{CALLBACK_USER_PICKER_PAGE}p_{users[0]['user_id']}"))
+    if has_next:
+        nav_row.append(InlineKeyboardButton("Siguiente ▶️", callback_data=f"{CALLBACK_USER_PICKER_PAGE}n_{users[-1]['user_id']}"))
+    if nav_row:
+        buttons.append(nav_row)
+    if search:
+        buttons.append([InlineKeyboardButton("✖️ Quitar búsqueda", callback_data=CALLBACK_USER_PICKER_CLEAR)])
+    keyboard = InlineKeyboardMarkup(buttons)
+
+    message_text = f"{title}\n\n"
+    if search:
+        message_text += f"🔎 Búsqueda: *{db.escape_markdown(search)}*"
+        message_text += "\n" if users else " - sin resultados.\n"
+    message_text += "✍️ Escribe el inicio de un nombre para buscar.\nPuedes cancelar con /cancel."
+
+    # Editar el mensaje del selector en el sitio; si no se puede, enviar uno nuevo
+    if query:
+        try:
+            await query.edit_message_text(message_text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+            picker['message_id'] = query.message.message_id
+            remember_prompt(context, query.message)
+            return True
+        except BadRequest as e:
+            if "message is not modified" in str(e).lower():
+                return True
+            logger.warning(f"No se pudo editar el selector de usuarios, enviando nuevo: {e}")
+    else:
+        if update.message:
+            try: await context.bot.delete_message(chat_id=chat_id, message_id=update.message.message_id)
+            except Exception: pass # Ignorar si no se puede borrar
+        if picker.get('message_id'):
+            try:
+                await context.bot.edit_message_text(message_text, chat_id=chat_id, message_id=picker['message_id'],
+                                                    reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+                return True
+            except BadRequest as e:
+                if "message is not modified" in str(e).lower():
+                    return True
+                logger.warning(f"No se pudo editar el selector de usuarios, enviando nuevo: {e}")
+
+    sent_message = await context.bot.send_message(chat_id, message_text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    picker['message_id'] = sent_message.message_id
+    remember_prompt(context, sent_message)
+    return True
+
+async def _fetch_picker_page(direction: str | None, cursor: int | None, search: str | None, admin_id: int) -> list:
+    """Consulta keyset de una página del selector (una fila extra para saber si hay más)."""
+    if direction == 'prev':
+        return await adb.list_users_db(before_user_id=cursor, limit=PAGE_SIZE + 1, name_prefix=search, exclude_user_id=admin_id)
+    return await adb.list_users_db(after_user_id=cursor, limit=PAGE_SIZE + 1, name_prefix=search, exclude_user_id=admin_id)
+
+def build_user_picker_handlers(select_prefix: str, title: str, state: int) -> list:
+    """Handlers de navegación y búsqueda del selector para el estado 'state' de una conversación."""
+    async def navigate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        query = update.callback_query
+        await query.answer()
+        if query.data == CALLBACK_USER_PICKER_CLEAR:
+            context.user_data.setdefault('user_picker', {})['search'] = None
+        await show_user_picker(update, context, select_prefix, title)
+        return state
+
+    async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        context.user_data.setdefault('user_picker', {})['search'] = update.message.text.strip()[:64] or None
+        await show_user_picker(update, context, select_prefix, title)
+        return state
+
+    return [
+        CallbackQueryHandler(navigate, pattern=f"^{CALLBACK_USER_PICKER_PAGE}"),
+        MessageHandler(filters.TEXT & ~filters.COMMAND, search),
+    ]
+
 # --- Conversación: Eliminar Usuario (/deleteuser) ---
 
 @admin_required
@@ -278,33 +405,17 @@ async def delete_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
             logger.error(f"Error answering callback query in delete_user_start: {e}")
 
     try:
-        users = db.list_users_db()
-        # Log después de obtener usuarios
-        logger.debug(f"delete_user_start: Fetched {len(users)} users from DB.")
-
-        active_users = [u for u in users if u['user_id'] != admin_id] # No permitir eliminar al propio admin
-        # Log después de filtrar usuarios
-        logger.debug(f"delete_user_start: Found {len(active_users)} active users (excluding admin).")
+        context.user_data['user_picker'] = {} # Selector nuevo: sin búsqueda previa
+        has_users = await show_user_picker(update, context, "deluser_", DELETE_USER_PICKER_TITLE)
 
-        if not active_users:
+        if not has_users:
             message_text = "ℹ️ No hay otros usuarios registrados para eliminar."
             keyboard = get_back_to_menu_keyboard()
             logger.info("delete_user_start: No active users found to delete. Sending info message.")
             await _send_paginated_or_edit(update, context, message_text, keyboard)
             return ConversationHandler.END
 
-        buttons = []
-        for user in active_users:
-            label = f"ID: {user['user_id']} - {user['name']}"
-            buttons.append([InlineKeyboardButton(label, callback_data=f"deluser_{user['user_id']}")])
-
-        users_keyboard = InlineKeyboardMarkup(buttons)
-        message_text = "🗑️ Selecciona el usuario que deseas eliminar 👇:\n\nPuedes cancelar con /cancel." # Añadido texto inicial
-
-        # Log antes de enviar/editar mensaje
-        logger.debug("delete_user_start: Preparing to send user list for deletion.")
-        await _send_paginated_or_edit(update, context, message_text, users_keyboard)
-        logger.info("delete_user_start: User list sent. Returning SELECT_USER_TO_DELETE.")
+        logger.info("delete_user_start: User picker sent. Returning SELECT_USER_TO_DELETE.")
         return SELECT_USER_TO_DELETE
 
     except Exception as e:
@@ -331,7 +442,7 @@ async def received_user_delete_selection(update: Update, context: ContextTypes.D
              await query.edit_message_text("⛔ No puedes eliminarte a ti mismo.", reply_markup=get_back_to_menu_keyboard())
              return ConversationHandler.END
 
-        user_info = db.get_user_status_db(user_id_to_delete)
+        user_info = await adb.get_user_status_db(user_id_to_delete)
         if not user_info:
              await query.edit_message_text("❌ Usuario no encontrado.", reply_markup=get_back_to_menu_keyboard())
              return ConversationHandler.END
@@ -383,7 +494,7 @@ async def confirm_user_delete(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     if confirmation == "deleteuser_confirm_yes":
         logger.info(f"Admin {admin_id} confirma eliminar usuario ID {user_id_to_delete}.")
-        success = db.delete_user_db(user_id=user_id_to_delete)
+        success = await adb.delete_user_db(user_id=user_id_to_delete)
 
         if success:
             confirmation_text = f"🗑️ ¡Usuario ID `{user_id_to_delete}` eliminado correctamente de la lista de autorizados!"
@@ -413,11 +524,16 @@ deleteuser_conv_handler = ConversationHandler(
         CallbackQueryHandler(delete_user_start, pattern=f"^{CALLBACK_ADMIN_DELETE_USER_START}$")
         ],
     states={
-        SELECT_USER_TO_DELETE: [CallbackQueryHandler(received_user_delete_selection, pattern="^deluser_")],
+        SELECT_USER_TO_DELETE: [CallbackQueryHandler(received_user_delete_selection, pattern="^deluser_")]
+                               + build_user_picker_handlers("deluser_", DELETE_USER_PICKER_TITLE, SELECT_USER_TO_DELETE),
         CONFIRM_USER_DELETE: [CallbackQueryHandler(confirm_user_delete, pattern="^deleteuser_confirm_")],
+        ConversationHandler.TIMEOUT: build_timeout_handlers("delete_user", ('delete_user_id', 'user_picker')),
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: generic_cancel_conversation(u, c, "delete_user"))],
-    allow_reentry=True
+    allow_reentry=True,
+    name="delete_user",
+    conversation_timeout=get_conversation_timeout("delete_user"),
+    persistent=True,
 )
 
 
@@ -437,24 +553,15 @@ async def edit_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             logger.error(f"Error answering callback query in edit_user_start: {e}")
 
     try:
-        users = db.list_users_db()
-        editable_users = [u for u in users if u['user_id'] != admin_id] # No permitir editar al propio admin
+        context.user_data['user_picker'] = {} # Selector nuevo: sin búsqueda previa
+        has_users = await show_user_picker(update, context, "edituser_", EDIT_USER_PICKER_TITLE)
 
-        if not editable_users:
+        if not has_users:
             message_text = "ℹ️ No hay otros usuarios registrados para editar."
             keyboard = get_back_to_menu_keyboard()
             await _send_paginated_or_edit(update, context, message_text, keyboard)
             return ConversationHandler.END
 
-        buttons = []
-        for user in editable_users:
-            label = f"ID: {user['user_id']} - {user['name']}"
-            buttons.append([InlineKeyboardButton(label, callback_data=f"edituser_{user['user_id']}")])
-
-        users_keyboard = InlineKeyboardMarkup(buttons)
-        message_text = "✏️ Selecciona el usuario que deseas editar 👇:\n\nPuedes cancelar con /cancel."
-
-        await _send_paginated_or_edit(update, context, message_text, users_keyboard, schedule_delete=False) # No borrar lista de selección
         return SELECT_USER_TO_EDIT
 
     except Exception as e:
@@ -479,7 +586,7 @@ async def received_user_edit_selection(update: Update, context: ContextTypes.DEF
 
     try:
         user_id_to_edit = int(user_id_to_edit_str)
-        user_info = db.get_user_status_db(user_id_to_edit)
+        user_info = await adb.get_user_status_db(user_id_to_edit)
 
         if not user_info:
              await query.edit_message_text("❌ Usuario no encontrado.", reply_markup=get_back_to_menu_keyboard())
@@ -561,7 +668,7 @@ async def received_new_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data.clear()
         return ConversationHandler.END
 
-    success = db.update_user_name_db(user_id_to_edit, new_name)
+    success = await adb.update_user_name_db(user_id_to_edit, new_name)
     name_escaped = db.escape_markdown(new_name)
     if success:
         confirmation_text = f"✅ Nombre del usuario ID `{user_id_to_edit}` actualizado a *{name_escaped}*."
@@ -594,14 +701,14 @@ async def received_new_days(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         days_active = int(user_input)
         if days_active <= 0:
-            await update.message.reply_text("El número de días debe ser positivo. Intenta de nuevo.")
+            remember_prompt(context, await update.message.reply_text("El número de días debe ser positivo. Intenta de nuevo."))
             return GET_NEW_DAYS
 
         current_ts = int(time.time())
         new_expiry_ts = current_ts + (days_active * 24 * 60 * 60)
         new_expiry_date = datetime.fromtimestamp(new_expiry_ts).strftime('%d/%m/%Y %H:%M')
 
-        success = db.update_user_expiry_db(user_id_to_edit, new_expiry_ts)
+        success = await adb.update_user_expiry_db(user_id_to_edit, new_expiry_ts)
 
         if success:
             confirmation_text = f"✅ Acceso del usuario ID `{user_id_to_edit}` actualizado.\nNueva expiración: *{new_expiry_date}* ({days_active} días desde ahora)."
@@ -632,13 +739,18 @@ edituser_conv_handler = ConversationHandler(
         CallbackQueryHandler(edit_user_start, pattern=f"^{CALLBACK_ADMIN_EDIT_USER_PROMPT}$")
         ],
     states={
-        SELECT_USER_TO_EDIT: [CallbackQueryHandler(received_user_edit_selection, pattern="^edituser_")],
+        SELECT_USER_TO_EDIT: [CallbackQueryHandler(received_user_edit_selection, pattern="^edituser_")]
+                             + build_user_picker_handlers("edituser_", EDIT_USER_PICKER_TITLE, SELECT_USER_TO_EDIT),
         CHOOSE_FIELD_TO_EDIT: [CallbackQueryHandler(received_field_edit_selection, pattern="^editfield_")],
         GET_NEW_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_new_name)],
         GET_NEW_DAYS: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_new_days)],
+        ConversationHandler.TIMEOUT: build_timeout_handlers("edit_user", ('edit_user_id', 'edit_user_name', 'edit_field', 'user_picker')),
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: generic_cancel_conversation(u, c, "edit_user"))],
-    allow_reentry=True
+    allow_reentry=True,
+    name="edit_user",
+    conversation_timeout=get_conversation_timeout("edit_user"),
+    persistent=True,
 )
 
 # --- Handlers Simples (Listados) ---
@@ -647,16 +759,16 @@ async def _send_paginated_or_edit(update: Update, context: ContextTypes.DEFAULT_
     """
     Envía o edita un mensaje, paginando si es necesario.
     Programa el borrado de los mensajes enviados/editados si schedule_delete es True,
-    excepto si el teclado es el de 'Volver al Menú'.
+    excepto si el teclado es el de 'Volver al Menú'. Devuelve el último mensaje enviado/editado (o None).
     """
     query = update.callback_query
     is_callback = bool(query)
     chat_id = update.effective_chat.id
-    job_queue = context.job_queue
     max_length = 4096 # Límite de Telegram
 
     sent_messages_ids = []
-    is_back_to_menu_keyboard = (keyboard == get_back_to_menu_keyboard())
+    last_message = None
+    is_back_to_menu_keyboard = keyboard is get_back_to_menu_keyboard()
 
     try:
         if is_callback:
@@ -668,6 +780,7 @@ async def _send_paginated_or_edit(update: Update, context: ContextTypes.DEFAULT_
                     reply_markup=keyboard
                 )
                 sent_messages_ids.append(edited_message.message_id)
+                last_message = edited_message
                 if len(text) > max_length:
                      logger.warning("Mensaje editado truncado por longitud.")
                      # Opcional: enviar el resto en mensajes nuevos si es necesario
@@ -696,16 +809,12 @@ async def _send_paginated_or_edit(update: Update, context: ContextTypes.DEFAULT_
                     reply_markup=current_keyboard
                 )
                 sent_messages_ids.append(msg.message_id)
+                last_message = msg
 
         # Programar borrado solo si schedule_delete es True Y no es el teclado de volver al menú
         if schedule_delete and not is_back_to_menu_keyboard:
             for msg_id in sent_messages_ids:
-                job_queue.run_once(
-                    delete_message_later,
-                    when=timedelta(seconds=DELETE_DELAY_SECONDS),
-                    data={'chat_id': chat_id, 'message_id': msg_id},
-                    name=f'delete_{chat_id}_{msg_id}'
-                )
+                schedule_message_deletion(chat_id, msg_id, DELETE_DELAY_SECONDS)
                 logger.info(f"Programado borrado del mensaje {msg_id} en {DELETE_DELAY_SECONDS} segundos.")
         elif is_back_to_menu_keyboard:
              logger.info(f"No se programó borrado para mensaje {sent_messages_ids[-1]} (contiene botón 'Volver al Menú').")
@@ -721,6 +830,7 @@ async def _send_paginated_or_edit(update: Update, context: ContextTypes.DEFAULT_
         if not sent_messages_ids:
              try: await context.bot.send_message(chat_id, "⚠️ Ocurrió un error inesperado.")
              except Exception as send_e: logger.error(f"No se pudo enviar mensaje de error: {send_e}")
+    return last_message
 
 
 @admin_required
@@ -732,10 +842,20 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if is_callback: await query.answer()
     logger.info(f"Admin {admin_id} solicitó listar usuarios (is_callback: {is_callback}).")
 
+    # Cursor keyset de la página pedida (None = primera página)
+    direction, cursor = parse_page_callback(query.data if is_callback else None, CALLBACK_ADMIN_USERS_PAGE)
+
     try:
-        users = db.list_users_db()
+        users = await _fetch_users_page(direction, cursor)
+        if not users and direction:
+            # El usuario usado como cursor ya no existe: volver a la primera página
+            direction, cursor = None, None
+            users = await _fetch_users_page(None, None)
+        users, has_prev, has_next = split_page(users, direction, PAGE_SIZE)
+
         if not users:
             user_list_text = "ℹ️ No hay usuarios registrados."
+            keyboard = get_back_to_menu_keyboard()
             logger.info("list_users: No users found in DB.")
         else:
             logger.info(f"list_users: Formatting {len(users)} users.")
@@ -750,25 +870,212 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
                     f"   Nombre: {name_escaped}\n"
                     f"   Expira: {expiry_date} ({status})"
                 )
+            keyboard = get_pagination_keyboard(CALLBACK_ADMIN_USERS_PAGE, users[0]['user_id'], users[-1]['user_id'], has_prev, has_next)
 
-        final_keyboard = get_back_to_menu_keyboard()
-        await _send_paginated_or_edit(update, context, user_list_text, final_keyboard)
+        # Una página = un mensaje, editado en el sitio al navegar
+        await _send_paginated_or_edit(update, context, user_list_text, keyboard, schedule_delete=False)
         logger.info(f"list_users: Lista enviada/editada para admin {admin_id}.")
 
     except Exception as e:
         logger.error(f"Error al procesar list_users para admin {admin_id}: {e}", exc_info=True)
         await _send_paginated_or_edit(update, context, "⚠️ Ocurrió un error al listar usuarios.", get_back_to_menu_keyboard())
 
+async def _fetch_users_page(direction: str | None, cursor: int | None) -> list:
+    """Consulta keyset de una página de usuarios (una fila extra para saber si hay más)."""
+    if direction == 'prev':
+        return await adb.list_users_db(before_user_id=cursor, limit=PAGE_SIZE + 1)
+    return await adb.list_users_db(after_user_id=cursor, limit=PAGE_SIZE + 1)
+
+@admin_required
+async def db_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(Admin) Muestra el perfil de rendimiento y los PRAGMA efectivos de la base de datos."""
+    admin_id = update.effective_user.id
+    logger.info(f"Admin {admin_id} solicitó /dbinfo.")
+
+    try:
+        report = await adb.get_db_settings_report()
+        cache_stats = db.get_auth_cache_stats()
+        info_text = "🗄️ *Configuración de la Base de Datos*\n"
+        for key, value in report.items():
+            info_text += f"\n`{key}`: `{value}`"
+        info_text += (
+            f"\n\n🔐 *Caché de autorización:* {cache_stats['size']} usuarios, "
+            f"{cache_stats['hits']} aciertos / {cache_stats['misses']} fallos "
+            f"({cache_stats['hit_rate']:.0%})"
+        )
+        info_text += (
+            f"\n🗑️ *Borrados pendientes:* {deletion_scheduler.pending_count()} mensajes "
+            f"({deletion_scheduler.deleted_count} borrados, {deletion_scheduler.failed_count} fallidos, "
+            f"{deletion_scheduler.retried_count} reintentados)"
+        )
+        send_stats = send_rate_limiter.get_stats()
+        info_text += (
+            f"\n📤 *Cola de envíos:* {send_stats['queue_depth']} en espera (máx. {send_stats['max_queue_depth']}), "
+            f"{send_stats['sent']} enviados, {send_stats['retries']} reintentos por flood-wait, "
+            f"{send_stats['failed']} descartados, {send_stats['throttled_seconds']}s de espera acumulada"
+        )
+        update_stats = update_processor.get_stats()
+        info_text += (
+            f"\n📥 *Updates:* {update_stats['active']}/{update_stats['workers']} workers ocupados, "
+            f"{update_stats['pending']} en cola, {update_stats['processed']} procesados; espera p50 "
+            f"{update_stats['wait_p50_ms']} ms, p95 {update_stats['wait_p95_ms']} ms, máx. {update_stats['wait_max_ms']} ms"
+        )
+        persistence_stats = sqlite_persistence.get_stats()
+        info_text += (
+            f"\n💾 *Persistencia:* datos de {persistence_stats['tracked_users']} usuarios, "
+            f"{persistence_stats['saved_keys']} claves guardadas, {persistence_stats['expired_users']} usuarios "
+            f"inactivos liberados, {persistence_stats['expired_conversations']} conversaciones caducadas terminadas, "
+            f"{persistence_stats['expired_rows']} filas caducadas purgadas"
+        )
+        info_text += f"\n🚪 *Flujos abandonados:* {sum(abandoned_flows.values())}"
+        if abandoned_flows:
+            info_text += " (" + ", ".join(f"{db.escape_markdown(name)}: {count}" for name, count in abandoned_flows.most_common()) + ")"
+        await _send_paginated_or_edit(update, context, info_text, get_back_to_menu_keyboard())
+    except Exception as e:
+        logger.error(f"Error al procesar db_info para admin {admin_id}: {e}", exc_info=True)
+        await _send_paginated_or_edit(update, context, "⚠️ Ocurrió un error al leer la configuración de la BD.", get_back_to_menu_keyboard())
+
+@admin_required
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(Admin) Resumen de las métricas de rendimiento: updates, reparto BD/API, handlers lentos y errores."""
+    admin_id = update.effective_user.id
+    logger.info(f"Admin {admin_id} solicitó /perf.")
+
+    try:
+        summary = bot_metrics.get_summary()
+        if not summary['enabled']:
+            await _send_paginated_or_edit(update, context, "📈 Las métricas están desactivadas (METRICS_ENABLED=false).", get_back_to_menu_keyboard())
+            return
+        updates = summary['updates']
+        perf_text = (
+            f"📈 *Rendimiento* (últimos {summary['uptime_seconds'] // 60} min)\n"
+            f"\n📥 *Updates:* {updates['count']}, p50 {updates['p50_ms']} ms, p95 {updates['p95_ms']} ms, máx. {updates['max_ms']} ms"
+            f"\n⏱️ *Tiempo total:* {updates['total_s']}s, de ellos BD {summary['db_seconds']}s y Bot API {summary['api_seconds']}s"
+        )
+        if updates['total_s']:
+            perf_text += f" ({summary['db_seconds'] / updates['total_s']:.0%} / {summary['api_seconds'] / updates['total_s']:.0%})"
+
+        sections = (
+            ("🐢 *Handlers más lentos (p95):*", summary['handlers']),
+            ("🗄️ *BD (tiempo total):*", summary['db_calls']),
+            ("📤 *Bot API (tiempo total):*", summary['api_calls']),
+        )
+        for title, rows in sections:
+            if rows:
+                perf_text += f"\n\n{title}"
+                for name, stats in rows:
+                    perf_text += (
+                        f"\n• {db.escape_markdown(name)}: {stats['count']}×, p50 {stats['p50_ms']} ms, "
+                        f"p95 {stats['p95_ms']} ms, total {stats['total_s']}s"
+                    )
+        counters = (
+            ("❌ *Errores por handler:*", summary['handler_errors']),
+            ("❌ *Errores por botón:*", summary['callback_errors']),
+            ("🔀 *Transiciones de conversación:*", summary['transitions']),
+        )
+        for title, rows in counters:
+            if rows:
+                perf_text += f"\n\n{title} " + ", ".join(f"{db.escape_markdown(name)}: {count}" for name, count in rows)
+        await _send_paginated_or_edit(update, context, perf_text, get_back_to_menu_keyboard())
+    except Exception as e:
+        logger.error(f"Error al procesar perf_command para admin {admin_id}: {e}", exc_info=True)
+        await _send_paginated_or_edit(update, context, "⚠️ Ocurrió un error al leer las métricas.", get_back_to_menu_keyboard())
+
+SLOW_QUERIES_TOP = 10
+_SLOW_QUERIES_ORDERS = {'total': "tiempo total", 'max': "ejecución más lenta", 'count': "ejecuciones"}
+
+@admin_required
+async def slow_queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    (Admin) Estadísticas por sentencia SQL: /slowqueries [total|max|count] ordena por tiempo acumulado
+    (por defecto), por la ejecución más lenta o por número de ejecuciones; /slowqueries reset las reinicia.
+    """
+    admin_id = update.effective_user.id
+    arg = context.args[0].lower() if context.args else 'total'
+    logger.info(f"Admin {admin_id} solicitó /slowqueries {arg}.")
+
+    if arg == 'reset':
+        query_stats.reset()
+        await update.message.reply_text("🧹 Estadísticas de consultas reiniciadas.", reply_markup=get_back_to_menu_keyboard())
+        return
+    if arg not in _SLOW_QUERIES_ORDERS:
+        await update.message.reply_text("Uso: /slowqueries [total|max|count|reset]", reply_markup=get_back_to_menu_keyboard())
+        return
+
+    try:
+        summary = query_stats.get_summary()
+        text = (
+            f"🐢 *Consultas SQL* (por {_SLOW_QUERIES_ORDERS[arg]}, desde {datetime.fromtimestamp(summary['since_ts']).strftime('%d/%m %H:%M')})\n"
+            f"{summary['statements']} sentencias, {summary['executions']} ejecuciones, {summary['total_ms']} ms en total; "
+            f"{summary['slow']} lentas (≥ {summary['threshold_ms']:g} ms)"
+        )
+        for i, stats in enumerate(query_stats.get_stats(SLOW_QUERIES_TOP, arg), start=1):
+            text += (
+                f"\n\n*{i}.* {stats['count']}×, total {stats['total_ms']} ms, media {stats['avg_ms']} ms, "
+                f"máx. {stats['max_ms']} ms, {stats['slow']} lentas"
+            )
+            if stats['full_scans']:
+                text += f"\n⚠️ Recorre entera: {db.escape_markdown(', '.join(stats['full_scans']))}"
+            text += f"\n`{stats['sql'][:300]}`"
+            if stats['plan']:
+                text += f"\nPlan: `{' / '.join(stats['plan'])[:300]}`"
+        await _send_paginated_or_edit(update, context, text, get_back_to_menu_keyboard())
+    except Exception as e:
+        logger.error(f"Error al procesar slow_queries_command para admin {admin_id}: {e}", exc_info=True)
+        await _send_paginated_or_edit(update, context, "⚠️ Ocurrió un error al leer las estadísticas de consultas.", get_back_to_menu_keyboard())
+
+INDEX_ADVISOR_STATEMENTS = 30 # Sentencias registradas (las de más tiempo acumulado) que revisa /indexadvisor
+
+@admin_required
+async def index_advisor_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(Admin) Revisa los índices y el plan de las consultas críticas y de las sentencias más costosas registradas."""
+    admin_id = update.effective_user.id
+    logger.info(f"Admin {admin_id} solicitó /indexadvisor.")
+
+    try:
+        statements = [stats['sql'] for stats in query_stats.get_stats(INDEX_ADVISOR_STATEMENTS)]
+        advice = await adb.get_index_advice(statements)
+        text = "🧭 *Asesor de Índices*\n"
+        if advice['missing']:
+            text += f"\n⚠️ *Faltan índices gestionados* (se crean al reiniciar el bot): {db.escape_markdown(', '.join(advice['missing']))}"
+        else:
+            text += f"\n✅ Están los {len(db.MANAGED_INDEXES)} índices gestionados."
+        if advice['obsolete']:
+            text += f"\n⚠️ *Índices obsoletos aún presentes:* {db.escape_markdown(', '.join(advice['obsolete']))}"
+        if advice['kept']:
+            text += f"\nℹ️ Obsoletos conservados (ningún otro índice los cubre en esta BD): {db.escape_markdown(', '.join(advice['kept']))}"
+        for redundant in advice['redundant']:
+            text += f"\n♻️ {db.escape_markdown(redundant['index'])} ({db.escape_markdown(redundant['table'])}) sobra: lo cubre {db.escape_markdown(redundant['covered_by'])}"
+
+        text += "\n\n*Consultas críticas:*"
+        for review in advice['workload']:
+            icon = "⚠️" if review['problems'] else "✅"
+            text += f"\n{icon} {review['name']}"
+            if review['problems']:
+                text += f": {db.escape_markdown('; '.join(review['problems']))}"
+            text += f"\n`{' / '.join(review['plan'])}`"
+
+        flagged = [review for review in advice['statements'] if review['problems']]
+        text += f"\n\n*Sentencias registradas:* {len(advice['statements'])} revisadas, {len(flagged)} con recorridos completos u ordenaciones temporales"
+        for review in flagged:
+            text += f"\n• {db.escape_markdown('; '.join(review['problems']))}: `{review['sql'][:300]}`"
+        await _send_paginated_or_edit(update, context, text, get_back_to_menu_keyboard())
+    except Exception as e:
+        logger.error(f"Error al procesar index_advisor_command para admin {admin_id}: {e}", exc_info=True)
+        await _send_paginated_or_edit(update, context, "⚠️ Ocurrió un error al ejecutar el asesor de índices.", get_back_to_menu_keyboard())
+
 # --- Funciones Auxiliares ---
 
-def get_admin_specific_buttons() -> list:
-    """Devuelve la lista de botones específicos para el menú de administrador."""
-    return [
-        [InlineKeyboardButton("🔑 Admin: Listar Usuarios", callback_data=CALLBACK_ADMIN_LIST_USERS)],
-        [InlineKeyboardButton("👤 Admin: Añadir/Act. Usuario", callback_data=CALLBACK_ADMIN_ADD_USER_PROMPT)],
-        [InlineKeyboardButton("✏️ Admin: Editar Usuario", callback_data=CALLBACK_ADMIN_EDIT_USER_PROMPT)],
-        [InlineKeyboardButton("🗑️ Admin: Eliminar Usuario", callback_data=CALLBACK_ADMIN_DELETE_USER_START)],
-    ]
+_ADMIN_SPECIFIC_BUTTONS = (
+    (InlineKeyboardButton("🔑 Admin: Listar Usuarios", callback_data=CALLBACK_ADMIN_LIST_USERS),),
+    (InlineKeyboardButton("👤 Admin: Añadir/Act. Usuario", callback_data=CALLBACK_ADMIN_ADD_USER_PROMPT),),
+    (InlineKeyboardButton("✏️ Admin: Editar Usuario", callback_data=CALLBACK_ADMIN_EDIT_USER_PROMPT),),
+    (InlineKeyboardButton("🗑️ Admin: Eliminar Usuario", callback_data=CALLBACK_ADMIN_DELETE_USER_START),),
+)
+
+def get_admin_specific_buttons() -> tuple:
+    """Devuelve las filas de botones específicos para el menú de administrador (tupla inmutable, construida una vez)."""
+    return _ADMIN_SPECIFIC_BUTTONS
 
 # --- ELIMINAR list_all_accounts ---
 # @admin_required
@@ -0,0 +1,104 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+from metrics import bot_metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del Ejecutor de BD ---
+# Por defecto tantos hilos como conexiones en el pool, para que ningún hilo espere conexión
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(db.DB_POOL_SIZE)))
+
+_executor = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Crea el ejecutor dedicado de BD en el primer uso."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db-worker")
+        logger.info(f"Ejecutor de BD iniciado con {DB_EXECUTOR_WORKERS} hilos.")
+    return _executor
+
+async def run_db(func, *args, **kwargs):
+    """
+    Ejecuta una función síncrona de database.py en el ejecutor de BD y espera su resultado
+    sin bloquear el event loop de python-telegram-bot.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+    finally:
+        # Incluye la espera por un hilo libre: es el tiempo que el handler pasa esperando a la BD
+        bot_metrics.record_db(getattr(func, '__name__', 'db'), time.perf_counter() - start)
+
+def _async_wrapper(func):
+    """Genera la versión 'await'-able de una función de database.py."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+def shutdown() -> None:
+    """Espera a que terminen las operaciones pendientes y cierra el ejecutor y el pool."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+        logger.info("Ejecutor de BD detenido.")
+    db.close_db()
+
+# --- Funciones de Usuarios ---
+add_user_db = _async_wrapper(db.add_user_db)
+get_user_status_db = _async_wrapper(db.get_user_status_db)
+
+async def is_user_authorized(user_id: int) -> bool:
+    """Responde desde la caché de autorización sin salir del event loop; solo consulta la BD si falla."""
+    if user_id == db.ADMIN_USER_ID:
+        return True
+    cached = db.get_cached_authorization(user_id)
+    if cached is not None:
+        return cached
+    return await run_db(db.load_user_authorization, user_id)
+
+list_users_db = _async_wrapper(db.list_users_db)
+delete_user_db = _async_wrapper(db.delete_user_db)
+update_user_name_db = _async_wrapper(db.update_user_name_db)
+update_user_expiry_db = _async_wrapper(db.update_user_expiry_db)
+
+# --- Funciones de Cuentas y Perfiles ---
+add_account_db = _async_wrapper(db.add_account_db)
+import_accounts_bulk_db = _async_wrapper(db.import_accounts_bulk_db)
+get_accounts_for_user = _async_wrapper(db.get_accounts_for_user)
+get_account_id_for_profile_db = _async_wrapper(db.get_account_id_for_profile_db)
+update_account_email_db = _async_wrapper(db.update_account_email_db)
+update_profile_pin_db = _async_wrapper(db.update_profile_pin_db)
+update_profile_name_db = _async_wrapper(db.update_profile_name_db)
+delete_account_db = _async_wrapper(db.delete_account_db)
+get_all_accounts_db = _async_wrapper(db.get_all_accounts_db)
+
+# --- Cola Persistente de Borrados de Mensajes ---
+save_pending_deletions_db = _async_wrapper(db.save_pending_deletions_db)
+remove_pending_deletions_db = _async_wrapper(db.remove_pending_deletions_db)
+load_pending_deletions_db = _async_wrapper(db.load_pending_deletions_db)
+
+# --- Persistencia de Conversaciones y user_data ---
+load_conversation_states_db = _async_wrapper(db.load_conversation_states_db)
+save_conversation_state_db = _async_wrapper(db.save_conversation_state_db)
+load_user_data_db = _async_wrapper(db.load_user_data_db)
+save_user_data_db = _async_wrapper(db.save_user_data_db)
+delete_user_data_db = _async_wrapper(db.delete_user_data_db)
+purge_stale_persistence_db = _async_wrapper(db.purge_stale_persistence_db)
+
+# --- Funciones de Limpieza ---
+delete_expired_accounts = _async_wrapper(db.delete_expired_accounts)
+
+# --- Mantenimiento y Diagnóstico ---
+run_db_maintenance = _async_wrapper(db.run_db_maintenance)
+get_db_settings_report = _async_wrapper(db.get_db_settings_report)
+get_index_advice = _async_wrapper(db.get_index_advice)
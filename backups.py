@@ -0,0 +1,337 @@
+import asyncio
+import codecs
+import functools
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+from telegram import InputFile
+
+try:
+    import zstandard  # Opcional: solo necesario para backups .jsonl.zst
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del Parser de Backups ---
+BACKUP_CHUNK_SIZE = 64 * 1024  # Bytes leídos por iteración
+MAX_BACKUP_ROWS = int(os.getenv("MAX_BACKUP_ROWS", "50000"))  # Perfiles admitidos como máximo en una importación
+BOT_API_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # La Bot API no descarga archivos mayores
+# Tope de bytes descomprimidos: el límite de descarga solo acota el archivo comprimido (bombas de descompresión)
+MAX_BACKUP_BYTES = int(os.getenv("MAX_BACKUP_BYTES", str(10 * BOT_API_DOWNLOAD_LIMIT)))
+MAX_BACKUP_LINE_LENGTH = 1024 * 1024  # Caracteres como máximo en una línea (una cuenta JSONL ocupa muy poco)
+MAX_BACKUP_LINES = 10 * MAX_BACKUP_ROWS + 100  # El formato de texto usa 7 líneas por perfil; evita recorrer millones de líneas vacías
+
+# Una sola expresión para las cuatro claves del formato de texto
+LEGACY_FIELD_RE = re.compile(r"^(Servicio|Email|Perfil|PIN):\s*(.+)$", re.IGNORECASE)
+LEGACY_FIELD_KEYS = {
+    'servicio': 'service',
+    'email': 'email',
+    'perfil': 'profile_name',
+    'pin': 'pin',
+}
+LEGACY_REQUIRED_KEYS = ('service', 'email', 'profile_name', 'pin')
+LEGACY_HEADER_PREFIXES = ("Backup de Cuentas", "Fecha:", "=")
+
+# Formato estructurado: JSON Lines versionado, una línea de cabecera y una línea por cuenta
+JSONL_FORMAT_NAME = "streaming-accounts-backup"
+JSONL_FORMAT_VERSION = 1
+JSONL_COMPRESSIONS = {None: ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+# Firmas (magic bytes) para detectar el formato del archivo recibido
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+ACCEPTED_BACKUP_EXTENSIONS = (".txt", ".jsonl", ".jsonl.gz", ".jsonl.zst")
+
+# --- Lectura Incremental ---
+def iter_chunks(stream, chunk_size: int = BACKUP_CHUNK_SIZE, max_bytes: int | None = None):
+    """
+    Lee un objeto tipo archivo en bloques de 'chunk_size' bytes.
+    Lanza ValueError si el total leído supera 'max_bytes' (con un stream descomprimido, bytes ya descomprimidos).
+    """
+    total = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        total += len(chunk)
+        if max_bytes is not None and total > max_bytes:
+            raise ValueError(f"El backup supera {max_bytes // (1024 * 1024)} MB una vez descomprimido.")
+        yield chunk
+
+def iter_lines(chunks, max_line_length: int | None = None, max_lines: int | None = None):
+    """
+    Decodifica bloques de bytes UTF-8 de forma incremental y devuelve línea a línea.
+    Un carácter multibyte partido entre dos bloques se completa con el siguiente.
+    Lanza ValueError si una línea supera 'max_line_length' caracteres, aunque aún no haya terminado,
+    o si hay más de 'max_lines' líneas.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ""
+    line_count = 0
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(keepends=True)
+        # La última línea puede estar incompleta: se guarda para el siguiente bloque
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ""
+        if max_line_length is not None and (len(pending) > max_line_length or any(len(line) > max_line_length for line in lines)):
+            raise ValueError(f"El backup tiene una línea de más de {max_line_length} caracteres.")
+        line_count += len(lines)
+        if max_lines is not None and line_count > max_lines:
+            raise ValueError(f"El backup tiene más de {max_lines} líneas.")
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+# --- Parser del Formato de Texto ---
+def _is_valid_email(email: str) -> bool:
+    return '@' in email and '.' in email.split('@')[-1]
+
+def parse_legacy_backup(lines):
+    """
+    Máquina de estados sobre el formato de texto de /backupmyaccounts.
+    Devuelve (generador) un diccionario por perfil con 'service', 'email', 'profile_name' y 'pin'.
+    Un registro se cierra con la línea separadora '-----' una vez leídas las cuatro claves.
+    """
+    current_account = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith(LEGACY_HEADER_PREFIXES):
+            continue
+
+        match = LEGACY_FIELD_RE.match(line)
+        if match:
+            current_account[LEGACY_FIELD_KEYS[match.group(1).lower()]] = match.group(2).strip()
+        elif line.startswith("-") and all(k in current_account for k in LEGACY_REQUIRED_KEYS):
+            if _is_valid_email(current_account['email']):
+                yield current_account
+            else:
+                logger.warning(f"Cuenta omitida en importación por email inválido: {current_account}")
+            current_account = {}
+
+    # Último registro sin separador final
+    if all(k in current_account for k in LEGACY_REQUIRED_KEYS) and '@' in current_account['email']:
+        yield current_account
+
+def parse_legacy_backup_stream(stream, chunk_size: int = BACKUP_CHUNK_SIZE):
+    """Atajo: parsea un objeto tipo archivo binario leyendo en bloques."""
+    return parse_legacy_backup(iter_lines(iter_chunks(stream, chunk_size)))
+
+# --- Formato JSON Lines ---
+def zstd_available() -> bool:
+    return zstandard is not None
+
+def group_profiles_by_account(rows: list) -> list:
+    """
+    Agrupa la lista plana de get_accounts_for_user en registros de cuenta con sus perfiles anidados,
+    conservando el orden de aparición.
+    """
+    accounts = {}
+    for row in rows:
+        key = (row['service'], row['email'])
+        record = accounts.get(key)
+        if record is None:
+            record = accounts[key] = {
+                'service': row['service'],
+                'email': row['email'],
+                'registration_ts': row.get('registration_ts'),
+                'expiry_ts': row.get('expiry_ts'),
+                'profiles': [],
+            }
+        record['profiles'].append({'name': row['profile_name'], 'pin': row['pin']})
+    return list(accounts.values())
+
+def build_jsonl_backup(user_id: int, rows: list, compression: str | None = None) -> io.BytesIO:
+    """
+    Genera en memoria un backup JSON Lines: cabecera con formato y versión, y una línea por cuenta.
+    'compression' puede ser None, 'gzip' o 'zstd'. Devuelve el buffer posicionado al inicio.
+    """
+    if compression not in JSONL_COMPRESSIONS:
+        raise ValueError(f"Compresión de backup no soportada: {compression}")
+    if compression == "zstd" and zstandard is None:
+        raise RuntimeError("La compresión zstd requiere el paquete 'zstandard'.")
+
+    accounts = group_profiles_by_account(rows)
+    header = {
+        'format': JSONL_FORMAT_NAME,
+        'version': JSONL_FORMAT_VERSION,
+        'user_id': user_id,
+        'created_ts': int(time.time()),
+        'accounts': len(accounts),
+    }
+
+    buffer = io.BytesIO()
+    if compression == "gzip":
+        writer = gzip.GzipFile(fileobj=buffer, mode='wb')
+    elif compression == "zstd":
+        writer = zstandard.ZstdCompressor().stream_writer(buffer, closefd=False)
+    else:
+        writer = buffer
+
+    writer.write(json.dumps(header, ensure_ascii=False).encode('utf-8') + b"\n")
+    for record in accounts:
+        writer.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b"\n")
+    if writer is not buffer:
+        writer.close()  # Vuelca el final del stream comprimido; el buffer sigue abierto
+
+    buffer.seek(0)
+    return buffer
+
+def parse_jsonl_backup(lines):
+    """
+    Parsea un backup JSON Lines y devuelve (generador) un diccionario por perfil con el mismo
+    formato que parse_legacy_backup. Lanza ValueError si la cabecera o la versión no son válidas.
+    """
+    header = None
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Línea {line_number} no es JSON válido: {e}") from e
+
+        if header is None:
+            if not isinstance(data, dict) or data.get('format') != JSONL_FORMAT_NAME:
+                raise ValueError("El archivo no es un backup JSON Lines reconocido.")
+            if data.get('version') != JSONL_FORMAT_VERSION:
+                raise ValueError(f"Versión de backup no soportada: {data.get('version')}")
+            header = data
+            continue
+
+        service, email = data.get('service'), data.get('email')
+        if not service or not email or not _is_valid_email(email):
+            logger.warning(f"Cuenta omitida en importación JSONL (línea {line_number}): servicio o email inválido.")
+            continue
+        for profile in data.get('profiles') or []:
+            if profile.get('name'):
+                yield {'service': service, 'email': email, 'profile_name': profile['name'], 'pin': profile.get('pin') or 'N/A'}
+
+    if header is None:
+        raise ValueError("El archivo de backup está vacío.")
+
+def detect_backup_format(buffer) -> str:
+    """Detecta el formato por sus primeros bytes: 'gzip', 'zstd', 'jsonl' o 'text'."""
+    position = buffer.tell()
+    head = buffer.read(4)
+    buffer.seek(position)
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if head.lstrip(codecs.BOM_UTF8).lstrip().startswith(b"{"):
+        return "jsonl"
+    return "text"
+
+def limit_rows(rows, max_rows: int = MAX_BACKUP_ROWS):
+    """Reenvía los perfiles de 'rows' y lanza ValueError en cuanto el backup supera 'max_rows'."""
+    for count, row in enumerate(rows, start=1):
+        if count > max_rows:
+            raise ValueError(f"El backup tiene más de {max_rows} perfiles.")
+        yield row
+
+def parse_backup_stream(stream, chunk_size: int = BACKUP_CHUNK_SIZE, max_rows: int = MAX_BACKUP_ROWS,
+                        max_bytes: int = MAX_BACKUP_BYTES, max_line_length: int = MAX_BACKUP_LINE_LENGTH,
+                        max_lines: int = MAX_BACKUP_LINES):
+    """
+    Parsea cualquier formato de backup soportado (.txt, .jsonl, .jsonl.gz, .jsonl.zst).
+    Devuelve (formato, generador de perfiles). La descompresión también es incremental;
+    el generador lanza ValueError si el backup supera 'max_rows' perfiles, 'max_bytes' bytes
+    descomprimidos, 'max_lines' líneas o 'max_line_length' caracteres en una línea.
+    """
+    backup_format = detect_backup_format(stream)
+    if backup_format == "gzip":
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif backup_format == "zstd":
+        if zstandard is None:
+            raise RuntimeError("El backup está comprimido con zstd y el paquete 'zstandard' no está instalado.")
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+
+    lines = iter_lines(iter_chunks(stream, chunk_size, max_bytes), max_line_length, max_lines)
+    if backup_format == "text":
+        return backup_format, limit_rows(parse_legacy_backup(lines), max_rows)
+    return backup_format, limit_rows(parse_jsonl_backup(lines), max_rows)
+
+def load_backup(buffer: io.BytesIO, max_rows: int = MAX_BACKUP_ROWS) -> tuple:
+    """
+    Parsea el backup completo y devuelve (formato, lista de perfiles). La lista se guarda para la
+    confirmación, así que la memoria crece con el número de perfiles (acotado por 'max_rows').
+    Cierra el buffer al terminar.
+    """
+    try:
+        backup_format, rows = parse_backup_stream(buffer, max_rows=max_rows)
+        return backup_format, list(rows)
+    finally:
+        buffer.close()
+
+async def load_backup_async(buffer: io.BytesIO, max_rows: int = MAX_BACKUP_ROWS) -> tuple:
+    """
+    Ejecuta load_backup en el ejecutor por defecto del event loop: parsear (y descomprimir) un backup
+    grande es CPU y no debe frenar los updates de otros usuarios. No usa el ejecutor de BD para no
+    ocupar un hilo con conexión.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(load_backup, buffer, max_rows))
+
+# --- Documentos en Memoria ---
+def build_text_backup(user_id: int, rows: list) -> io.BytesIO:
+    """
+    Genera en memoria el backup en formato de texto de /backupmyaccounts, escribiendo
+    perfil a perfil sobre el buffer (sin concatenar todo el contenido en un str).
+    """
+    buffer = io.BytesIO()
+    writer = io.TextIOWrapper(buffer, encoding='utf-8', newline='\n')
+    writer.write(f"Backup de Cuentas para Usuario ID: {user_id}\n")
+    writer.write(f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    writer.write("=" * 30 + "\n\n")
+    for acc in rows:
+        expiry_date = datetime.fromtimestamp(acc['expiry_ts']).strftime('%d/%m/%Y') if acc.get('expiry_ts') else 'N/A'
+        writer.write(
+            f"ID Cuenta: {acc.get('id', 'N/A')}\n"
+            f"Servicio: {acc.get('service', 'N/A')}\n"
+            f"Email: {acc.get('email', 'N/A')}\n"
+            f"Perfil: {acc.get('profile_name', 'N/A')}\n"
+            f"PIN: {acc.get('pin', 'N/A')}\n"
+            f"Expira: {expiry_date}\n"
+            + "-" * 30 + "\n"
+        )
+    writer.flush()
+    writer.detach()  # Evita que cerrar el wrapper cierre también el buffer
+    buffer.seek(0)
+    return buffer
+
+def snapshot_file(path: str) -> io.BytesIO:
+    """
+    Copia el contenido actual de un archivo a un buffer en memoria con una sola lectura.
+    Como los guardados usan os.replace, la copia siempre corresponde a una versión completa.
+    """
+    with open(path, 'rb') as f:
+        return io.BytesIO(f.read())
+
+async def send_document_from_memory(bot, chat_id: int, buffer: io.BytesIO, filename: str, **kwargs):
+    """Envía un buffer en memoria como documento y lo libera al terminar, haya error o no."""
+    try:
+        return await bot.send_document(chat_id=chat_id, document=InputFile(buffer, filename=filename), **kwargs)
+    finally:
+        buffer.close()
+
+# --- Descarga ---
+async def download_document(document) -> io.BytesIO:
+    """
+    Descarga un documento de Telegram a un buffer en memoria, listo para leer desde el inicio.
+    La Bot API limita las descargas a BOT_API_DOWNLOAD_LIMIT, así que el buffer está acotado.
+    """
+    telegram_file = await document.get_file()
+    buffer = io.BytesIO()
+    await telegram_file.download_to_memory(out=buffer)
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,225 @@
+"""
+Benchmark de las operaciones principales de database.py sobre una BD con datos sintéticos.
+
+Mide cada operación varias veces y guarda p50/p95/p99 (ms) y ops/s en un JSON, para comparar
+entre commits. Como add_account_db y delete_expired_accounts escriben, se mide sobre una copia
+de la BD (salvo con --in-place), así que ejecuciones sucesivas parten de los mismos datos.
+Antes de medir se ejecuta database.init_db() (crea los índices gestionados que falten, igual que
+el bot al arrancar) y al final se muestra el asesor de índices sobre las sentencias ejecutadas.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/db_bench.py --seed                       # genera la BD si no existe y la mide
+    python benchmarks/db_bench.py --output antes.json
+    python benchmarks/db_bench.py --output despues.json --compare antes.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db # noqa: E402
+import seed_db # noqa: E402
+from query_log import query_stats # noqa: E402
+
+PAGE_SIZE = 15 # Igual que el PAGE_SIZE por defecto de los listados del bot
+
+# --- Medición ---
+def percentile(samples: list, p: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+def summarize(samples: list) -> dict:
+    """Resumen de una lista de duraciones en segundos."""
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        'runs': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 4),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 4),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 4),
+        'max_ms': round(samples[-1] * 1000, 4),
+        'ops_per_sec': round(len(samples) / total, 1) if total else None,
+    }
+
+def measure(func, args_iter, runs: int, setup=None) -> dict:
+    """Ejecuta func(*args) 'runs' veces con argumentos distintos; 'setup' (sin medir) se llama antes de cada ejecución."""
+    samples = []
+    for _ in range(runs):
+        args = next(args_iter)
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+def cycle_random(rng: random.Random, values: list, build):
+    while True:
+        yield build(rng.choice(values))
+
+# --- Escenarios ---
+def run_benchmarks(runs: int, heavy_runs: int, seed_value: int) -> dict:
+    rng = random.Random(seed_value)
+    with db.get_connection() as conn:
+        user_ids = [row[0] for row in conn.execute("SELECT user_id FROM users")]
+        owner_ids = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM streaming_accounts")]
+    if not user_ids or not owner_ids:
+        raise SystemExit("❌ La BD no tiene usuarios o cuentas. Genera datos con --seed o benchmarks/seed_db.py.")
+    now = int(time.time())
+    counter = iter(range(10 ** 9))
+    results = {}
+
+    # Con caché: un grupo de usuarios activos que ya han interactuado con el bot
+    db.invalidate_auth_cache()
+    hot_users = rng.sample(user_ids, min(len(user_ids), 200))
+    for user_id in hot_users:
+        db.is_user_authorized(user_id)
+    results['is_user_authorized'] = measure(db.is_user_authorized, cycle_random(rng, hot_users, lambda u: (u,)), runs)
+    # Sin caché: siempre la consulta a la BD
+    results['is_user_authorized_uncached'] = measure(db.load_user_authorization, cycle_random(rng, user_ids, lambda u: (u,)), runs)
+
+    results['get_accounts_for_user'] = measure(db.get_accounts_for_user, cycle_random(rng, owner_ids, lambda u: (u,)), runs)
+    results['get_accounts_for_user_page'] = measure(
+        db.get_accounts_for_user, cycle_random(rng, owner_ids, lambda u: (u, None, None, PAGE_SIZE + 1)), runs
+    )
+
+    results['add_account_db'] = measure(
+        db.add_account_db,
+        cycle_random(rng, owner_ids, lambda u: (
+            u, rng.choice(seed_db.SERVICES), f"bench{next(counter)}@correo-ejemplo.com",
+            [{'name': f"Perfil {n}", 'pin': f"{n}{n}{n}{n}"} for n in range(1, 4)], now, now + 30 * 86400,
+        )),
+        runs,
+    )
+
+    results['list_users_db_page'] = measure(
+        db.list_users_db, cycle_random(rng, user_ids, lambda u: (u, None, PAGE_SIZE + 1)), runs
+    )
+    results['list_users_db_all'] = measure(db.list_users_db, iter(lambda: (), None), heavy_runs)
+    results['get_all_accounts_db'] = measure(db.get_all_accounts_db, iter(lambda: (), None), heavy_runs)
+
+    # La primera purga borra todo lo caducado del seed; después se caducan 500 cuentas antes de cada purga
+    start = time.perf_counter()
+    purged = db.delete_expired_accounts()
+    results['delete_expired_accounts_initial'] = dict(summarize([time.perf_counter() - start]), rows=purged)
+
+    def expire_batch():
+        with db.get_connection() as conn:
+            conn.execute(
+                "UPDATE streaming_accounts SET expiry_ts = ? WHERE id IN (SELECT id FROM streaming_accounts ORDER BY random() LIMIT 500)",
+                (now - 86400,),
+            )
+            conn.commit()
+    results['delete_expired_accounts'] = measure(db.delete_expired_accounts, iter(lambda: (), None), heavy_runs, setup=expire_batch)
+    return results
+
+def copy_database(source: str, target: str) -> None:
+    """Copia consistente de la BD (API de backup de SQLite) para medir sin alterar el original."""
+    remove_database(target)
+    with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+
+def remove_database(path: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+# --- Informe ---
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def print_results(results: dict, baseline: dict | None = None) -> None:
+    header = f"{'Operación':<34}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>11}"
+    if baseline:
+        header += f"{'p50 antes':>11}{'cambio':>9}"
+    print(header)
+    for name, stats in results.items():
+        line = f"{name:<34}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['ops_per_sec'] or 0:>11.1f}"
+        old = (baseline or {}).get(name)
+        if old and old.get('p50_ms'):
+            line += f"{old['p50_ms']:>11.3f}{(stats['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100:>+8.0f}%"
+        print(line)
+
+def print_index_advice() -> None:
+    """Plan de las consultas críticas y sentencias del benchmark que recorren tablas completas u ordenan en memoria."""
+    advice = db.get_index_advice([stats['sql'] for stats in query_stats.get_stats(50)])
+    if advice['missing'] or advice['obsolete'] or advice['kept'] or advice['redundant']:
+        print(
+            f"Índices: faltan {advice['missing']}, obsoletos {advice['obsolete']}, conservados {advice['kept']}, "
+            f"redundantes {[r['index'] for r in advice['redundant']]}"
+        )
+    for review in advice['workload'] + [r for r in advice['statements'] if r['problems']]:
+        flag = f"⚠️ {'; '.join(review['problems'])}" if review['problems'] else "✅"
+        print(f"{flag} {review['name'] or review['sql'][:80]}: {' / '.join(review['plan'])}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark de las operaciones de database.py.")
+    parser.add_argument('--db', default=seed_db.DEFAULT_DB, help="BD a medir (por defecto benchmarks/bench_access_control.db).")
+    parser.add_argument('--seed', action='store_true', help="Generar la BD con seed_db si no existe.")
+    parser.add_argument('--users', type=int, default=50000, help="Con --seed: usuarios a generar.")
+    parser.add_argument('--accounts', type=int, default=200000, help="Con --seed: cuentas a generar.")
+    parser.add_argument('--profiles', type=int, default=1000000, help="Con --seed: perfiles a generar.")
+    parser.add_argument('--runs', type=int, default=500, help="Ejecuciones de cada operación puntual.")
+    parser.add_argument('--heavy-runs', type=int, default=5, help="Ejecuciones de los listados completos y las purgas.")
+    parser.add_argument('--random-seed', type=int, default=1, help="Semilla para elegir usuarios.")
+    parser.add_argument('--output', default=None, help="JSON de salida (por defecto benchmarks/results/db_bench_<commit>.json).")
+    parser.add_argument('--compare', default=None, help="JSON de una ejecución anterior con el que comparar.")
+    parser.add_argument('--in-place', action='store_true', help="Medir directamente sobre --db en vez de sobre una copia.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        if not args.seed:
+            print(f"❌ {args.db} no existe. Usa --seed para generarla.")
+            return 1
+        print(f"Generando datos sintéticos en {args.db}...")
+        print(seed_db.seed(args.db, args.users, args.accounts, args.profiles))
+    db.close_db()
+    work_db = args.db if args.in_place else args.db + ".bench"
+    if not args.in_place:
+        copy_database(args.db, work_db)
+    db.DATABASE_FILE = work_db
+    db.init_db()
+    counts = seed_db.table_counts()
+    print(f"BD {args.db}: {counts}")
+
+    try:
+        results = run_benchmarks(args.runs, args.heavy_runs, args.random_seed)
+        print_index_advice()
+    finally:
+        db.close_db()
+        if not args.in_place:
+            remove_database(work_db)
+    report = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'db_profile': db.DB_PROFILE,
+        'dataset': counts,
+        'results': results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f).get('results')
+    print_results(results, baseline)
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"db_bench_{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {output}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,309 @@
+"""
+Prueba de carga de extremo a extremo de los handlers de bot.py, sin red ni Telegram.
+
+Sustituye la capa HTTP de PTB por una Bot API simulada en el propio proceso (registra envíos,
+ediciones y borrados y puede añadir latencia) y hace pasar por los handlers reales, con el mismo
+procesador concurrente de updates que en producción, secuencias de updates por usuario:
+menú, /get, la conversación /addmyaccount, importaciones de backup y listados de admin.
+Para cada escenario muestra updates/s, latencia por update (p50/p95/p99, desde que entra en el
+procesador hasta que terminan sus handlers) y llamadas a la API por método; al final, el desglose
+por handler de metrics.py (el tiempo de Bot API solo se registra con --rate-limit).
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --users 500 --latency-ms 40 --jitter-ms 20 --scenarios menu get
+    python benchmarks/load_test.py --rate-limit --output resultados.json
+La BD es temporal: no se toca access_control.db.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update # noqa: E402
+from telegram.request import BaseRequest # noqa: E402
+
+FIRST_USER_ID = 700000000
+SCENARIOS = ("menu", "get", "addmyaccount", "import", "admin")
+
+# --- Bot API Simulada ---
+class FakeBotAPI(BaseRequest):
+    """
+    Capa de peticiones de PTB que responde en memoria como lo haría la Bot API.
+    Cuenta las llamadas por método, sirve los archivos registrados con add_file() y
+    espera latency_ms ± jitter_ms antes de cada respuesta.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, seed: int = 1):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.calls = Counter()
+        self.files = {}            # file_id -> bytes
+        self._message_ids = itertools.count(1)
+        self._rng = random.Random(seed)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def add_file(self, file_id: str, content: bytes) -> None:
+        self.files[file_id] = content
+
+    def take_calls(self) -> dict:
+        """Devuelve las llamadas contadas desde la última vez y reinicia el contador."""
+        calls, self.calls = dict(self.calls), Counter()
+        return calls
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter)))
+        if method == "GET": # Descarga de un archivo (file_path = documents/<file_id>)
+            self.calls['downloadFile'] += 1
+            return 200, self.files.get(url.rsplit('/', 1)[-1], b"")
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({'ok': True, 'result': self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return {'id': 123456, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'load_test_bot'}
+        if endpoint == "getFile":
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.files.get(file_id, b"")), 'file_path': f"documents/{file_id}"}
+        if endpoint.startswith(("send", "edit", "copy", "forward")):
+            message = {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+            if endpoint == "sendDocument":
+                message['document'] = {'file_id': 'doc', 'file_unique_id': 'doc', 'file_name': 'backup'}
+            return message
+        return True # deleteMessage(s), answerCallbackQuery, setMyCommands...
+
+# --- Updates Sintéticos ---
+_ids = itertools.count(1)
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"Carga{user_id % 1000}"}
+
+def message_update(user_id: int, text: str) -> dict:
+    message = {'message_id': next(_ids), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': _user(user_id), 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_ids), 'message': message}
+
+def document_update(user_id: int, file_id: str, file_name: str, size: int) -> dict:
+    document = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': file_name, 'file_size': size}
+    message = {'message_id': next(_ids), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': _user(user_id), 'document': document}
+    return {'update_id': next(_ids), 'message': message}
+
+def callback_update(user_id: int, data: str) -> dict:
+    message = {'message_id': next(_ids), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'text': 'menu'}
+    return {'update_id': next(_ids), 'callback_query': {'id': str(next(_ids)), 'chat_instance': 'load', 'data': data, 'from': _user(user_id), 'message': message}}
+
+# --- Escenarios ---
+def build_scripts(name: str, user_ids: list, admin_id: int, api: FakeBotAPI, args) -> list:
+    """Lista de guiones (uno por usuario); cada guion es una lista de funciones que crean el update."""
+    import backups
+    import database as db
+    from admin_handlers import CALLBACK_ADMIN_LIST_USERS, CALLBACK_ADMIN_USERS_PAGE
+    from utils import PAGE_SIZE
+
+    if name == "menu":
+        return [[
+            lambda u=u: message_update(u, "/start"),
+            lambda u=u: callback_update(u, "show_status"),
+            lambda u=u: callback_update(u, "back_to_menu"),
+            lambda u=u: callback_update(u, "list_accounts"),
+            lambda u=u: callback_update(u, "back_to_menu"),
+        ] for u in user_ids]
+    if name == "get":
+        return [[lambda u=u: message_update(u, "/get")] for u in user_ids]
+    if name == "addmyaccount":
+        run = int(time.time())
+        return [[
+            lambda u=u: message_update(u, "/addmyaccount"),
+            lambda u=u: callback_update(u, "service_Netflix"),
+            lambda u=u: message_update(u, f"carga{u}.{run}@correo-ejemplo.com"),
+            lambda u=u: message_update(u, "2"),
+            lambda u=u: message_update(u, "Perfil A"),
+            lambda u=u: message_update(u, "1111"),
+            lambda u=u: message_update(u, "Perfil B"),
+            lambda u=u: message_update(u, "2222"),
+        ] for u in user_ids]
+    if name == "import":
+        scripts = []
+        for u in user_ids:
+            rows = [
+                {'service': service, 'email': f"import{u}.{i}@correo-ejemplo.com", 'profile_name': f"Perfil {p}", 'pin': f"{p}{p}{p}{p}"}
+                for i, service in enumerate(("Spotify", "HBO Max", "Prime Video")) for p in (1, 2)
+            ]
+            content = backups.build_jsonl_backup(u, rows, compression="gzip").getvalue()
+            file_id = f"backup{u}"
+            api.add_file(file_id, content)
+            scripts.append([
+                lambda u=u: message_update(u, "/importmyaccounts"),
+                lambda u=u, f=file_id, n=len(content): document_update(u, f, "backup.jsonl.gz", n),
+                lambda u=u: callback_update(u, "import_confirm_yes"),
+            ])
+        return scripts
+    if name == "admin":
+        first_page = db.list_users_db(limit=PAGE_SIZE)
+        cursor = first_page[-1]['user_id'] if first_page else None
+        steps = []
+        for _ in range(args.admin_rounds):
+            steps.append(lambda: message_update(admin_id, "/listusers"))
+            if cursor is not None:
+                steps.append(lambda: callback_update(admin_id, f"{CALLBACK_ADMIN_USERS_PAGE}n_{cursor}"))
+            steps.append(lambda: callback_update(admin_id, CALLBACK_ADMIN_LIST_USERS))
+            steps.append(lambda: message_update(admin_id, "/dbinfo"))
+            steps.append(lambda: message_update(admin_id, "/perf"))
+        return [steps] # Un único chat: los updates del admin se procesan en orden
+    raise ValueError(f"Escenario desconocido: {name}")
+
+async def run_scenario(application, api: FakeBotAPI, name: str, scripts: list, errors: Counter) -> dict:
+    """Ejecuta los guiones en paralelo (cada uno en orden) y devuelve las métricas del escenario."""
+    latencies = []
+    errors_before = errors[name]
+    api.take_calls()
+
+    async def run_script(steps):
+        for build in steps:
+            update = Update.de_json(build(), application.bot)
+            start = time.perf_counter()
+            # Mismo camino que los updates de polling/webhook: procesador concurrente -> handlers
+            await application.update_processor.process_update(update, application.process_update(update))
+            latencies.append(time.perf_counter() - start)
+
+    errors['current'] = name
+    start = time.perf_counter()
+    await asyncio.gather(*(run_script(steps) for steps in scripts))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else 0.0
+    return {
+        'users': len(scripts),
+        'updates': len(latencies),
+        'seconds': round(elapsed, 3),
+        'updates_per_sec': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'latency_p50_ms': percentile(0.50),
+        'latency_p95_ms': percentile(0.95),
+        'latency_p99_ms': percentile(0.99),
+        'latency_max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        'handler_errors': errors[name] - errors_before,
+        'api_calls': dict(sorted(api.take_calls().items())),
+    }
+
+# --- Preparación ---
+def seed_users(user_ids: list, accounts_per_user: int) -> None:
+    import database as db
+    now = int(time.time())
+    for user_id in user_ids:
+        db.add_user_db(user_id, f"Carga {user_id % 100000}", "N/A", now, now + 365 * 86400)
+        for i in range(accounts_per_user):
+            db.add_account_db(
+                user_id, ("Netflix", "Disney Plus", "Crunchyroll", "YouTube Premium")[i % 4], f"base{user_id}.{i}@correo-ejemplo.com",
+                [{'name': f"Perfil {p}", 'pin': f"{p}{p}{p}{p}"} for p in (1, 2)], now, now + 180 * 86400,
+            )
+
+async def run(args) -> dict:
+    import bot
+    import database as db
+    from metrics import bot_metrics
+    from utils import ADMIN_USER_ID
+
+    logging.getLogger().setLevel(args.log_level) # bot.py configura DEBUG al importarse
+    db.DATABASE_FILE = os.path.join(args.workdir, "load_test.db")
+    db.init_db()
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    seed_users(user_ids, args.accounts_per_user)
+
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms)
+    application = bot.build_application("123456:LOADTEST", request=api, rate_limited=args.rate_limit)
+    errors = Counter()
+
+    async def count_error(update, context):
+        errors[errors['current']] += 1
+        if errors[errors['current']] <= 3:
+            logging.getLogger(__name__).error(f"Error en un handler durante '{errors['current']}': {context.error!r}")
+    application.add_error_handler(count_error)
+
+    results = {}
+    await application.initialize()
+    await application.start()
+    try:
+        for name in args.scenarios:
+            scripts = build_scripts(name, user_ids, ADMIN_USER_ID, api, args)
+            results[name] = await run_scenario(application, api, name, scripts, errors)
+            print_result(name, results[name])
+        print_metrics(bot_metrics.get_summary())
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+    return results
+
+def print_result(name: str, stats: dict) -> None:
+    calls = ", ".join(f"{endpoint}={count}" for endpoint, count in stats['api_calls'].items())
+    print(
+        f"[{name}] {stats['updates']} updates de {stats['users']} usuarios en {stats['seconds']}s -> "
+        f"{stats['updates_per_sec']} updates/s | latencia (cola + handler) p50 {stats['latency_p50_ms']} ms, p95 {stats['latency_p95_ms']} ms, "
+        f"p99 {stats['latency_p99_ms']} ms, máx. {stats['latency_max_ms']} ms | errores {stats['handler_errors']}\n"
+        f"    llamadas: {calls}"
+    )
+
+def print_metrics(summary: dict) -> None:
+    if not summary['enabled']:
+        return
+    print(f"Tiempo en handlers: BD {summary['db_seconds']}s, Bot API {summary['api_seconds']}s. Handlers más lentos (p95):")
+    for name, stats in summary['handlers']:
+        print(f"    {name:<48} {stats['count']:>6}x  p50 {stats['p50_ms']:>7} ms  p95 {stats['p95_ms']:>7} ms  total {stats['total_s']}s")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Prueba de carga de los handlers con una Bot API simulada.")
+    parser.add_argument('--users', type=int, default=200, help="Usuarios sintéticos autorizados (uno por chat).")
+    parser.add_argument('--accounts-per-user', type=int, default=3, help="Cuentas (con 2 perfiles) de cada usuario al empezar.")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--admin-rounds', type=int, default=50, help="Repeticiones del guion del admin.")
+    parser.add_argument('--admin-id', type=int, default=1, help="ADMIN_USER_ID a usar durante la prueba.")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Latencia simulada de cada llamada a la API.")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="Variación aleatoria (±) de la latencia.")
+    parser.add_argument('--rate-limit', action='store_true', help="Incluir el limitador de envíos (límites reales de Telegram).")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', default=None, help="Guardar los resultados en este JSON.")
+    args = parser.parse_args()
+
+    # Debe fijarse antes de importar los módulos del bot (leen ADMIN_USER_ID al importarse)
+    os.environ['ADMIN_USER_ID'] = str(args.admin_id)
+    with tempfile.TemporaryDirectory(prefix="load_test_") as workdir:
+        args.workdir = workdir
+        results = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'timestamp': int(time.time()), 'config': {k: v for k, v in vars(args).items() if k != 'workdir'}, 'results': results}, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.output}")
+    return 1 if any(stats['handler_errors'] for stats in results.values()) else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,108 @@
+"""
+Micro-benchmark del escapado de Markdown: compara markdown_escape.escape_markdown con la
+implementación anterior (concatenación carácter a carácter) y comprueba que la salida es idéntica.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/markdown_escape_bench.py
+    python benchmarks/markdown_escape_bench.py --profiles 2000 --repeat 5
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown_escape # noqa: E402
+
+SERVICES = ["Netflix", "HBO Max", "Spotify", "Disney Plus", "Paramount Plus", "Prime Video", "YouTube Premium", "Crunchyroll", "Otro"]
+
+def legacy_escape_markdown(text: str) -> str:
+    """Implementación anterior de database.escape_markdown (cuadrática en textos largos)."""
+    if not isinstance(text, str):
+        text = str(text)
+    escape_chars = r'_*[]()~`>#+-=|{}.!'
+    escaped_text = ""
+    for i, char in enumerate(text):
+        if char in escape_chars and (i == 0 or text[i-1] != '\\'):
+            escaped_text += '\\' + char
+        else:
+            escaped_text += char
+    return escaped_text
+
+# --- Datos de Prueba ---
+def build_profiles(count: int, seed: int = 1) -> list:
+    rng = random.Random(seed)
+    return [
+        {
+            'profile_id': i,
+            'service': rng.choice(SERVICES),
+            'profile_name': f"Perfil_{rng.randint(1, 5)}",
+            'email': f"usuario.{rng.randint(1, count)}@correo-ejemplo.com",
+            'pin': f"{rng.randint(0, 9999):04d}",
+        }
+        for i in range(count)
+    ]
+
+def render_get(profiles: list, escape) -> str:
+    """Misma forma que el listado de /get: cuatro campos escapados por perfil."""
+    lines = []
+    for profile in profiles:
+        lines.append(
+            f"*{escape(profile['service'])}* (👤 {escape(profile['profile_name'])})\n"
+            f"  📧 Email Cuenta: `{escape(profile['email'])}`\n"
+            f"  🔑 PIN: `{escape(profile['pin'])}`\n"
+        )
+    return "".join(lines)
+
+def random_text(length: int, seed: int = 2) -> str:
+    """Texto adversario: más de un tercio de los caracteres son especiales o barras invertidas."""
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + " _*[]()~`>#+-=|{}.!\\"
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+def plain_text(profiles: list) -> str:
+    """Texto largo realista: los campos del listado sin escapar, uno tras otro."""
+    return " ".join(f"{p['service']} {p['profile_name']} {p['email']} {p['pin']}" for p in profiles)
+
+# --- Medición ---
+def best_of(stmt, repeat: int, number: int) -> float:
+    """Mejor tiempo por ejecución en milisegundos."""
+    return min(timeit.repeat(stmt, repeat=repeat, number=number)) / number * 1000
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compara el escapado de Markdown nuevo con el anterior.")
+    parser.add_argument('--profiles', type=int, default=500, help="Perfiles en el listado simulado de /get.")
+    parser.add_argument('--long-length', type=int, default=20000, help="Longitud del texto largo.")
+    parser.add_argument('--repeat', type=int, default=3, help="Repeticiones (se toma la mejor).")
+    args = parser.parse_args()
+
+    profiles = build_profiles(args.profiles)
+    long_text = random_text(args.long_length)
+    realistic_text = plain_text(profiles)
+
+    # La salida debe ser idéntica a la anterior (MarkdownV2, respetando lo ya escapado)
+    samples = [long_text, "", "a\\_b", "\\\\*", "usuario.1@correo.com", 1234] + [random_text(50, seed) for seed in range(200)]
+    for sample in samples:
+        assert markdown_escape.escape_markdown(sample) == legacy_escape_markdown(sample), repr(sample)
+    assert render_get(profiles, markdown_escape.escape_markdown) == render_get(profiles, legacy_escape_markdown)
+    assert markdown_escape.escape_markdown("a_b*c.d[e]", version=1) == "a\\_b\\*c.d\\[e]"
+
+    cases = [
+        ("token corto (servicio)", lambda f: f("Paramount Plus"), 20000),
+        (f"texto realista de {len(realistic_text)} caracteres", lambda f: f(realistic_text), 5),
+        (f"texto adversario de {args.long_length} caracteres", lambda f: f(long_text), 5),
+        (f"listado /get de {args.profiles} perfiles", lambda f: render_get(profiles, f), 3),
+    ]
+    print(f"{'Caso':<40}{'anterior (ms)':>15}{'nuevo (ms)':>14}{'x':>9}")
+    for name, run, number in cases:
+        old = best_of(lambda: run(legacy_escape_markdown), args.repeat, number)
+        new = best_of(lambda: run(markdown_escape.escape_markdown), args.repeat, number)
+        print(f"{name:<40}{old:>15.4f}{new:>14.4f}{old / new:>8.1f}x")
+    print(f"Caché LRU: {markdown_escape.cache_info()}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
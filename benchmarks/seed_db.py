@@ -0,0 +1,159 @@
+"""
+Generador de datos sintéticos para los benchmarks de database.py.
+
+Crea (o amplía) una base de datos con el esquema real del bot (database.init_db) y la llena con
+usuarios, cuentas y perfiles con una distribución de caducidades parecida a la de producción.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/seed_db.py                               # 50k usuarios, 200k cuentas, 1M perfiles
+    python benchmarks/seed_db.py --users 5000 --accounts 20000 --profiles 100000
+    python benchmarks/seed_db.py --db access_control.db --force  # ¡sobre la BD real del bot!
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db # noqa: E402
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_access_control.db")
+FIRST_USER_ID = 100000000
+DAY = 86400
+SERVICES = ["Netflix", "HBO Max", "Spotify", "Disney Plus", "Paramount Plus", "Prime Video", "YouTube Premium", "Crunchyroll", "Otro"]
+SERVICE_WEIGHTS = [30, 12, 15, 12, 5, 12, 8, 4, 2] # Netflix y Spotify dominan, como en uso real
+FIRST_NAMES = ["Ana", "Luis", "María", "José", "Carmen", "Juan", "Lucía", "Pedro", "Sofía", "Diego", "Elena", "Javier", "Laura", "Andrés", "Paula"]
+BATCH_SIZE = 50000
+
+# --- Distribuciones ---
+def user_expiry(rng: random.Random, now: int) -> int:
+    """80% de usuarios con acceso vigente (1-365 días), 20% caducados hace 1-180 días."""
+    if rng.random() < 0.8:
+        return now + rng.randint(1, 365) * DAY
+    return now - rng.randint(1, 180) * DAY
+
+def account_expiry(rng: random.Random, now: int) -> int:
+    """70% vigentes (hasta 1 año), 10% caducan en la próxima semana, 20% ya caducadas."""
+    r = rng.random()
+    if r < 0.7:
+        return now + int(rng.expovariate(1 / (60 * DAY))) % (365 * DAY) + DAY
+    if r < 0.8:
+        return now + rng.randint(1, 7 * DAY)
+    return now - rng.randint(1, 90 * DAY)
+
+def split_counts(rng: random.Random, total: int, buckets: int, max_per_bucket: int | None = None) -> list:
+    """Reparte 'total' elementos entre 'buckets' de forma aleatoria (y con un máximo por bucket si se indica)."""
+    counts = [0] * buckets
+    if buckets == 0:
+        return counts
+    if max_per_bucket is not None:
+        total = min(total, buckets * max_per_bucket)
+    base, extra = divmod(total, buckets)
+    for i in range(buckets):
+        counts[i] = base + (1 if i < extra else 0)
+    rng.shuffle(counts)
+    if max_per_bucket is None:
+        # Sesgo realista: unos pocos usuarios concentran muchas cuentas
+        for _ in range(buckets // 10):
+            a, b = rng.randrange(buckets), rng.randrange(buckets)
+            moved = counts[a] // 2
+            counts[a] -= moved
+            counts[b] += moved
+    return counts
+
+# --- Generación ---
+def seed(db_path: str, users: int, accounts: int, profiles: int, seed_value: int = 42) -> dict:
+    """Llena 'db_path' con datos sintéticos. Devuelve los totales insertados y el tiempo empleado."""
+    db.close_db()
+    db.DATABASE_FILE = db_path
+    db.init_db()
+    rng = random.Random(seed_value)
+    now = int(time.time())
+    start = time.perf_counter()
+
+    with db.get_connection() as conn:
+        max_account_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM streaming_accounts").fetchone()[0]
+        max_user_id = conn.execute("SELECT COALESCE(MAX(user_id), ?) FROM users", (FIRST_USER_ID - 1,)).fetchone()[0]
+        first_user_id = max(FIRST_USER_ID, max_user_id + 1)
+        user_ids = list(range(first_user_id, first_user_id + users))
+
+        user_rows = (
+            (user_id, f"{rng.choice(FIRST_NAMES)} {user_id % 100000}", "N/A", now - rng.randint(1, 720) * DAY, user_expiry(rng, now))
+            for user_id in user_ids
+        )
+        conn.executemany("INSERT INTO users (user_id, name, payment_method, registration_ts, expiry_ts) VALUES (?, ?, ?, ?, ?)", user_rows)
+
+        account_rows = []
+        account_ids = []
+        account_id = max_account_id
+        for user_id, count in zip(user_ids, split_counts(rng, accounts, len(user_ids))):
+            services = rng.choices(SERVICES, weights=SERVICE_WEIGHTS, k=count)
+            for i, service in enumerate(services):
+                account_id += 1
+                account_ids.append(account_id)
+                # El índice en el email garantiza UNIQUE(user_id, service, email)
+                account_rows.append((account_id, user_id, service, f"u{user_id}.{i}@correo-ejemplo.com", now - rng.randint(1, 365) * DAY, account_expiry(rng, now)))
+                if len(account_rows) >= BATCH_SIZE:
+                    conn.executemany("INSERT INTO streaming_accounts (id, user_id, service, email, registration_ts, expiry_ts) VALUES (?, ?, ?, ?, ?, ?)", account_rows)
+                    account_rows = []
+        if account_rows:
+            conn.executemany("INSERT INTO streaming_accounts (id, user_id, service, email, registration_ts, expiry_ts) VALUES (?, ?, ?, ?, ?, ?)", account_rows)
+
+        profile_rows = []
+        inserted_profiles = 0
+        for account_id, count in zip(account_ids, split_counts(rng, profiles, len(account_ids), db.MAX_PROFILES_PER_ACCOUNT)):
+            for n in range(1, count + 1):
+                profile_rows.append((account_id, f"Perfil {n}", f"{rng.randint(0, 9999):04d}"))
+            if len(profile_rows) >= BATCH_SIZE:
+                conn.executemany("INSERT INTO account_profiles (account_id, profile_name, pin) VALUES (?, ?, ?)", profile_rows)
+                inserted_profiles += len(profile_rows)
+                profile_rows = []
+        if profile_rows:
+            conn.executemany("INSERT INTO account_profiles (account_id, profile_name, pin) VALUES (?, ?, ?)", profile_rows)
+            inserted_profiles += len(profile_rows)
+        conn.commit()
+        conn.execute("ANALYZE;") # Estadísticas del planificador, como tras un PRAGMA optimize en producción
+        conn.commit()
+
+    db.invalidate_auth_cache()
+    return {
+        'users': users,
+        'accounts': len(account_ids),
+        'profiles': inserted_profiles,
+        'seconds': round(time.perf_counter() - start, 2),
+    }
+
+def table_counts() -> dict:
+    """Filas actuales de las tablas principales de la BD configurada en database.DATABASE_FILE."""
+    with db.get_connection() as conn:
+        return {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("users", "streaming_accounts", "account_profiles")
+        }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Llena una BD SQLite con datos sintéticos para los benchmarks.")
+    parser.add_argument('--db', default=DEFAULT_DB, help="Archivo de BD (por defecto benchmarks/bench_access_control.db).")
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--accounts', type=int, default=200000)
+    parser.add_argument('--profiles', type=int, default=1000000, help=f"Máximo {db.MAX_PROFILES_PER_ACCOUNT} por cuenta.")
+    parser.add_argument('--seed', type=int, default=42, help="Semilla del generador (misma semilla = mismos datos).")
+    parser.add_argument('--force', action='store_true', help="Permitir añadir datos a una BD que ya tiene usuarios.")
+    args = parser.parse_args()
+
+    if os.path.exists(args.db) and not args.force:
+        db.DATABASE_FILE = args.db
+        if table_counts()['users'] > 0:
+            print(f"❌ {args.db} ya contiene usuarios. Bórrala o usa --force para añadir más datos.")
+            return 1
+        db.close_db()
+    print(f"Generando {args.users} usuarios, {args.accounts} cuentas y {args.profiles} perfiles en {args.db}...")
+    result = seed(args.db, args.users, args.accounts, args.profiles, args.seed)
+    print(f"Listo en {result['seconds']}s: {table_counts()}")
+    db.close_db()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
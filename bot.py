@@ -2,12 +2,20 @@ import logging
 import os
 from dotenv import load_dotenv
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+from telegram.request import BaseRequest
 
 # Importar módulos locales de handlers
 import database as db
+import async_db as adb
 import user_handlers
 import admin_handlers
 import callback_handlers
+from utils import deletion_scheduler
+from rate_limiter import send_rate_limiter
+from update_processor import update_processor
+from webhook_server import run_application
+from persistence import sqlite_persistence
+from metrics import bot_metrics
 
 # Importar conversaciones específicas para claridad
 from user_handlers import (
@@ -31,27 +39,41 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-def main() -> None:
-    """Configura e inicia el bot."""
-
-    # Validar variables de entorno
-    if not TELEGRAM_BOT_TOKEN:
-        logger.critical("Error: No se encontró el TELEGRAM_BOT_TOKEN en las variables de entorno.")
-        return
-    if not ADMIN_USER_ID_STR or not ADMIN_USER_ID_STR.isdigit():
-         logger.critical("Error: No se encontró o es inválido el ADMIN_USER_ID en las variables de entorno.")
-         return
-    # ADMIN_USER_ID ya se carga en database.py y handlers.py
-
-    # Inicializar la base de datos
-    try:
-        db.init_db()
-    except Exception as e:
-        logger.critical(f"No se pudo inicializar la base de datos: {e}. Abortando.")
-        return
-
-    # Crear la Application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def db_maintenance_job(context) -> None:
+    """Job periódico: checkpoint del WAL y PRAGMA optimize."""
+    await adb.run_db_maintenance()
+
+async def post_init(application: Application) -> None:
+    """Abre el endpoint HTTP local de métricas (METRICS_PORT) al arrancar el bot."""
+    await bot_metrics.start_server()
+
+async def post_shutdown(application: Application) -> None:
+    """Guarda los borrados pendientes y libera el ejecutor y el pool de conexiones de la BD al detener el bot."""
+    await bot_metrics.stop_server()
+    await deletion_scheduler.save_pending()
+    adb.shutdown()
+
+def build_application(token: str, request: BaseRequest | None = None, rate_limited: bool = True) -> Application:
+    """
+    Crea la Application con todos los handlers registrados (sin jobs periódicos ni arranque).
+    'request' sustituye la capa HTTP de PTB (p. ej. la Bot API simulada de benchmarks/load_test.py)
+    y rate_limited=False omite el limitador de envíos.
+    """
+    # Las llamadas salientes pasan por el limitador de envíos y los updates de distintos
+    # chats/usuarios se procesan en paralelo (en orden dentro de cada chat)
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(update_processor)
+        .persistence(sqlite_persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if rate_limited:
+        builder = builder.rate_limiter(send_rate_limiter)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
 
     # --- Agrupar Handlers ---
 
@@ -62,7 +84,6 @@ def main() -> None:
         CommandHandler("list", user_handlers.list_accounts),
         CommandHandler("get", user_handlers.get_account),
         CommandHandler("backupmyaccounts", user_handlers.backup_my_accounts),
-        CommandHandler("importmyaccounts", user_handlers.import_my_accounts_start), # Entry point for conversation
     ]
 
     user_conversation_handlers = [
@@ -76,6 +97,10 @@ def main() -> None:
         CommandHandler("listusers", admin_handlers.list_users),
         # CommandHandler("listallaccounts", admin_handlers.list_all_accounts), # Eliminado o comentado
         CommandHandler("edituser", admin_handlers.edit_user_start), # Añadir comando para editar
+        CommandHandler("dbinfo", admin_handlers.db_info),
+        CommandHandler("perf", admin_handlers.perf_command),
+        CommandHandler("slowqueries", admin_handlers.slow_queries_command),
+        CommandHandler("indexadvisor", admin_handlers.index_advisor_command),
     ]
 
     admin_conversation_handlers = [
@@ -94,9 +119,52 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(callback_handlers.button_callback_handler))
     application.add_handler(MessageHandler(filters.COMMAND, user_handlers.unknown)) # Maneja comandos no reconocidos
 
+    # Métricas por handler (también dentro de las conversaciones) y por ruta del router de botones
+    bot_metrics.instrument_application(application)
+    if bot_metrics.enabled:
+        callback_handlers.wrap_callback_routes(bot_metrics.time_callback_route)
+
+    return application
+
+def main() -> None:
+    """Configura e inicia el bot."""
+
+    # Validar variables de entorno
+    if not TELEGRAM_BOT_TOKEN:
+        logger.critical("Error: No se encontró el TELEGRAM_BOT_TOKEN en las variables de entorno.")
+        return
+    if not ADMIN_USER_ID_STR or not ADMIN_USER_ID_STR.isdigit():
+         logger.critical("Error: No se encontró o es inválido el ADMIN_USER_ID en las variables de entorno.")
+         return
+    # ADMIN_USER_ID ya se carga en database.py y handlers.py
+
+    # Inicializar la base de datos
+    try:
+        db.init_db()
+    except Exception as e:
+        logger.critical(f"No se pudo inicializar la base de datos: {e}. Abortando.")
+        return
+
+    application = build_application(TELEGRAM_BOT_TOKEN)
+
+    # Mantenimiento periódico de la BD (wal_checkpoint + optimize)
+    if db.DB_MAINTENANCE_INTERVAL_SECONDS > 0:
+        application.job_queue.run_repeating(
+            db_maintenance_job,
+            interval=db.DB_MAINTENANCE_INTERVAL_SECONDS,
+            first=db.DB_MAINTENANCE_INTERVAL_SECONDS,
+            name="db_maintenance"
+        )
+
+    # Borrado automático de mensajes: un único job que vacía la cola por lotes (persistida en la BD)
+    deletion_scheduler.start(application.job_queue)
+
+    # Caducidad de conversaciones y user_data persistidos (libera memoria de usuarios inactivos)
+    sqlite_persistence.start(application.job_queue)
+
     # Iniciar el Bot
     logger.info("Iniciando el bot...")
-    application.run_polling()
+    run_application(application) # Polling o webhook según BOT_RUN_MODE
     logger.info("Bot detenido.")
 
 if __name__ == "__main__":
@@ -8,25 +8,124 @@ from telegram.error import BadRequest
 import user_handlers
 import admin_handlers
 from utils import ADMIN_USER_ID, get_back_to_menu_keyboard
-import database as db
+import async_db as adb # Acceso a BD sin bloquear el event loop
 
 # Importar constantes de callback data
 from user_handlers import (
     CALLBACK_ADD_MY_ACCOUNT, CALLBACK_DELETE_MY_ACCOUNT, CALLBACK_EDIT_MY_ACCOUNT,
-    CALLBACK_BACKUP_MY_ACCOUNTS, CALLBACK_IMPORT_MY_ACCOUNTS
+    CALLBACK_BACKUP_MY_ACCOUNTS, CALLBACK_BACKUP_MY_ACCOUNTS_JSONL, CALLBACK_IMPORT_MY_ACCOUNTS,
+    CALLBACK_ACCOUNTS_PAGE
 )
 # Importar constantes de admin
 from admin_handlers import (
     CALLBACK_ADMIN_ADD_USER_PROMPT,
     CALLBACK_ADMIN_LIST_USERS,
     CALLBACK_ADMIN_EDIT_USER_PROMPT,
-    CALLBACK_ADMIN_DELETE_USER_START
+    CALLBACK_ADMIN_DELETE_USER_START,
+    CALLBACK_ADMIN_USERS_PAGE
 )
 
 logger = logging.getLogger(__name__)
 
+# --- Registro de Callbacks ---
+# Roles requeridos por cada ruta. Solo 'authorized' y 'user' consultan la autorización (caché/BD).
+ROLE_ANY = "any"                # Cualquiera; el handler hace sus propias comprobaciones si las necesita
+ROLE_AUTHORIZED = "authorized"  # Usuario autorizado o admin
+ROLE_USER = "user"              # Usuario autorizado que no es admin
+ROLE_ADMIN = "admin"            # Solo el admin
+
+_DENIED_TEXT = {
+    ROLE_AUTHORIZED: "⛔ Acceso denegado.",
+    ROLE_USER: "⛔ Función no disponible.",
+    ROLE_ADMIN: "⛔ Acceso denegado.",
+}
+
+# callback_data exacto -> (handler, rol, texto de error)
+_EXACT_ROUTES = {}
+# Prefijo ('delacc_', 'deluser_', ...) -> (handler, rol, texto de error)
+_PREFIX_ROUTES = {}
+
+def _prefix_of(callback_data: str) -> str:
+    """Prefijo de un callback_data: el texto hasta el primer '_' incluido."""
+    head, sep, _ = callback_data.partition('_')
+    return head + sep
+
+def register_callback(key: str, handler, role: str = ROLE_ANY, prefix: bool = False, error_text: str | None = None) -> None:
+    """
+    Registra el handler de un botón inline.
+    Con prefix=True, 'key' debe ser un prefijo de la forma 'palabra_' y la ruta atiende
+    todos los callback_data que empiecen por él. Si se indica 'error_text', los errores del
+    handler se notifican con ese mensaje en lugar del genérico.
+    """
+    if role not in (ROLE_ANY, ROLE_AUTHORIZED, ROLE_USER, ROLE_ADMIN):
+        raise ValueError(f"Rol de callback desconocido: {role}")
+    if prefix and _prefix_of(key) != key:
+        raise ValueError(f"Prefijo de callback inválido: '{key}' (debe tener la forma 'palabra_')")
+    (_PREFIX_ROUTES if prefix else _EXACT_ROUTES)[key] = (handler, role, error_text)
+
+def resolve_callback(callback_data: str):
+    """Busca la ruta de un callback_data: primero coincidencia exacta y luego por prefijo (O(1))."""
+    route = _EXACT_ROUTES.get(callback_data)
+    if route is None:
+        route = _PREFIX_ROUTES.get(_prefix_of(callback_data))
+    return route
+
+def wrap_callback_routes(wrapper) -> None:
+    """Sustituye el handler de cada ruta registrada por wrapper(handler, clave) (p. ej. para medirlo por ruta)."""
+    for routes in (_EXACT_ROUTES, _PREFIX_ROUTES):
+        for key, (handler, role, error_text) in routes.items():
+            routes[key] = (wrapper(handler, key), role, error_text)
+
+async def _has_role(role: str, user_id: int) -> bool:
+    """Comprueba el rol requerido; la autorización solo se consulta si la ruta la necesita."""
+    if role == ROLE_ANY:
+        return True
+    is_admin_user = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
+    if role == ROLE_ADMIN:
+        return is_admin_user
+    if role == ROLE_AUTHORIZED:
+        return is_admin_user or await adb.is_user_authorized(user_id)
+    # ROLE_USER
+    return not is_admin_user and await adb.is_user_authorized(user_id)
+
+# --- Handlers de Callbacks Propios ---
+async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Reconstruye y muestra el menú principal."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    is_admin_user = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
+    is_authorized_user = await adb.is_user_authorized(user_id)
+
+    user_name = query.from_user.first_name
+    welcome_message = f"¡Hola, {user_name}! 👋\n\nBienvenido al Gestor de Cuentas."
+    if is_authorized_user or is_admin_user:
+         welcome_message += "\nPuedes usar los botones de abajo 👇 o escribir /help para ver los comandos."
+    else:
+        welcome_message += "\n⛔ Parece que no tienes acceso autorizado. Contacta al administrador."
+    keyboard = user_handlers.get_main_menu_keyboard(is_admin_user, is_authorized_user)
+    try:
+        await query.edit_message_text(
+            text=welcome_message,
+            reply_markup=keyboard
+        )
+        logger.info(f"User {user_id} returned to main menu via button.")
+    except BadRequest as e:
+        if "message is not modified" in str(e).lower():
+            pass # Ignorar si el menú ya está mostrado
+        else:
+            logger.error(f"Error editing message for back_to_menu callback: {e}")
+
+async def expired_conversation_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Botón de un paso de conversación que ya no está activa (cancelada, terminada o reiniciada).
+    Los ConversationHandler atienden estos botones mientras la conversación sigue viva.
+    """
+    query = update.callback_query
+    logger.info(f"Botón caducado '{query.data}' pulsado por user {query.from_user.id}.")
+    await query.edit_message_text("⌛ Esta operación ya no está activa. Vuelve a empezar desde el menú.", reply_markup=get_back_to_menu_keyboard())
+
 async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Maneja las pulsaciones de los botones inline."""
+    """Maneja las pulsaciones de los botones inline mediante el registro de callbacks."""
     query = update.callback_query
     if not query or not query.data:
         logger.warning("Callback sin query o sin data recibido.")
@@ -38,117 +137,26 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
     callback_data = query.data
     logger.info(f"Callback recibido: '{callback_data}' de user_id: {user_id}")
 
-    is_admin_user = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
-    # La autorización general se verifica dentro de cada handler si es necesario
-    is_authorized_user = db.is_user_authorized(user_id)
-
     try:
-        # --- Callback Común ---
-        if callback_data == 'show_status':
-            await user_handlers.status_command(update, context)
-        elif callback_data == 'list_accounts':
-             if is_authorized_user or is_admin_user: # Permitir al admin ver su propia lista si tuviera
-                 await user_handlers.list_accounts(update, context)
-             else:
-                 await query.edit_message_text("⛔ Acceso denegado.", reply_markup=get_back_to_menu_keyboard())
-
-        # --- Callbacks de Usuario (No Admin) ---
-        elif callback_data == CALLBACK_ADD_MY_ACCOUNT:
-            if is_authorized_user and not is_admin_user:
-                await user_handlers.add_my_account_start(update, context)
-            else:
-                 await query.edit_message_text("⛔ Función no disponible.", reply_markup=get_back_to_menu_keyboard())
-        elif callback_data == CALLBACK_EDIT_MY_ACCOUNT:
-             if is_authorized_user and not is_admin_user:
-                 await user_handlers.edit_my_account_start(update, context)
-             else:
-                 await query.edit_message_text("⛔ Función no disponible.", reply_markup=get_back_to_menu_keyboard())
-        elif callback_data == CALLBACK_DELETE_MY_ACCOUNT:
-             if is_authorized_user and not is_admin_user:
-                 await user_handlers.delete_my_account_start(update, context)
-             else:
-                 await query.edit_message_text("⛔ Función no disponible.", reply_markup=get_back_to_menu_keyboard())
-        elif callback_data == CALLBACK_BACKUP_MY_ACCOUNTS:
-             if is_authorized_user and not is_admin_user:
-                 await user_handlers.backup_my_accounts(update, context)
-             else:
-                 await query.edit_message_text("⛔ Función no disponible.", reply_markup=get_back_to_menu_keyboard())
-        elif callback_data == CALLBACK_IMPORT_MY_ACCOUNTS:
-            if is_authorized_user and not is_admin_user:
-                await user_handlers.import_my_accounts_start(update, context)
-            else:
-                 await query.edit_message_text("⛔ Función no disponible.", reply_markup=get_back_to_menu_keyboard())
-
-        # --- Callbacks de Admin ---
-        elif callback_data == CALLBACK_ADMIN_LIST_USERS:
-            if is_admin_user:
-                try:
-                    await admin_handlers.list_users(update, context)
-                except Exception as e_admin:
-                    logger.error(f"Error en admin_handlers.list_users (callback): {e_admin}", exc_info=True)
-                    await query.edit_message_text("⚠️ Error al listar usuarios.", reply_markup=get_back_to_menu_keyboard())
-            else: await query.edit_message_text("⛔ Acceso denegado.", reply_markup=get_back_to_menu_keyboard())
-        elif callback_data == CALLBACK_ADMIN_ADD_USER_PROMPT:
-            if is_admin_user:
-                try:
-                    await admin_handlers.add_user_start(update, context) # Inicia conversación adduser
-                except Exception as e_admin:
-                    logger.error(f"Error en admin_handlers.add_user_start (callback): {e_admin}", exc_info=True)
-                    await query.edit_message_text("⚠️ Error al iniciar proceso de añadir usuario.", reply_markup=get_back_to_menu_keyboard())
-            else: await query.edit_message_text("⛔ Acceso denegado.", reply_markup=get_back_to_menu_keyboard())
-        elif callback_data == CALLBACK_ADMIN_EDIT_USER_PROMPT: # Editar Usuario
-            if is_admin_user:
-                try:
-                    await admin_handlers.edit_user_start(update, context) # Inicia conversación edituser
-                except Exception as e_admin:
-                    logger.error(f"Error en admin_handlers.edit_user_start (callback): {e_admin}", exc_info=True)
-                    await query.edit_message_text("⚠️ Error al iniciar proceso de editar usuario.", reply_markup=get_back_to_menu_keyboard())
-            else: await query.edit_message_text("⛔ Acceso denegado.", reply_markup=get_back_to_menu_keyboard())
-        elif callback_data == CALLBACK_ADMIN_DELETE_USER_START: # Eliminar Usuario
-            if is_admin_user:
-                try:
-                    await admin_handlers.delete_user_start(update, context) # Inicia conversación deleteuser
-                except Exception as e_admin:
-                    logger.error(f"Error en admin_handlers.delete_user_start (callback): {e_admin}", exc_info=True)
-                    await query.edit_message_text("⚠️ Error al iniciar proceso de eliminar usuario.", reply_markup=get_back_to_menu_keyboard())
-            else: await query.edit_message_text("⛔ Acceso denegado.", reply_markup=get_back_to_menu_keyboard())
-
-        # --- Volver al Menú ---
-        elif callback_data == 'back_to_menu': # Usar la constante importada
-            # await query.answer() # Ya se hizo al inicio
-            # Reconstruir y mostrar el menú principal
-            user_name = query.from_user.first_name
-            welcome_message = f"¡Hola, {user_name}! 👋\n\nBienvenido al Gestor de Cuentas."
-            if is_authorized_user or is_admin_user:
-                 welcome_message += "\nPuedes usar los botones de abajo 👇 o escribir /help para ver los comandos."
-            else:
-                welcome_message += "\n⛔ Parece que no tienes acceso autorizado. Contacta al administrador."
-            keyboard = user_handlers.get_main_menu_keyboard(is_admin_user, is_authorized_user)
-            try:
-                await query.edit_message_text(
-                    text=welcome_message,
-                    reply_markup=keyboard
-                )
-                logger.info(f"User {user_id} returned to main menu via button.")
-            except BadRequest as e:
-                if "message is not modified" in str(e).lower():
-                    pass # Ignorar si el menú ya está mostrado
-                else:
-                    logger.error(f"Error editing message for back_to_menu callback: {e}")
-                    # Podríamos intentar enviar un nuevo mensaje si la edición falla persistentemente
-                    # await context.bot.send_message(chat_id=user_id, text=welcome_message, reply_markup=keyboard)
+        route = resolve_callback(callback_data)
+        if route is None:
+            # Acción desconocida o ya procesada: el query.answer() ya se envió
+            logger.warning(f"Callback '{callback_data}' no manejado explícitamente por button_callback_handler.")
+            return
+
+        handler, role, error_text = route
+        if not await _has_role(role, user_id):
+            await query.edit_message_text(_DENIED_TEXT[role], reply_markup=get_back_to_menu_keyboard())
+            return
 
+        if error_text is None:
+            await handler(update, context)
         else:
-            # Si el callback no coincide con ninguno conocido Y NO es un callback de conversación
-            # (los callbacks de conversación son manejados por ConversationHandler)
-            # Podríamos asumir que es una acción ya procesada o desconocida.
-            # Es difícil saber con certeza si un callback pertenece a una conversación activa
-            # sin consultar context.user_data o context.chat_data, lo cual puede ser complejo aquí.
-            # Por seguridad, mantenemos el mensaje genérico si no se maneja explícitamente.
-            logger.warning(f"Callback '{callback_data}' no manejado explícitamente por button_callback_handler.")
-            # Evitar editar si ya se respondió con error antes
-            # await query.edit_message_text(text="Acción no reconocida o ya procesada.", reply_markup=get_back_to_menu_keyboard())
-            # Simplemente no hacer nada si ya se respondió con answer()
+            try:
+                await handler(update, context)
+            except Exception as e_route:
+                logger.error(f"Error en {handler.__module__}.{handler.__name__} (callback): {e_route}", exc_info=True)
+                await query.edit_message_text(error_text, reply_markup=get_back_to_menu_keyboard())
 
     except BadRequest as e:
          # Capturar errores comunes de Telegram al intentar editar/responder
@@ -184,3 +192,28 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
             except Exception as send_error:
                 logger.error(f"Error enviando mensaje de error de callback a {user_id}: {send_error}")
 
+# --- Rutas Registradas ---
+# Comunes
+register_callback('show_status', user_handlers.status_command)
+register_callback('list_accounts', user_handlers.list_accounts, ROLE_AUTHORIZED)
+register_callback(CALLBACK_ACCOUNTS_PAGE, user_handlers.list_accounts, ROLE_AUTHORIZED, prefix=True)
+register_callback('back_to_menu', back_to_menu)
+
+# Usuario (no admin)
+register_callback(CALLBACK_ADD_MY_ACCOUNT, user_handlers.add_my_account_start, ROLE_USER)
+register_callback(CALLBACK_EDIT_MY_ACCOUNT, user_handlers.edit_my_account_start, ROLE_USER)
+register_callback(CALLBACK_DELETE_MY_ACCOUNT, user_handlers.delete_my_account_start, ROLE_USER)
+register_callback(CALLBACK_BACKUP_MY_ACCOUNTS, user_handlers.backup_my_accounts, ROLE_USER)
+register_callback(CALLBACK_BACKUP_MY_ACCOUNTS_JSONL, user_handlers.backup_my_accounts, ROLE_USER)
+register_callback(CALLBACK_IMPORT_MY_ACCOUNTS, user_handlers.import_my_accounts_start, ROLE_USER)
+
+# Admin
+register_callback(CALLBACK_ADMIN_LIST_USERS, admin_handlers.list_users, ROLE_ADMIN, error_text="⚠️ Error al listar usuarios.")
+register_callback(CALLBACK_ADMIN_USERS_PAGE, admin_handlers.list_users, ROLE_ADMIN, prefix=True, error_text="⚠️ Error al listar usuarios.")
+register_callback(CALLBACK_ADMIN_ADD_USER_PROMPT, admin_handlers.add_user_start, ROLE_ADMIN, error_text="⚠️ Error al iniciar proceso de añadir usuario.")
+register_callback(CALLBACK_ADMIN_EDIT_USER_PROMPT, admin_handlers.edit_user_start, ROLE_ADMIN, error_text="⚠️ Error al iniciar proceso de editar usuario.")
+register_callback(CALLBACK_ADMIN_DELETE_USER_START, admin_handlers.delete_user_start, ROLE_ADMIN, error_text="⚠️ Error al iniciar proceso de eliminar usuario.")
+
+# Pasos de conversación: solo llegan aquí si la conversación ya no está activa
+for _conversation_prefix in ('service_', 'delacc_', 'delete_', 'editprof_', 'editfield_', 'import_', 'deluser_', 'deleteuser_', 'edituser_', 'upick_'):
+    register_callback(_conversation_prefix, expired_conversation_button, prefix=True)
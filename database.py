@@ -2,6 +2,10 @@ import sqlite3
 import time
 import logging
 import re
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 import os
@@ -14,152 +18,571 @@ ADMIN_USER_ID = int(ADMIN_USER_ID_STR) if ADMIN_USER_ID_STR and ADMIN_USER_ID_ST
 DATABASE_FILE = 'access_control.db'
 logger = logging.getLogger(__name__)
 
+from query_log import connection_factory, full_scans, normalize_sql # Después de load_dotenv: lee DB_SLOW_QUERY_MS y DB_QUERY_STATS_ENABLED
+
+# --- Configuración del Pool de Conexiones ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4")) # Conexiones persistentes máximas
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")) # Espera ante 'database is locked'
+DB_CACHED_STATEMENTS = 256 # Sentencias preparadas cacheadas por conexión
+DB_POOL_ACQUIRE_TIMEOUT = 30 # Segundos máximos esperando una conexión libre
+
+# --- Perfiles de Rendimiento de SQLite ---
+# Cada perfil define los PRAGMA que se aplican a cada conexión al abrirla.
+DB_PROFILES = {
+    # Máxima durabilidad: cada commit hace fsync del WAL
+    'safe': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -2000, # KiB (negativo) -> ~2 MB
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+    },
+    # Lectores y escritores concurrentes sin fsync por commit (seguro ante caídas del proceso)
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000, # ~16 MB por conexión
+        'mmap_size': 268435456, # 256 MB
+        'temp_store': 'MEMORY',
+    },
+}
+DB_PROFILE = os.getenv("DB_PROFILE", "performance")
+DB_MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("DB_MAINTENANCE_INTERVAL_SECONDS", "3600")) # wal_checkpoint + optimize
+
+_VALID_PRAGMA_VALUES = {
+    'journal_mode': {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'},
+    'synchronous': {'OFF', 'NORMAL', 'FULL', 'EXTRA'},
+    'temp_store': {'DEFAULT', 'FILE', 'MEMORY'},
+}
+
+# --- Configuración de la Caché de Autorización ---
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "300")) # Vigencia de cada entrada
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000")) # Usuarios cacheados como máximo
+
 # --- Funciones de Utilidad ---
-def escape_markdown(text: str) -> str:
-    """Escapa caracteres especiales para MarkdownV2."""
-    if not isinstance(text, str):
-        text = str(text) # Asegurarse que es string
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    # No escapar caracteres ya escapados
-    # Simple check: if the char before is already a backslash, skip
-    escaped_text = ""
-    for i, char in enumerate(text):
-        if char in escape_chars and (i == 0 or text[i-1] != '\\'):
-            escaped_text += '\\' + char
+import markdown_escape
+
+# Re-exportado a propósito: los handlers siguen usando db.escape_markdown (escapado lineal con caché)
+escape_markdown = markdown_escape.escape_markdown
+
+# --- Perfil de Rendimiento ---
+def get_db_profile_settings() -> dict:
+    """
+    Devuelve los PRAGMA del perfil activo (DB_PROFILE), aplicando las variables de entorno
+    DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_CACHE_SIZE, DB_MMAP_SIZE y DB_TEMP_STORE si existen.
+    """
+    profile_name = DB_PROFILE if DB_PROFILE in DB_PROFILES else 'performance'
+    if profile_name != DB_PROFILE:
+        logger.warning(f"Perfil de BD '{DB_PROFILE}' desconocido. Usando 'performance'.")
+    settings = dict(DB_PROFILES[profile_name])
+
+    for key in ('journal_mode', 'synchronous', 'temp_store'):
+        value = os.getenv(f"DB_{key.upper()}")
+        if value is None:
+            continue
+        if value.upper() in _VALID_PRAGMA_VALUES[key]:
+            settings[key] = value.upper()
         else:
-            escaped_text += char
-    return escaped_text
+            logger.warning(f"Valor inválido para DB_{key.upper()}: '{value}'. Se mantiene '{settings[key]}'.")
+    for key in ('cache_size', 'mmap_size'):
+        value = os.getenv(f"DB_{key.upper()}")
+        if value is None:
+            continue
+        try:
+            settings[key] = int(value)
+        except ValueError:
+            logger.warning(f"Valor inválido para DB_{key.upper()}: '{value}'. Se mantiene '{settings[key]}'.")
+    return settings
+
+def _apply_db_profile(conn: sqlite3.Connection) -> None:
+    """Aplica los PRAGMA del perfil activo a una conexión recién abierta."""
+    settings = get_db_profile_settings()
+    # journal_mode es persistente en el archivo; el resto son por conexión
+    conn.execute(f"PRAGMA journal_mode = {settings['journal_mode']};")
+    conn.execute(f"PRAGMA synchronous = {settings['synchronous']};")
+    conn.execute(f"PRAGMA cache_size = {int(settings['cache_size'])};")
+    conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])};")
+    conn.execute(f"PRAGMA temp_store = {settings['temp_store']};")
+
+# --- Pool de Conexiones ---
+class ConnectionPool:
+    """
+    Pool acotado de conexiones SQLite de larga duración.
+    Cada conexión se configura una sola vez al abrirse (claves foráneas, perfil de
+    rendimiento, busy_timeout, caché de sentencias) y se reutiliza entre llamadas.
+    """
+
+    def __init__(self, database: str, size: int):
+        self.database = database
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _open(self) -> sqlite3.Connection:
+        """Abre y configura una nueva conexión."""
+        conn = sqlite3.connect(
+            self.database,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=DB_CACHED_STATEMENTS,
+            check_same_thread=False, # El pool garantiza un único usuario por conexión
+            factory=connection_factory() # Mide cada sentencia y registra las lentas (query_log.py)
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS};")
+        _apply_db_profile(conn)
+        logger.debug(f"Nueva conexión SQLite abierta ({self._created}/{self.size}) para {self.database}.")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Obtiene una conexión libre, abriendo una nueva si no se alcanzó el límite."""
+        if self._closed:
+            raise sqlite3.ProgrammingError("El pool de conexiones está cerrado.")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._open()
+                except sqlite3.Error:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Tiempo de espera agotado esperando una conexión del pool.")
+
+    def release(self, conn: sqlite3.Connection, discard: bool = False) -> None:
+        """Devuelve una conexión al pool (o la descarta si quedó en mal estado)."""
+        if not discard and not self._closed:
+            try:
+                if conn.in_transaction:
+                    conn.rollback() # No dejar transacciones abiertas entre usuarios del pool
+                self._idle.put(conn)
+                return
+            except sqlite3.Error as e:
+                logger.warning(f"Descartando conexión SQLite defectuosa: {e}")
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close_all(self) -> None:
+        """Cierra todas las conexiones libres y marca el pool como cerrado."""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.execute("PRAGMA optimize;") # Recomendado por SQLite antes de cerrar
+            except sqlite3.Error:
+                pass
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            with self._lock:
+                self._created -= 1
+        logger.info("Pool de conexiones SQLite cerrado.")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> ConnectionPool:
+    """Crea el pool en el primer uso (permite cambiar DATABASE_FILE antes de usarlo)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_FILE, DB_POOL_SIZE)
+    return _pool
+
+@contextmanager
+def get_connection():
+    """Presta una conexión del pool durante el bloque 'with'."""
+    pool = _get_pool()
+    conn = pool.acquire()
+    discard = False
+    try:
+        yield conn
+    except sqlite3.Error as e:
+        # Errores de consulta no invalidan la conexión; corrupción o fallos internos sí
+        discard = not isinstance(e, (sqlite3.IntegrityError, sqlite3.OperationalError, sqlite3.ProgrammingError))
+        raise
+    finally:
+        pool.release(conn, discard=discard)
+
+def close_db() -> None:
+    """Cierra el pool de conexiones (llamar al detener el bot)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+
+# --- Caché de Autorización ---
+# user_id -> (expiry_ts o None si no está registrado, instante en que caduca la entrada)
+_auth_cache = OrderedDict()
+_auth_cache_lock = threading.Lock()
+_auth_cache_generation = 0 # Se incrementa en cada invalidación para descartar lecturas obsoletas
+_auth_cache_hits = 0
+_auth_cache_misses = 0
+
+def get_cached_authorization(user_id: int) -> bool | None:
+    """
+    Responde desde memoria si el usuario está autorizado comparando su expiry_ts
+    cacheado con la hora actual. Devuelve None si no hay entrada vigente.
+    """
+    global _auth_cache_hits, _auth_cache_misses
+    now = time.time()
+    with _auth_cache_lock:
+        entry = _auth_cache.get(user_id)
+        if entry is None or entry[1] < now:
+            _auth_cache_misses += 1
+            return None
+        _auth_cache.move_to_end(user_id)
+        _auth_cache_hits += 1
+    expiry_ts = entry[0]
+    return expiry_ts is not None and now <= expiry_ts
+
+def _store_auth_cache(user_id: int, expiry_ts: int | None, generation: int) -> None:
+    """Guarda la expiración leída de la BD salvo que haya habido una invalidación entretanto."""
+    with _auth_cache_lock:
+        if generation != _auth_cache_generation:
+            return
+        _auth_cache[user_id] = (expiry_ts, time.time() + AUTH_CACHE_TTL_SECONDS)
+        _auth_cache.move_to_end(user_id)
+        while len(_auth_cache) > AUTH_CACHE_MAX_ENTRIES:
+            _auth_cache.popitem(last=False)
+
+def invalidate_auth_cache(user_id: int | None = None) -> None:
+    """Invalida la entrada de un usuario (o toda la caché si user_id es None)."""
+    global _auth_cache_generation
+    with _auth_cache_lock:
+        _auth_cache_generation += 1
+        if user_id is None:
+            _auth_cache.clear()
+        else:
+            _auth_cache.pop(user_id, None)
+
+def get_auth_cache_stats() -> dict:
+    """Devuelve los contadores de aciertos/fallos y el tamaño actual de la caché."""
+    with _auth_cache_lock:
+        total = _auth_cache_hits + _auth_cache_misses
+        return {
+            'hits': _auth_cache_hits,
+            'misses': _auth_cache_misses,
+            'hit_rate': (_auth_cache_hits / total) if total else 0.0,
+            'size': len(_auth_cache),
+            'ttl_seconds': AUTH_CACHE_TTL_SECONDS,
+        }
+
+# --- Índices Gestionados ---
+# Índices de las tablas principales: init_db crea los que falten. Las consultas de INDEX_WORKLOAD deben
+# resolverse con ellos sin recorrer tablas completas (lo comprueba get_index_advice / /indexadvisor).
+MANAGED_INDEXES = {
+    'idx_users_name_nocase_id': "users(name COLLATE NOCASE, user_id)",     # /listusers y selector de usuarios (keyset y prefijo)
+    'idx_users_expiry': "users(expiry_ts)",                                # Informes de caducidad de usuarios
+    'idx_account_expiry': "streaming_accounts(expiry_ts)",                 # Purga de cuentas caducadas
+}
+# Índices de las restricciones UNIQUE del esquema actual, que sirven el listado de cuentas de un usuario
+# (filtro y orden) y el ON DELETE CASCADE de los perfiles. Las BD migradas desde la tabla 'accounts' no
+# tienen esas restricciones: solo en ellas se crean estos índices equivalentes.
+UNIQUE_FALLBACK_INDEXES = {
+    'idx_account_user_service_email': ("streaming_accounts", ("user_id", "service", "email")),
+    'idx_profile_account_name': ("account_profiles", ("account_id", "profile_name")),
+}
+# Índices de versiones anteriores que solo cuestan en cada escritura: (tabla, columnas, motivo). Los que son
+# prefijo de otro solo se eliminan si en esta BD existe de verdad un índice que los cubra; con columnas None
+# se eliminan siempre (ninguna consulta los usa).
+OBSOLETE_INDEXES = {
+    'idx_user_id': ("users", ("user_id",), "duplica la clave primaria users.user_id"),
+    'idx_account_user_id': ("streaming_accounts", ("user_id",), "es un prefijo del índice de (user_id, service, email)"),
+    'idx_account_user_service': ("streaming_accounts", ("user_id", "service"), "es un prefijo del índice de (user_id, service, email)"),
+    'idx_profile_account_id': ("account_profiles", ("account_id",), "es un prefijo del índice de (account_id, profile_name)"),
+    'idx_account_user_expiry': ("streaming_accounts", None, "el listado por usuario se ordena por (service, email): no lo usa ningún plan"),
+    'idx_users_name_id': ("users", None, "sustituido por idx_users_name_nocase_id (los listados se ordenan sin distinguir mayúsculas)"),
+    'idx_users_name_nocase': ("users", None, "es un prefijo de idx_users_name_nocase_id"),
+}
+
+def _index_columns(conn: sqlite3.Connection, index: str) -> tuple:
+    """Columnas clave de un índice como (nombre, collation); 'None' como nombre es el rowid."""
+    return tuple((col['name'], col['coll']) for col in conn.execute(f'PRAGMA index_xinfo("{index}")').fetchall() if col['key'])
+
+def _covering_index(conn: sqlite3.Connection, table: str, columns: tuple, exclude: str | None = None) -> str | None:
+    """Nombre de un índice de 'table' (o 'PRIMARY KEY') cuyas primeras columnas son 'columns' con collation BINARY."""
+    table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    pk = [col for col in conn.execute(f'PRAGMA table_info("{table}")').fetchall() if col['pk']]
+    if (len(pk) == 1 and pk[0]['type'].upper() == "INTEGER" and columns == (pk[0]['name'],)
+            and "WITHOUT ROWID" not in ((table_sql[0] if table_sql else None) or "").upper()):
+        return "PRIMARY KEY" # Alias del rowid: es el propio árbol de la tabla y no aparece en index_list
+    wanted = tuple((name, "BINARY") for name in columns)
+    for index in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+        if index['name'] == exclude or index['partial']:
+            continue
+        if _index_columns(conn, index['name'])[:len(wanted)] == wanted:
+            return index['name']
+    return None
+
+def _obsolete_indexes(conn: sqlite3.Connection, existing: set) -> tuple:
+    """Índices obsoletos presentes: (los que se pueden eliminar, los que hay que conservar porque nada los cubre)."""
+    droppable, kept = [], []
+    for name, (table, columns, _reason) in OBSOLETE_INDEXES.items():
+        if name not in existing:
+            continue
+        if columns is not None and _covering_index(conn, table, columns, exclude=name) is None:
+            kept.append(name) # Sin él, sus búsquedas (o el CASCADE) recorrerían la tabla completa
+        else:
+            droppable.append(name)
+    return droppable, kept
+
+def apply_managed_indexes(conn: sqlite3.Connection) -> dict:
+    """
+    Crea los índices gestionados que falten (con sus estadísticas para el planificador) y elimina los
+    obsoletos que ya estén cubiertos por otro índice de la misma tabla.
+    """
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    has_stats = 'sqlite_stat1' in tables
+    created = [name for name in MANAGED_INDEXES if name not in existing]
+    definitions = {name: MANAGED_INDEXES[name] for name in created}
+    for name, (table, columns) in UNIQUE_FALLBACK_INDEXES.items():
+        if name not in existing and table in tables and _covering_index(conn, table, columns) is None:
+            created.append(name)
+            definitions[name] = f"{table}({', '.join(columns)})"
+    for name in created:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definitions[name]};")
+        if has_stats:
+            # Si el resto de índices ya tiene estadísticas, el nuevo también (sin ellas el planificador lo infravalora)
+            conn.execute(f"ANALYZE {name};")
+    dropped, kept = _obsolete_indexes(conn, existing)
+    for name in dropped:
+        conn.execute(f"DROP INDEX IF EXISTS {name};")
+    conn.commit()
+    if kept:
+        logger.warning(f"Índices obsoletos conservados porque ningún otro índice los cubre en esta BD: {kept}")
+    if dropped or created:
+        logger.info(f"Índices gestionados: creados {created or 'ninguno'}, eliminados {dropped or 'ninguno'}.")
+    return {'created': created, 'dropped': dropped, 'kept': kept}
 
 # --- Inicialización y Migración de Base de Datos ---
-def init_db():
-    """Inicializa la base de datos y aplica migraciones si es necesario."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+USERS_COLUMNS = ('user_id', 'name', 'payment_method', 'registration_ts', 'expiry_ts')
 
-    # Crear tabla de usuarios si no existe
+def _migrate_users_name_not_null(conn: sqlite3.Connection) -> None:
+    """
+    Bases antiguas: 'users.name' admitía NULL y con un nombre NULL la comparación del cursor keyset
+    (_USERS_AFTER_CURSOR) es NULL, así que no se podía pasar de esa fila. Rellena los NULL con '' y
+    reconstruye la tabla con NOT NULL (SQLite no permite añadir la restricción con ALTER TABLE).
+    Los índices de 'users' se pierden con la tabla antigua; apply_managed_indexes los vuelve a crear.
+    """
+    columns = {row[1]: row[3] for row in conn.execute("PRAGMA table_info(users)")}
+    if columns.get('name'):
+        return  # Ya es NOT NULL
+    if set(columns) != set(USERS_COLUMNS):
+        # Columnas desconocidas: no se reconstruye para no perderlas, solo se rellenan los NULL
+        updated = conn.execute("UPDATE users SET name = '' WHERE name IS NULL").rowcount
+        conn.commit()
+        logger.warning(f"Tabla 'users' con columnas no esperadas ({', '.join(columns)}): {updated} nombres NULL rellenados, sin NOT NULL.")
+        return
+
+    column_list = ", ".join(USERS_COLUMNS)
     try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute('''
+            CREATE TABLE users_new (
                 user_id INTEGER PRIMARY KEY,
-                name TEXT,
-                payment_method TEXT, -- Se mantiene pero no se usa activamente
+                name TEXT NOT NULL DEFAULT '',
+                payment_method TEXT,
                 registration_ts INTEGER,
-                expiry_ts INTEGER -- Caducidad general del permiso para usar el bot
+                expiry_ts INTEGER
             )
         ''')
-    except sqlite3.Error as e:
-        logger.error(f"Error al crear la tabla de usuarios: {e}")
+        conn.execute(
+            f"INSERT INTO users_new ({column_list}) "
+            f"SELECT user_id, COALESCE(name, ''), payment_method, registration_ts, expiry_ts FROM users"
+        )
+        conn.execute("DROP TABLE users")
+        conn.execute("ALTER TABLE users_new RENAME TO users")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
         raise
+    logger.info("Tabla 'users' migrada: 'name' es NOT NULL (los nombres NULL pasan a '').")
 
-    # --- Migración y Creación de Tablas de Cuentas ---
-    try:
-        # 1. Verificar si la tabla 'accounts' existe (vieja estructura)
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='accounts';")
-        old_table_exists = cursor.fetchone()
+def init_db():
+    """Inicializa la base de datos y aplica migraciones si es necesario."""
+    with get_connection() as conn:
+        cursor = conn.cursor()
 
-        # 2. Verificar si la tabla 'streaming_accounts' existe (nueva estructura)
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='streaming_accounts';")
-        new_main_table_exists = cursor.fetchone()
+        # Crear tabla de usuarios si no existe
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL DEFAULT '', -- NULL rompería el cursor keyset de los listados
+                    payment_method TEXT, -- Se mantiene pero no se usa activamente
+                    registration_ts INTEGER,
+                    expiry_ts INTEGER -- Caducidad general del permiso para usar el bot
+                )
+            ''')
+            _migrate_users_name_not_null(conn)
+        except sqlite3.Error as e:
+            logger.error(f"Error al crear la tabla de usuarios: {e}")
+            raise
 
-        if old_table_exists and not new_main_table_exists:
-            logger.info("Detectada estructura de tabla 'accounts' antigua. Migrando a 'streaming_accounts' y 'account_profiles'...")
-            try:
-                # Renombrar tabla principal
-                cursor.execute("ALTER TABLE accounts RENAME TO streaming_accounts;")
-                logger.info("Tabla 'accounts' renombrada a 'streaming_accounts'.")
+        # --- Migración y Creación de Tablas de Cuentas ---
+        try:
+            # 1. Verificar si la tabla 'accounts' existe (vieja estructura)
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='accounts';")
+            old_table_exists = cursor.fetchone()
+
+            # 2. Verificar si la tabla 'streaming_accounts' existe (nueva estructura)
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='streaming_accounts';")
+            new_main_table_exists = cursor.fetchone()
+
+            if old_table_exists and not new_main_table_exists:
+                logger.info("Detectada estructura de tabla 'accounts' antigua. Migrando a 'streaming_accounts' y 'account_profiles'...")
+                try:
+                    # Renombrar tabla principal
+                    cursor.execute("ALTER TABLE accounts RENAME TO streaming_accounts;")
+                    logger.info("Tabla 'accounts' renombrada a 'streaming_accounts'.")
+
+                    # Crear tabla de perfiles
+                    cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS account_profiles (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            account_id INTEGER NOT NULL,
+                            profile_name TEXT NOT NULL,
+                            pin TEXT,
+                            FOREIGN KEY(account_id) REFERENCES streaming_accounts(id) ON DELETE CASCADE
+                        );
+                    ''')
+                    logger.info("Tabla 'account_profiles' creada o ya existente.")
 
-                # Crear tabla de perfiles
+                    # Migrar datos de perfiles (esto es una aproximación, puede necesitar ajustes)
+                    # Asume que cada fila antigua representa un perfil único
+                    cursor.execute("SELECT id, profile_name, pin FROM streaming_accounts;")
+                    profiles_to_migrate = cursor.fetchall()
+                    for acc_id, profile_name, pin in profiles_to_migrate:
+                        if profile_name: # Solo migrar si había un nombre de perfil
+                            cursor.execute(
+                                "INSERT INTO account_profiles (account_id, profile_name, pin) VALUES (?, ?, ?)",
+                                (acc_id, profile_name, pin if pin else 'N/A')
+                            )
+                    logger.info(f"Migrados {len(profiles_to_migrate)} perfiles iniciales a 'account_profiles'.")
+
+                    # Eliminar columnas antiguas de la tabla principal (¡SQLite tiene limitaciones!)
+                    # Forma segura: Crear nueva tabla sin las columnas, copiar datos, borrar vieja, renombrar nueva.
+                    # Intentaremos un método alternativo si la versión de SQLite lo soporta (>= 3.35.0)
+                    # O simplemente las dejamos NULAS si la migración anterior funcionó.
+                    logger.warning("Columnas 'profile_name' y 'pin' aún existen en 'streaming_accounts' pero no se usarán. Se recomienda limpieza manual o migración avanzada.")
+                    # Alternativamente, si se sabe que no hay datos importantes que perder y se quiere forzar:
+                    # cursor.execute("ALTER TABLE streaming_accounts DROP COLUMN profile_name;") # Requiere SQLite >= 3.35.0
+                    # cursor.execute("ALTER TABLE streaming_accounts DROP COLUMN pin;")      # Requiere SQLite >= 3.35.0
+
+                    conn.commit()
+                    logger.info("Migración de estructura de cuentas completada.")
+
+                except sqlite3.Error as e:
+                    logger.error(f"Error durante la migración de la base de datos: {e}. Revise manualmente.", exc_info=True)
+                    conn.rollback() # Revertir cambios parciales si falla la migración
+                    # Podrías decidir salir o continuar con la estructura antigua si falla
+
+            elif not new_main_table_exists:
+                 # Si ni la vieja ni la nueva existen, crear la nueva estructura directamente
+                logger.info("Creando nueva estructura de tablas 'streaming_accounts' y 'account_profiles'.")
+                cursor.execute('''
+                    CREATE TABLE streaming_accounts (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER NOT NULL,
+                        service TEXT NOT NULL,
+                        email TEXT NOT NULL,
+                        registration_ts INTEGER,
+                        expiry_ts INTEGER,
+                        UNIQUE(user_id, service, email)
+                    );
+                ''')
                 cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS account_profiles (
+                    CREATE TABLE account_profiles (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         account_id INTEGER NOT NULL,
                         profile_name TEXT NOT NULL,
                         pin TEXT,
-                        FOREIGN KEY(account_id) REFERENCES streaming_accounts(id) ON DELETE CASCADE
+                        FOREIGN KEY(account_id) REFERENCES streaming_accounts(id) ON DELETE CASCADE,
+                        UNIQUE(account_id, profile_name)
                     );
                 ''')
-                logger.info("Tabla 'account_profiles' creada o ya existente.")
-
-                # Migrar datos de perfiles (esto es una aproximación, puede necesitar ajustes)
-                # Asume que cada fila antigua representa un perfil único
-                cursor.execute("SELECT id, profile_name, pin FROM streaming_accounts;")
-                profiles_to_migrate = cursor.fetchall()
-                for acc_id, profile_name, pin in profiles_to_migrate:
-                    if profile_name: # Solo migrar si había un nombre de perfil
-                        cursor.execute(
-                            "INSERT INTO account_profiles (account_id, profile_name, pin) VALUES (?, ?, ?)",
-                            (acc_id, profile_name, pin if pin else 'N/A')
-                        )
-                logger.info(f"Migrados {len(profiles_to_migrate)} perfiles iniciales a 'account_profiles'.")
-
-                # Eliminar columnas antiguas de la tabla principal (¡SQLite tiene limitaciones!)
-                # Forma segura: Crear nueva tabla sin las columnas, copiar datos, borrar vieja, renombrar nueva.
-                # Intentaremos un método alternativo si la versión de SQLite lo soporta (>= 3.35.0)
-                # O simplemente las dejamos NULAS si la migración anterior funcionó.
-                logger.warning("Columnas 'profile_name' y 'pin' aún existen en 'streaming_accounts' pero no se usarán. Se recomienda limpieza manual o migración avanzada.")
-                # Alternativamente, si se sabe que no hay datos importantes que perder y se quiere forzar:
-                # cursor.execute("ALTER TABLE streaming_accounts DROP COLUMN profile_name;") # Requiere SQLite >= 3.35.0
-                # cursor.execute("ALTER TABLE streaming_accounts DROP COLUMN pin;")      # Requiere SQLite >= 3.35.0
-
                 conn.commit()
-                logger.info("Migración de estructura de cuentas completada.")
+                logger.info("Nuevas tablas creadas.")
 
-            except sqlite3.Error as e:
-                logger.error(f"Error durante la migración de la base de datos: {e}. Revise manualmente.", exc_info=True)
-                conn.rollback() # Revertir cambios parciales si falla la migración
-                # Podrías decidir salir o continuar con la estructura antigua si falla
+        except sqlite3.Error as e:
+            logger.error(f"Error al inicializar/migrar tablas de cuentas: {e}", exc_info=True)
 
-        elif not new_main_table_exists:
-             # Si ni la vieja ni la nueva existen, crear la nueva estructura directamente
-            logger.info("Creando nueva estructura de tablas 'streaming_accounts' y 'account_profiles'.")
-            cursor.execute('''
-                CREATE TABLE streaming_accounts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    service TEXT NOT NULL,
-                    email TEXT NOT NULL,
-                    registration_ts INTEGER,
-                    expiry_ts INTEGER,
-                    UNIQUE(user_id, service, email)
-                );
-            ''')
-            cursor.execute('''
-                CREATE TABLE account_profiles (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    account_id INTEGER NOT NULL,
-                    profile_name TEXT NOT NULL,
-                    pin TEXT,
-                    FOREIGN KEY(account_id) REFERENCES streaming_accounts(id) ON DELETE CASCADE,
-                    UNIQUE(account_id, profile_name)
-                );
-            ''')
-            conn.commit()
-            logger.info("Nuevas tablas creadas.")
+        # Crear los índices gestionados que falten y eliminar los obsoletos
+        apply_managed_indexes(conn)
 
-    except sqlite3.Error as e:
-        logger.error(f"Error al inicializar/migrar tablas de cuentas: {e}", exc_info=True)
+        # Cola persistente de borrados de mensajes (sobrevive a reinicios)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pending_deletions (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                due_ts INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_deletions_due ON pending_deletions(due_ts);")
 
-    # Crear índices
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON users(user_id);")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_account_user_id ON streaming_accounts(user_id);")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_profile_account_id ON account_profiles(account_id);")
+        # Persistencia de conversaciones y user_data (una fila por clave, escrita solo si cambia)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_states (
+                name TEXT NOT NULL,
+                conv_key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_ts INTEGER NOT NULL,
+                PRIMARY KEY (name, conv_key)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_states_updated ON conversation_states(updated_ts);")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_data_store (
+                user_id INTEGER NOT NULL,
+                data_key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated_ts INTEGER NOT NULL,
+                PRIMARY KEY (user_id, data_key)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_data_store_updated ON user_data_store(updated_ts);")
 
-    conn.commit()
-    conn.close()
+        conn.commit()
+    settings = get_db_settings_report()
+    logger.info(
+        f"Perfil de BD '{settings.get('profile')}' activo: journal_mode={settings.get('journal_mode')}, "
+        f"synchronous={settings.get('synchronous')}, cache_size={settings.get('cache_size')}, "
+        f"mmap_size={settings.get('mmap_size')}, temp_store={settings.get('temp_store')}."
+    )
     logger.info("Inicialización/Verificación de la base de datos completada.")
 
 # --- Funciones CRUD para Usuarios ---
 def add_user_db(user_id: int, name: str, payment_method: str, registration_ts: int, expiry_ts: int) -> None:
     """Añade o actualiza un usuario autorizado en la BD."""
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute(
-            "REPLACE INTO users (user_id, name, payment_method, registration_ts, expiry_ts) VALUES (?, ?, ?, ?, ?)",
-            (user_id, name, payment_method, registration_ts, expiry_ts)
-        )
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            conn.execute(
+                "REPLACE INTO users (user_id, name, payment_method, registration_ts, expiry_ts) VALUES (?, ?, ?, ?, ?)",
+                (user_id, name, payment_method, registration_ts, expiry_ts)
+            )
+            conn.commit()
+        invalidate_auth_cache(user_id)
         logger.info(f"Usuario {user_id} ({name}) añadido/actualizado en BD.")
     except sqlite3.Error as e:
         logger.error(f"Error de BD al añadir usuario {user_id}: {e}")
@@ -168,37 +591,41 @@ def add_user_db(user_id: int, name: str, payment_method: str, registration_ts: i
 def get_user_status_db(user_id: int) -> dict | None:
     """Obtiene el estado (nombre, expiración) de un usuario de la BD."""
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT name, expiry_ts FROM users WHERE user_id = ?", (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with get_connection() as conn:
+            row = conn.execute("SELECT name, expiry_ts FROM users WHERE user_id = ?", (user_id,)).fetchone()
         return dict(row) if row else None
     except sqlite3.Error as e:
         logger.error(f"Error de BD al verificar estado para user_id {user_id}: {e}")
         raise
 
 def is_user_authorized(user_id: int) -> bool:
-    """Verifica si un usuario está autorizado."""
+    """Verifica si un usuario está autorizado (consultando primero la caché en memoria)."""
     if user_id == ADMIN_USER_ID:
         logger.debug(f"is_user_authorized: User {user_id} is ADMIN. Returning True.")
         return True
 
+    cached = get_cached_authorization(user_id)
+    if cached is not None:
+        return cached
+    return load_user_authorization(user_id)
+
+def load_user_authorization(user_id: int) -> bool:
+    """Lee la expiración del usuario de la BD, la guarda en la caché y devuelve si está autorizado."""
+    with _auth_cache_lock:
+        generation = _auth_cache_generation
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        conn.row_factory = sqlite3.Row # Asegurar acceso por nombre de columna
-        cursor = conn.cursor()
-        cursor.execute("SELECT expiry_ts FROM users WHERE user_id = ?", (user_id,))
-        user_row = cursor.fetchone()
-        conn.close()
+        with get_connection() as conn:
+            user_row = conn.execute("SELECT expiry_ts FROM users WHERE user_id = ?", (user_id,)).fetchone()
 
         if user_row:
             current_ts = int(time.time())
             expiry_ts = user_row['expiry_ts']
+            _store_auth_cache(user_id, expiry_ts, generation)
             is_valid = current_ts <= expiry_ts
             logger.debug(f"is_user_authorized: User {user_id} found. current_ts={current_ts}, expiry_ts={expiry_ts}. Is valid: {is_valid}")
             return is_valid
         else:
+            _store_auth_cache(user_id, None, generation)
             logger.debug(f"is_user_authorized: User {user_id} not found in users table. Returning False.")
             return False
     except sqlite3.Error as e:
@@ -208,17 +635,67 @@ def is_user_authorized(user_id: int) -> bool:
         logger.error(f"Error inesperado en is_user_authorized para user_id {user_id}: {e}", exc_info=True)
         return False
 
-def list_users_db() -> list:
-    """Obtiene la lista de todos los usuarios registrados de la BD."""
+# Orden y cursor keyset de los listados de usuarios, con la collation de idx_users_name_nocase_id. El COLLATE
+# va en el lado del cursor: así la comparación es NOCASE y el planificador la usa como rango del índice
+_USERS_ORDER = " ORDER BY name COLLATE NOCASE, user_id"
+_USERS_ORDER_DESC = " ORDER BY name COLLATE NOCASE DESC, user_id DESC"
+_USERS_AFTER_CURSOR = "(name, user_id) > ((SELECT name FROM users WHERE user_id = ?) COLLATE NOCASE, ?)"
+_USERS_BEFORE_CURSOR = "(name, user_id) < ((SELECT name FROM users WHERE user_id = ?) COLLATE NOCASE, ?)"
+
+def _nocase_prefix_bounds(prefix: str) -> tuple:
+    """Rango [lower, upper) en collation NOCASE de los textos que empiezan por 'prefix' (NOCASE y LIKE solo pliegan ASCII)."""
+    lower = "".join(char.lower() if char.isascii() else char for char in prefix)
+    return lower, lower[:-1] + chr(min(ord(lower[-1]) + 1, 0x10FFFF))
+
+def list_users_db(after_user_id: int | None = None, before_user_id: int | None = None, limit: int | None = None,
+                  name_prefix: str | None = None, exclude_user_id: int | None = None) -> list:
+    """
+    Obtiene la lista de usuarios registrados ordenada por (name COLLATE NOCASE, user_id).
+    Sin argumentos devuelve todos. Para paginar por keyset se pasa 'limit' y como cursor el user_id
+    del último usuario mostrado ('after_user_id', página siguiente) o del primero ('before_user_id',
+    página anterior). Cada página es un rango del índice idx_users_name_nocase_id, que da también el orden.
+    'name_prefix' filtra por inicio del nombre sin distinguir mayúsculas (rango LIKE del mismo índice)
+    y 'exclude_user_id' omite un usuario (ej. el propio admin).
+    La lista devuelta siempre está en orden ascendente.
+    """
     users_list = []
+    query = "SELECT user_id, name, expiry_ts FROM users"
+    conditions = []
+    params = []
+    descending = False
+    if name_prefix:
+        escaped_prefix = name_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        if after_user_id is None and before_user_id is None:
+            conditions.append("name LIKE ? ESCAPE '\\'") # Primera página: rango del índice que deriva SQLite del LIKE
+            params.append(escaped_prefix + '%')
+        else:
+            # Con cursor, el rango debe empezar en el cursor: se anula el rango del LIKE (+name) y se acota
+            # el del cursor con los límites NOCASE del prefijo, para no recorrer las coincidencias anteriores
+            lower, upper = _nocase_prefix_bounds(name_prefix)
+            conditions.append("+name LIKE ? ESCAPE '\\' AND name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE")
+            params += [escaped_prefix + '%', lower, upper]
+    if exclude_user_id is not None:
+        conditions.append("user_id != ?")
+        params.append(exclude_user_id)
+    if after_user_id is not None:
+        conditions.append(_USERS_AFTER_CURSOR)
+        params += [after_user_id, after_user_id]
+    elif before_user_id is not None:
+        conditions.append(_USERS_BEFORE_CURSOR)
+        params += [before_user_id, before_user_id]
+        descending = True
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += _USERS_ORDER_DESC if descending else _USERS_ORDER
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, name, expiry_ts FROM users ORDER BY name")
-        rows = cursor.fetchall()
-        conn.close()
+        with get_connection() as conn:
+            rows = conn.execute(query, params).fetchall()
         users_list = [dict(row) for row in rows]
+        if descending:
+            users_list.reverse()
         logger.info(f"list_users_db: Found {len(users_list)} users.")
         logger.debug(f"list_users_db: Data retrieved: {users_list}") # Log detallado de datos
     except sqlite3.Error as e:
@@ -232,12 +709,11 @@ def delete_user_db(user_id: int) -> bool:
         logger.warning(f"Intento de eliminar al administrador (ID: {user_id}). Operación denegada.")
         return False # No permitir eliminar al admin
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        deleted_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            cursor = conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            deleted_rows = cursor.rowcount
+            conn.commit()
+        invalidate_auth_cache(user_id)
         if deleted_rows > 0:
             logger.info(f"Usuario {user_id} eliminado de la BD.")
         else:
@@ -254,12 +730,10 @@ def update_user_name_db(user_id: int, new_name: str) -> bool:
         logger.warning(f"Intento de editar nombre del administrador (ID: {user_id}). Operación denegada.")
         return False # No permitir editar al admin
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET name = ? WHERE user_id = ?", (new_name, user_id))
-        updated_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            cursor = conn.execute("UPDATE users SET name = ? WHERE user_id = ?", (new_name, user_id))
+            updated_rows = cursor.rowcount
+            conn.commit()
         if updated_rows > 0:
             logger.info(f"Nombre del usuario {user_id} actualizado a '{new_name}'.")
         else:
@@ -275,12 +749,11 @@ def update_user_expiry_db(user_id: int, new_expiry_ts: int) -> bool:
         logger.warning(f"Intento de editar expiración del administrador (ID: {user_id}). Operación denegada.")
         return False # No permitir editar al admin
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET expiry_ts = ? WHERE user_id = ?", (new_expiry_ts, user_id))
-        updated_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            cursor = conn.execute("UPDATE users SET expiry_ts = ? WHERE user_id = ?", (new_expiry_ts, user_id))
+            updated_rows = cursor.rowcount
+            conn.commit()
+        invalidate_auth_cache(user_id)
         if updated_rows > 0:
             expiry_date = datetime.fromtimestamp(new_expiry_ts).strftime('%d/%m/%Y %H:%M')
             logger.info(f"Expiración del usuario {user_id} actualizada a {expiry_date} ({new_expiry_ts}).")
@@ -299,150 +772,284 @@ def add_account_db(user_id: int, service: str, email: str, profiles: list, regis
     Actualiza la fecha de expiración si la cuenta principal ya existe.
     Añade/Actualiza perfiles basados en (account_id, profile_name).
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    try:
-        conn.execute("PRAGMA foreign_keys = ON;") # Asegurar integridad referencial
-        # Insertar o reemplazar la cuenta principal (actualiza timestamps si existe)
-        cursor.execute(
-            """
-            INSERT INTO streaming_accounts (user_id, service, email, registration_ts, expiry_ts)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(user_id, service, email) DO UPDATE SET
-            registration_ts=excluded.registration_ts, expiry_ts=excluded.expiry_ts;
-            """,
-            (user_id, service, email, registration_ts, expiry_ts)
-        )
-        # Obtener el ID de la cuenta insertada/actualizada
-        cursor.execute(
-            "SELECT id FROM streaming_accounts WHERE user_id=? AND service=? AND email=?",
-            (user_id, service, email)
-        )
-        account_row = cursor.fetchone()
-        if not account_row:
-             logger.error(f"No se pudo obtener el ID de la cuenta principal después de insertar/actualizar para user {user_id}, service {service}, email {email}.")
-             raise sqlite3.Error("No se pudo obtener el ID de la cuenta principal después de insertar/actualizar.")
-        account_id = account_row[0]
-
-        # Insertar o actualizar perfiles asociados
-        profiles_added_updated = 0
-        for profile in profiles:
-            profile_name = profile.get('name')
-            pin = profile.get('pin', 'N/A') # Usar N/A si no se proporciona PIN
-            if profile_name: # Asegurarse de que hay un nombre de perfil
-                # Verificar límite de perfiles (ej. 5) antes de insertar
-                cursor.execute("SELECT COUNT(*) FROM account_profiles WHERE account_id = ?", (account_id,))
-                count = cursor.fetchone()[0]
-                if count >= 5: # Asumiendo un límite de 5 perfiles por cuenta
-                    logger.warning(f"Límite de perfiles alcanzado para cuenta {account_id}. Omitiendo perfil '{profile_name}'.")
-                    continue # Saltar este perfil
-
-                cursor.execute(
-                    """
-                    INSERT INTO account_profiles (account_id, profile_name, pin)
-                    VALUES (?, ?, ?)
-                    ON CONFLICT(account_id, profile_name) DO UPDATE SET
-                    pin=excluded.pin;
-                    """,
-                    (account_id, profile_name, pin)
-                )
-                if cursor.rowcount > 0:
-                    profiles_added_updated += 1
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # Insertar o reemplazar la cuenta principal (actualiza timestamps si existe)
+            cursor.execute(
+                """
+                INSERT INTO streaming_accounts (user_id, service, email, registration_ts, expiry_ts)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, service, email) DO UPDATE SET
+                registration_ts=excluded.registration_ts, expiry_ts=excluded.expiry_ts;
+                """,
+                (user_id, service, email, registration_ts, expiry_ts)
+            )
+            # Obtener el ID de la cuenta insertada/actualizada
+            cursor.execute(
+                "SELECT id FROM streaming_accounts WHERE user_id=? AND service=? AND email=?",
+                (user_id, service, email)
+            )
+            account_row = cursor.fetchone()
+            if not account_row:
+                 logger.error(f"No se pudo obtener el ID de la cuenta principal después de insertar/actualizar para user {user_id}, service {service}, email {email}.")
+                 raise sqlite3.Error("No se pudo obtener el ID de la cuenta principal después de insertar/actualizar.")
+            account_id = account_row[0]
 
-        conn.commit()
-        logger.info(f"Cuenta {account_id} y {profiles_added_updated} perfiles añadidos/actualizados para user {user_id}, service {service}, email {email}")
-        return True
-    except sqlite3.Error as e:
-        logger.error(f"Error en add_account_db: {e}", exc_info=True)
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+            # Insertar o actualizar perfiles asociados
+            profiles_added_updated = 0
+            for profile in profiles:
+                profile_name = profile.get('name')
+                pin = profile.get('pin', 'N/A') # Usar N/A si no se proporciona PIN
+                if profile_name: # Asegurarse de que hay un nombre de perfil
+                    # Verificar límite de perfiles (ej. 5) antes de insertar
+                    cursor.execute("SELECT COUNT(*) FROM account_profiles WHERE account_id = ?", (account_id,))
+                    count = cursor.fetchone()[0]
+                    if count >= MAX_PROFILES_PER_ACCOUNT:
+                        logger.warning(f"Límite de perfiles alcanzado para cuenta {account_id}. Omitiendo perfil '{profile_name}'.")
+                        continue # Saltar este perfil
+
+                    cursor.execute(
+                        """
+                        INSERT INTO account_profiles (account_id, profile_name, pin)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT(account_id, profile_name) DO UPDATE SET
+                        pin=excluded.pin;
+                        """,
+                        (account_id, profile_name, pin)
+                    )
+                    if cursor.rowcount > 0:
+                        profiles_added_updated += 1
+
+            conn.commit()
+            logger.info(f"Cuenta {account_id} y {profiles_added_updated} perfiles añadidos/actualizados para user {user_id}, service {service}, email {email}")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error en add_account_db: {e}", exc_info=True)
+            conn.rollback()
+            return False
+
+# Límite de perfiles por cuenta principal
+MAX_PROFILES_PER_ACCOUNT = 5
 
-def get_accounts_for_user(user_id: int) -> list:
+def import_accounts_bulk_db(user_id: int, rows: list, registration_ts: int, expiry_ts: int) -> dict:
+    """
+    Importa un backup completo en una sola transacción.
+    Espera 'rows' como la lista de perfiles parseados, ej:
+    [{'service': 'Netflix', 'email': 'a@b.c', 'profile_name': 'P1', 'pin': '1111'}, ...].
+    El límite de perfiles por cuenta se valida en memoria y las cuentas y perfiles se
+    insertan/actualizan con executemany, con un único commit al final.
+    Devuelve un resumen con el resultado de cada fila en 'outcomes' (mismo orden que 'rows'):
+    'added', 'updated', 'limit' (límite de perfiles alcanzado), 'invalid' o 'error'.
+    """
+    outcomes = [None] * len(rows)
+    account_keys = {}
+    for index, row in enumerate(rows):
+        service, email, profile_name = row.get('service'), row.get('email'), row.get('profile_name')
+        if not service or not email or not profile_name:
+            outcomes[index] = 'invalid'
+            continue
+        account_keys.setdefault((service, email), None)
+
+    summary = {'accounts': len(account_keys), 'added': 0, 'updated': 0, 'limit': 0, 'invalid': outcomes.count('invalid'), 'error': 0}
+    if not account_keys:
+        summary['outcomes'] = outcomes
+        return summary
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # 1. Cuentas principales (actualiza timestamps si ya existen)
+            cursor.executemany(
+                """
+                INSERT INTO streaming_accounts (user_id, service, email, registration_ts, expiry_ts)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, service, email) DO UPDATE SET
+                registration_ts=excluded.registration_ts, expiry_ts=excluded.expiry_ts;
+                """,
+                [(user_id, service, email, registration_ts, expiry_ts) for service, email in account_keys]
+            )
+            # 2. IDs de todas las cuentas del usuario y perfiles ya existentes, en una consulta cada uno
+            cursor.execute("SELECT id, service, email FROM streaming_accounts WHERE user_id = ?", (user_id,))
+            account_ids = {(service, email): acc_id for acc_id, service, email in cursor.fetchall()}
+            cursor.execute(
+                """
+                SELECT p.account_id, p.profile_name FROM account_profiles p
+                JOIN streaming_accounts a ON p.account_id = a.id
+                WHERE a.user_id = ?
+                """,
+                (user_id,)
+            )
+            existing_profiles = set(cursor.fetchall())
+            profile_counts = {}
+            for acc_id, _ in existing_profiles:
+                profile_counts[acc_id] = profile_counts.get(acc_id, 0) + 1
+
+            # 3. Validar el límite de perfiles en memoria
+            profile_params = []
+            for index, row in enumerate(rows):
+                if outcomes[index] is not None:
+                    continue
+                acc_id = account_ids[(row['service'], row['email'])]
+                key = (acc_id, row['profile_name'])
+                if key in existing_profiles:
+                    outcomes[index] = 'updated'
+                elif profile_counts.get(acc_id, 0) < MAX_PROFILES_PER_ACCOUNT:
+                    outcomes[index] = 'added'
+                    existing_profiles.add(key)
+                    profile_counts[acc_id] = profile_counts.get(acc_id, 0) + 1
+                else:
+                    outcomes[index] = 'limit'
+                    continue
+                profile_params.append((acc_id, row['profile_name'], row.get('pin') or 'N/A'))
+
+            # 4. Perfiles
+            cursor.executemany(
+                """
+                INSERT INTO account_profiles (account_id, profile_name, pin)
+                VALUES (?, ?, ?)
+                ON CONFLICT(account_id, profile_name) DO UPDATE SET
+                pin=excluded.pin;
+                """,
+                profile_params
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error en import_accounts_bulk_db para user {user_id}: {e}", exc_info=True)
+            conn.rollback()
+            outcomes = ['invalid' if outcome == 'invalid' else 'error' for outcome in outcomes]
+            summary['accounts'] = 0
+
+    for outcome in ('added', 'updated', 'limit', 'error'):
+        summary[outcome] = outcomes.count(outcome)
+    summary['outcomes'] = outcomes
+    logger.info(
+        f"Importación masiva para user {user_id}: {summary['accounts']} cuentas, {summary['added']} perfiles añadidos, "
+        f"{summary['updated']} actualizados, {summary['limit']} omitidos por límite, {summary['invalid']} inválidos, "
+        f"{summary['error']} con error."
+    )
+    return summary
+
+_ACCOUNTS_FOR_USER_QUERY = """
+        SELECT
+            sa.id AS account_id, -- ID de la cuenta principal
+            sa.user_id,
+            sa.service,
+            sa.email,
+            sa.registration_ts,
+            sa.expiry_ts,
+            ap.id AS profile_id, -- ID único del perfil
+            ap.profile_name,
+            ap.pin
+        FROM streaming_accounts sa
+        JOIN account_profiles ap ON sa.id = ap.account_id
+        WHERE sa.user_id = ? AND sa.expiry_ts >= ?
+    """
+# Orden de los índices de (user_id, service, email) y (account_id, profile_name): sa.id desempata las cuentas
+# repetidas de las BD migradas (en ellas el índice no es UNIQUE y termina en el rowid)
+_ACCOUNTS_FOR_USER_ORDER = " ORDER BY sa.service, sa.email, sa.id, ap.profile_name, ap.id"
+_ACCOUNTS_FOR_USER_ORDER_DESC = " ORDER BY sa.service DESC, sa.email DESC, sa.id DESC, ap.profile_name DESC, ap.id DESC"
+
+def get_accounts_for_user(user_id: int, after_profile_id: int | None = None, before_profile_id: int | None = None, limit: int | None = None) -> list:
     """
     Obtiene una lista FLATTENED de perfiles para un usuario, incluyendo
     detalles de la cuenta padre y el ID del perfil.
     Solo incluye perfiles de cuentas cuya fecha de expiración no ha pasado.
+    Orden: (service, email, account_id, profile_name, profile_id), el de los índices de (user_id, service, email)
+    y (account_id, profile_name), así que ninguna página necesita ordenar en memoria. Acepta un cursor keyset igual que list_users_db:
+    'after_profile_id' / 'before_profile_id' con 'limit'. Sin argumentos devuelve todos.
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row # Devolver filas como diccionarios
-    cursor = conn.cursor()
     profiles_data = []
     current_ts = int(time.time())
+    cursor_key = """
+        (SELECT sa2.service, sa2.email, sa2.id, ap2.profile_name, ap2.id
+         FROM account_profiles ap2 JOIN streaming_accounts sa2 ON sa2.id = ap2.account_id
+         WHERE ap2.id = ? AND sa2.user_id = ?)
+    """
+    query = _ACCOUNTS_FOR_USER_QUERY
+    params = [user_id, current_ts]
+    descending = False
+    if after_profile_id is not None:
+        query += f" AND (sa.service, sa.email, sa.id, ap.profile_name, ap.id) > {cursor_key}"
+        params += [after_profile_id, user_id]
+    elif before_profile_id is not None:
+        query += f" AND (sa.service, sa.email, sa.id, ap.profile_name, ap.id) < {cursor_key}"
+        params += [before_profile_id, user_id]
+        descending = True
+    query += _ACCOUNTS_FOR_USER_ORDER_DESC if descending else _ACCOUNTS_FOR_USER_ORDER
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
     try:
-        # Unir las tablas y filtrar por user_id y expiry_ts
-        cursor.execute(
-            """
-            SELECT
-                sa.id AS account_id, -- ID de la cuenta principal
-                sa.user_id,
-                sa.service,
-                sa.email,
-                sa.registration_ts,
-                sa.expiry_ts,
-                ap.id AS profile_id, -- ID único del perfil
-                ap.profile_name,
-                ap.pin
-            FROM streaming_accounts sa
-            JOIN account_profiles ap ON sa.id = ap.account_id
-            WHERE sa.user_id = ? AND sa.expiry_ts >= ?
-            ORDER BY sa.service, ap.profile_name;
-            """,
-            (user_id, current_ts)
-        )
-        rows = cursor.fetchall()
+        with get_connection() as conn:
+            # Unir las tablas y filtrar por user_id y expiry_ts
+            rows = conn.execute(query, params).fetchall()
         for row in rows:
             profiles_data.append(dict(row)) # Convertir cada fila a dict
+        if descending:
+            profiles_data.reverse()
 
         return profiles_data
     except sqlite3.Error as e:
         logger.error(f"Error en get_accounts_for_user (flattened): {e}", exc_info=True)
         return []
-    finally:
-        conn.close()
+
+def get_account_id_for_profile_db(profile_id: int, user_id: int) -> int | None:
+    """Obtiene el ID de la cuenta principal de un perfil, verificando que pertenezca al usuario."""
+    try:
+        with get_connection() as conn:
+            row = conn.execute(
+                """
+                SELECT ap.account_id
+                FROM account_profiles ap
+                JOIN streaming_accounts sa ON ap.account_id = sa.id
+                WHERE ap.id = ? AND sa.user_id = ?
+                """,
+                (profile_id, user_id)
+            ).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Error en get_account_id_for_profile_db: {e}", exc_info=True)
+        return None
 
 def update_account_email_db(account_id: int, user_id: int, new_email: str) -> bool:
     """Actualiza el email de una cuenta principal (streaming_accounts), verificando propiedad y unicidad."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    try:
-        conn.execute("PRAGMA foreign_keys = ON;")
-        # 1. Verificar que la cuenta pertenece al usuario
-        cursor.execute("SELECT service FROM streaming_accounts WHERE id = ? AND user_id = ?", (account_id, user_id))
-        service_row = cursor.fetchone()
-        if not service_row:
-            logger.warning(f"Intento de actualizar email de cuenta {account_id} por usuario {user_id} no propietario o cuenta no existe.")
-            return False
-        service = service_row[0]
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # 1. Verificar que la cuenta pertenece al usuario
+            cursor.execute("SELECT service FROM streaming_accounts WHERE id = ? AND user_id = ?", (account_id, user_id))
+            service_row = cursor.fetchone()
+            if not service_row:
+                logger.warning(f"Intento de actualizar email de cuenta {account_id} por usuario {user_id} no propietario o cuenta no existe.")
+                return False
+            service = service_row[0]
 
-        # 2. Verificar si ya existe OTRA cuenta con el nuevo email para el mismo servicio y usuario
-        cursor.execute(
-            "SELECT id FROM streaming_accounts WHERE user_id = ? AND service = ? AND email = ? AND id != ?",
-            (user_id, service, new_email, account_id)
-        )
-        if cursor.fetchone():
-            logger.warning(f"Conflicto al actualizar email: Ya existe cuenta para user {user_id}, service '{service}' con email '{new_email}'.")
-            return False # Conflicto de unicidad
-
-        # 3. Actualizar email
-        cursor.execute(
-            "UPDATE streaming_accounts SET email = ? WHERE id = ? AND user_id = ?",
-            (new_email, account_id, user_id)
-        )
-        updated_rows = cursor.rowcount
-        conn.commit()
-        if updated_rows > 0:
-            logger.info(f"Email actualizado para cuenta {account_id} a '{new_email}'. Filas afectadas: {updated_rows}")
-        else:
-             logger.warning(f"No se actualizó el email para la cuenta {account_id} (quizás ya tenía ese email?).")
-        return updated_rows > 0
-    except sqlite3.Error as e:
-        logger.error(f"Error en update_account_email_db: {e}", exc_info=True)
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+            # 2. Verificar si ya existe OTRA cuenta con el nuevo email para el mismo servicio y usuario
+            cursor.execute(
+                "SELECT id FROM streaming_accounts WHERE user_id = ? AND service = ? AND email = ? AND id != ?",
+                (user_id, service, new_email, account_id)
+            )
+            if cursor.fetchone():
+                logger.warning(f"Conflicto al actualizar email: Ya existe cuenta para user {user_id}, service '{service}' con email '{new_email}'.")
+                return False # Conflicto de unicidad
+
+            # 3. Actualizar email
+            cursor.execute(
+                "UPDATE streaming_accounts SET email = ? WHERE id = ? AND user_id = ?",
+                (new_email, account_id, user_id)
+            )
+            updated_rows = cursor.rowcount
+            conn.commit()
+            if updated_rows > 0:
+                logger.info(f"Email actualizado para cuenta {account_id} a '{new_email}'. Filas afectadas: {updated_rows}")
+            else:
+                 logger.warning(f"No se actualizó el email para la cuenta {account_id} (quizás ya tenía ese email?).")
+            return updated_rows > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error en update_account_email_db: {e}", exc_info=True)
+            conn.rollback()
+            return False
 
 def update_profile_pin_db(profile_id: int, user_id: int, new_pin: str) -> bool:
     """
@@ -450,123 +1057,113 @@ def update_profile_pin_db(profile_id: int, user_id: int, new_pin: str) -> bool:
     verificando que el usuario sea el dueño de la cuenta principal asociada.
     (Renamed from update_profile_details_db)
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    try:
-        conn.execute("PRAGMA foreign_keys = ON;")
-        # 1. Verificar que el perfil existe y que el usuario es dueño de la cuenta padre
-        cursor.execute(
-            """
-            SELECT ap.id
-            FROM account_profiles ap
-            JOIN streaming_accounts sa ON ap.account_id = sa.id
-            WHERE ap.id = ? AND sa.user_id = ?
-            """,
-            (profile_id, user_id)
-        )
-        if not cursor.fetchone():
-            logger.warning(f"Intento de actualizar PIN del perfil {profile_id} fallido: Perfil no encontrado o no pertenece al usuario {user_id}.")
-            return False
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # 1. Verificar que el perfil existe y que el usuario es dueño de la cuenta padre
+            cursor.execute(
+                """
+                SELECT ap.id
+                FROM account_profiles ap
+                JOIN streaming_accounts sa ON ap.account_id = sa.id
+                WHERE ap.id = ? AND sa.user_id = ?
+                """,
+                (profile_id, user_id)
+            )
+            if not cursor.fetchone():
+                logger.warning(f"Intento de actualizar PIN del perfil {profile_id} fallido: Perfil no encontrado o no pertenece al usuario {user_id}.")
+                return False
 
-        # 2. Actualizar el PIN del perfil
-        cursor.execute(
-            "UPDATE account_profiles SET pin = ? WHERE id = ?",
-            (new_pin, profile_id)
-        )
-        updated_rows = cursor.rowcount
-        conn.commit()
-        if updated_rows > 0:
-            logger.info(f"PIN actualizado para perfil {profile_id}.")
-        else:
-            logger.warning(f"No se actualizó el PIN para el perfil {profile_id} (quizás ya tenía ese PIN?).")
-        return updated_rows > 0
-    except sqlite3.Error as e:
-        logger.error(f"Error en update_profile_pin_db: {e}", exc_info=True)
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+            # 2. Actualizar el PIN del perfil
+            cursor.execute(
+                "UPDATE account_profiles SET pin = ? WHERE id = ?",
+                (new_pin, profile_id)
+            )
+            updated_rows = cursor.rowcount
+            conn.commit()
+            if updated_rows > 0:
+                logger.info(f"PIN actualizado para perfil {profile_id}.")
+            else:
+                logger.warning(f"No se actualizó el PIN para el perfil {profile_id} (quizás ya tenía ese PIN?).")
+            return updated_rows > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error en update_profile_pin_db: {e}", exc_info=True)
+            conn.rollback()
+            return False
 
 def update_profile_name_db(profile_id: int, user_id: int, new_name: str) -> bool:
     """
     Actualiza el nombre de un perfil específico (account_profiles),
     verificando propiedad y unicidad del nombre dentro de la misma cuenta principal.
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    try:
-        conn.execute("PRAGMA foreign_keys = ON;")
-        # 1. Verificar que el perfil existe y que el usuario es dueño de la cuenta padre
-        #    y obtener el account_id para la verificación de unicidad.
-        cursor.execute(
-            """
-            SELECT sa.id AS account_id
-            FROM account_profiles ap
-            JOIN streaming_accounts sa ON ap.account_id = sa.id
-            WHERE ap.id = ? AND sa.user_id = ?
-            """,
-            (profile_id, user_id)
-        )
-        account_row = cursor.fetchone()
-        if not account_row:
-            logger.warning(f"Intento de actualizar nombre del perfil {profile_id} fallido: Perfil no encontrado o no pertenece al usuario {user_id}.")
-            return False
-        account_id = account_row[0]
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # 1. Verificar que el perfil existe y que el usuario es dueño de la cuenta padre
+            #    y obtener el account_id para la verificación de unicidad.
+            cursor.execute(
+                """
+                SELECT sa.id AS account_id
+                FROM account_profiles ap
+                JOIN streaming_accounts sa ON ap.account_id = sa.id
+                WHERE ap.id = ? AND sa.user_id = ?
+                """,
+                (profile_id, user_id)
+            )
+            account_row = cursor.fetchone()
+            if not account_row:
+                logger.warning(f"Intento de actualizar nombre del perfil {profile_id} fallido: Perfil no encontrado o no pertenece al usuario {user_id}.")
+                return False
+            account_id = account_row[0]
 
-        # 2. Verificar si ya existe OTRO perfil con el nuevo nombre en la MISMA cuenta principal
-        cursor.execute(
-            "SELECT id FROM account_profiles WHERE account_id = ? AND profile_name = ? AND id != ?",
-            (account_id, new_name, profile_id)
-        )
-        if cursor.fetchone():
-            logger.warning(f"Conflicto al actualizar nombre perfil {profile_id}: Ya existe otro perfil con nombre '{new_name}' en la cuenta {account_id}.")
-            return False # Conflicto de unicidad
-
-        # 3. Actualizar el nombre del perfil
-        cursor.execute(
-            "UPDATE account_profiles SET profile_name = ? WHERE id = ?",
-            (new_name, profile_id)
-        )
-        updated_rows = cursor.rowcount
-        conn.commit()
-        if updated_rows > 0:
-            logger.info(f"Nombre actualizado para perfil {profile_id} a '{new_name}'.")
-        else:
-            logger.warning(f"No se actualizó el nombre para el perfil {profile_id} (quizás ya tenía ese nombre?).")
-        return updated_rows > 0
-    except sqlite3.Error as e:
-        logger.error(f"Error en update_profile_name_db: {e}", exc_info=True)
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+            # 2. Verificar si ya existe OTRO perfil con el nuevo nombre en la MISMA cuenta principal
+            cursor.execute(
+                "SELECT id FROM account_profiles WHERE account_id = ? AND profile_name = ? AND id != ?",
+                (account_id, new_name, profile_id)
+            )
+            if cursor.fetchone():
+                logger.warning(f"Conflicto al actualizar nombre perfil {profile_id}: Ya existe otro perfil con nombre '{new_name}' en la cuenta {account_id}.")
+                return False # Conflicto de unicidad
+
+            # 3. Actualizar el nombre del perfil
+            cursor.execute(
+                "UPDATE account_profiles SET profile_name = ? WHERE id = ?",
+                (new_name, profile_id)
+            )
+            updated_rows = cursor.rowcount
+            conn.commit()
+            if updated_rows > 0:
+                logger.info(f"Nombre actualizado para perfil {profile_id} a '{new_name}'.")
+            else:
+                logger.warning(f"No se actualizó el nombre para el perfil {profile_id} (quizás ya tenía ese nombre?).")
+            return updated_rows > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error en update_profile_name_db: {e}", exc_info=True)
+            conn.rollback()
+            return False
 
 def delete_account_db(account_id: int, user_id: int) -> bool:
     """
     Elimina una cuenta principal (streaming_accounts) y sus perfiles asociados (CASCADE),
     verificando propiedad.
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    try:
-        # Habilitar claves foráneas para que CASCADE funcione
-        cursor.execute("PRAGMA foreign_keys = ON;")
-        # Verificar propiedad y eliminar la cuenta principal
-        # La eliminación de perfiles asociados ocurrirá automáticamente debido a ON DELETE CASCADE
-        cursor.execute("DELETE FROM streaming_accounts WHERE id = ? AND user_id = ?", (account_id, user_id))
-        deleted_rows = cursor.rowcount
-        conn.commit()
-        if deleted_rows > 0:
-            logger.info(f"Cuenta principal {account_id} y sus perfiles asociados eliminados para usuario {user_id}.")
-        else:
-            logger.warning(f"Intento de eliminar cuenta principal {account_id} fallido (no encontrada o no pertenece a usuario {user_id}).")
-        return deleted_rows > 0
-    except sqlite3.Error as e:
-        logger.error(f"Error en delete_account_db: {e}", exc_info=True)
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # Las claves foráneas ya están habilitadas en la conexión del pool, por lo que
+            # la eliminación de perfiles asociados ocurrirá automáticamente (ON DELETE CASCADE)
+            cursor.execute("DELETE FROM streaming_accounts WHERE id = ? AND user_id = ?", (account_id, user_id))
+            deleted_rows = cursor.rowcount
+            conn.commit()
+            if deleted_rows > 0:
+                logger.info(f"Cuenta principal {account_id} y sus perfiles asociados eliminados para usuario {user_id}.")
+            else:
+                logger.warning(f"Intento de eliminar cuenta principal {account_id} fallido (no encontrada o no pertenece a usuario {user_id}).")
+            return deleted_rows > 0
+        except sqlite3.Error as e:
+            logger.error(f"Error en delete_account_db: {e}", exc_info=True)
+            conn.rollback()
+            return False
 
 def get_all_accounts_db() -> list:
     """
@@ -574,32 +1171,29 @@ def get_all_accounts_db() -> list:
     incluyendo detalles de la cuenta padre y el ID del perfil.
     Utilizado por el administrador.
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row # Devolver filas como diccionarios
-    cursor = conn.cursor()
     profiles_data = []
     try:
-        # Unir las tablas
-        cursor.execute(
-            """
-            SELECT
-                sa.id AS account_id,
-                sa.user_id,
-                sa.service,
-                sa.email,
-                sa.registration_ts,
-                sa.expiry_ts,
-                ap.id AS profile_id,
-                ap.profile_name,
-                ap.pin,
-                u.name AS owner_name -- Añadir nombre del dueño desde la tabla users
-            FROM streaming_accounts sa
-            JOIN account_profiles ap ON sa.id = ap.account_id
-            LEFT JOIN users u ON sa.user_id = u.user_id -- Unir con users para obtener el nombre
-            ORDER BY sa.user_id, sa.service, ap.profile_name;
-            """
-        )
-        rows = cursor.fetchall()
+        with get_connection() as conn:
+            # Unir las tablas
+            rows = conn.execute(
+                """
+                SELECT
+                    sa.id AS account_id,
+                    sa.user_id,
+                    sa.service,
+                    sa.email,
+                    sa.registration_ts,
+                    sa.expiry_ts,
+                    ap.id AS profile_id,
+                    ap.profile_name,
+                    ap.pin,
+                    u.name AS owner_name -- Añadir nombre del dueño desde la tabla users
+                FROM streaming_accounts sa
+                JOIN account_profiles ap ON sa.id = ap.account_id
+                LEFT JOIN users u ON sa.user_id = u.user_id -- Unir con users para obtener el nombre
+                ORDER BY sa.user_id, sa.service, ap.profile_name;
+                """
+            ).fetchall()
         for row in rows:
             profiles_data.append(dict(row))
 
@@ -607,26 +1201,337 @@ def get_all_accounts_db() -> list:
     except sqlite3.Error as e:
         logger.error(f"Error en get_all_accounts_db (flattened): {e}", exc_info=True)
         return []
-    finally:
-        conn.close()
+
+# --- Cola Persistente de Borrados de Mensajes ---
+def save_pending_deletions_db(entries: list) -> bool:
+    """
+    Guarda borrados pendientes [(chat_id, message_id, due_ts), ...] en una sola transacción.
+    Si un mensaje ya estaba guardado se conserva el vencimiento más cercano.
+    """
+    if not entries:
+        return True
+    with get_connection() as conn:
+        try:
+            conn.executemany(
+                """
+                INSERT INTO pending_deletions (chat_id, message_id, due_ts) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id, message_id) DO UPDATE SET due_ts = MIN(due_ts, excluded.due_ts)
+                """,
+                entries
+            )
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error al guardar {len(entries)} borrados pendientes: {e}", exc_info=True)
+            conn.rollback()
+            return False
+
+def remove_pending_deletions_db(keys: list) -> bool:
+    """Elimina de la cola los borrados ya procesados [(chat_id, message_id), ...]."""
+    if not keys:
+        return True
+    with get_connection() as conn:
+        try:
+            conn.executemany("DELETE FROM pending_deletions WHERE chat_id = ? AND message_id = ?", keys)
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error al eliminar {len(keys)} borrados pendientes: {e}", exc_info=True)
+            conn.rollback()
+            return False
+
+def load_pending_deletions_db() -> list:
+    """Devuelve todos los borrados pendientes [(chat_id, message_id, due_ts), ...] ordenados por vencimiento."""
+    with get_connection() as conn:
+        try:
+            cursor = conn.execute("SELECT chat_id, message_id, due_ts FROM pending_deletions ORDER BY due_ts")
+            return [tuple(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error al cargar los borrados pendientes: {e}", exc_info=True)
+            return []
+
+# --- Persistencia de Conversaciones y user_data ---
+def load_conversation_states_db(name: str, min_updated_ts: int) -> list:
+    """Devuelve [(conv_key, state, updated_ts), ...] de una conversación, omitiendo los estados anteriores a 'min_updated_ts'."""
+    with get_connection() as conn:
+        try:
+            cursor = conn.execute(
+                "SELECT conv_key, state, updated_ts FROM conversation_states WHERE name = ? AND updated_ts >= ?",
+                (name, min_updated_ts)
+            )
+            return [tuple(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error al cargar estados de la conversación '{name}': {e}", exc_info=True)
+            return []
+
+def save_conversation_state_db(name: str, conv_key: str, state: str | None, updated_ts: int) -> bool:
+    """Guarda el estado (JSON) de una clave de conversación; 'state' None elimina la fila (conversación terminada)."""
+    with get_connection() as conn:
+        try:
+            if state is None:
+                conn.execute("DELETE FROM conversation_states WHERE name = ? AND conv_key = ?", (name, conv_key))
+            else:
+                conn.execute(
+                    """
+                    INSERT INTO conversation_states (name, conv_key, state, updated_ts) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(name, conv_key) DO UPDATE SET state = excluded.state, updated_ts = excluded.updated_ts
+                    """,
+                    (name, conv_key, state, updated_ts)
+                )
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error al guardar el estado de la conversación '{name}' ({conv_key}): {e}", exc_info=True)
+            conn.rollback()
+            return False
+
+def load_user_data_db(min_updated_ts: int) -> list:
+    """Devuelve [(user_id, data_key, value), ...] de los usuarios con actividad desde 'min_updated_ts'."""
+    with get_connection() as conn:
+        try:
+            cursor = conn.execute(
+                """
+                SELECT user_id, data_key, value FROM user_data_store
+                WHERE user_id IN (SELECT user_id FROM user_data_store GROUP BY user_id HAVING MAX(updated_ts) >= ?)
+                """,
+                (min_updated_ts,)
+            )
+            return [tuple(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error al cargar user_data persistido: {e}", exc_info=True)
+            return []
+
+def save_user_data_db(user_id: int, changed: dict, removed: list, updated_ts: int) -> bool:
+    """
+    Aplica en una transacción los cambios de user_data de un usuario: 'changed' {clave: JSON} se
+    inserta/actualiza, 'removed' [clave, ...] se elimina y el resto de sus claves se marca como activo.
+    """
+    with get_connection() as conn:
+        try:
+            if removed:
+                conn.executemany(
+                    "DELETE FROM user_data_store WHERE user_id = ? AND data_key = ?",
+                    [(user_id, key) for key in removed]
+                )
+            if changed:
+                conn.executemany(
+                    """
+                    INSERT INTO user_data_store (user_id, data_key, value, updated_ts) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id, data_key) DO UPDATE SET value = excluded.value, updated_ts = excluded.updated_ts
+                    """,
+                    [(user_id, key, value, updated_ts) for key, value in changed.items()]
+                )
+            conn.execute("UPDATE user_data_store SET updated_ts = ? WHERE user_id = ? AND updated_ts < ?", (updated_ts, user_id, updated_ts))
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error al guardar user_data del usuario {user_id}: {e}", exc_info=True)
+            conn.rollback()
+            return False
+
+def delete_user_data_db(user_id: int) -> bool:
+    """Elimina todo el user_data persistido de un usuario."""
+    with get_connection() as conn:
+        try:
+            conn.execute("DELETE FROM user_data_store WHERE user_id = ?", (user_id,))
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error al eliminar user_data del usuario {user_id}: {e}", exc_info=True)
+            conn.rollback()
+            return False
+
+def purge_stale_persistence_db(cutoff_ts: int) -> dict:
+    """Elimina las conversaciones y el user_data sin actividad desde 'cutoff_ts'. Devuelve cuántas filas se borraron."""
+    with get_connection() as conn:
+        try:
+            conversations = conn.execute("DELETE FROM conversation_states WHERE updated_ts < ?", (cutoff_ts,)).rowcount
+            user_data = conn.execute(
+                """
+                DELETE FROM user_data_store
+                WHERE user_id IN (SELECT user_id FROM user_data_store GROUP BY user_id HAVING MAX(updated_ts) < ?)
+                """,
+                (cutoff_ts,)
+            ).rowcount
+            conn.commit()
+            return {'conversations': conversations, 'user_data': user_data}
+        except sqlite3.Error as e:
+            logger.error(f"Error al purgar la persistencia caducada: {e}", exc_info=True)
+            conn.rollback()
+            return {'conversations': 0, 'user_data': 0}
 
 # --- Funciones de Limpieza (Opcional) ---
+_DELETE_EXPIRED_ACCOUNTS_QUERY = "DELETE FROM streaming_accounts WHERE expiry_ts < ?"
+
 def delete_expired_accounts():
     """Elimina las cuentas principales cuya fecha de expiración ha pasado."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    with get_connection() as conn:
+        try:
+            current_ts = int(time.time())
+            # CASCADE funciona porque la conexión del pool tiene foreign_keys = ON
+            cursor = conn.execute(_DELETE_EXPIRED_ACCOUNTS_QUERY, (current_ts,)) # Rango sobre idx_account_expiry
+            deleted_count = cursor.rowcount
+            conn.commit()
+            if deleted_count > 0:
+                logger.info(f"Se eliminaron {deleted_count} cuentas expiradas.")
+            return deleted_count
+        except sqlite3.Error as e:
+            logger.error(f"Error al eliminar cuentas expiradas: {e}", exc_info=True)
+            conn.rollback()
+            return 0
+
+# --- Mantenimiento y Diagnóstico ---
+_SYNCHRONOUS_NAMES = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+_TEMP_STORE_NAMES = {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}
+
+def run_db_maintenance() -> dict:
+    """
+    Ejecuta el mantenimiento periódico: checkpoint del WAL (PASSIVE, no bloquea lectores
+    ni escritores) y PRAGMA optimize para refrescar las estadísticas del planificador.
+    """
+    result = {}
     try:
-        current_ts = int(time.time())
-        cursor.execute("PRAGMA foreign_keys = ON;") # Asegurar que CASCADE funcione
-        cursor.execute("DELETE FROM streaming_accounts WHERE expiry_ts < ?", (current_ts,))
-        deleted_count = cursor.rowcount
-        conn.commit()
-        if deleted_count > 0:
-            logger.info(f"Se eliminaron {deleted_count} cuentas expiradas.")
-        return deleted_count
+        with get_connection() as conn:
+            busy, wal_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchone()
+            conn.execute("PRAGMA optimize;")
+        result = {'busy': busy, 'wal_frames': wal_frames, 'checkpointed': checkpointed}
+        logger.info(f"Mantenimiento de BD completado: wal_checkpoint={result}, optimize OK.")
     except sqlite3.Error as e:
-        logger.error(f"Error al eliminar cuentas expiradas: {e}", exc_info=True)
-        conn.rollback()
-        return 0
-    finally:
-        conn.close()
+        logger.error(f"Error durante el mantenimiento de la BD: {e}", exc_info=True)
+    return result
+
+def get_db_settings_report() -> dict:
+    """Devuelve los valores efectivos de los PRAGMA relevantes en una conexión del pool."""
+    report = {'profile': DB_PROFILE, 'database': DATABASE_FILE}
+    try:
+        with get_connection() as conn:
+            def pragma(name):
+                return conn.execute(f"PRAGMA {name};").fetchone()[0]
+            report.update({
+                'journal_mode': pragma('journal_mode'),
+                'synchronous': _SYNCHRONOUS_NAMES.get(pragma('synchronous'), '?'),
+                'cache_size': pragma('cache_size'),
+                'mmap_size': pragma('mmap_size'),
+                'temp_store': _TEMP_STORE_NAMES.get(pragma('temp_store'), '?'),
+                'busy_timeout': pragma('busy_timeout'),
+                'foreign_keys': bool(pragma('foreign_keys')),
+                'wal_autocheckpoint': pragma('wal_autocheckpoint'),
+                'page_size': pragma('page_size'),
+                'page_count': pragma('page_count'),
+                'freelist_count': pragma('freelist_count'),
+            })
+        report['pool_size'] = DB_POOL_SIZE
+        report['maintenance_interval'] = DB_MAINTENANCE_INTERVAL_SECONDS
+    except sqlite3.Error as e:
+        logger.error(f"Error al obtener la configuración de la BD: {e}", exc_info=True)
+    return report
+
+# --- Asesor de Índices ---
+# Consultas críticas del bot que deben resolverse con índices aunque las tablas crezcan. Una tupla
+# (sql, parámetros) fija los primeros parámetros: LIKE solo usa el índice con un patrón de texto.
+INDEX_WORKLOAD = {
+    'listado de cuentas de un usuario': _ACCOUNTS_FOR_USER_QUERY + _ACCOUNTS_FOR_USER_ORDER + " LIMIT ?",
+    'página anterior de cuentas de un usuario': _ACCOUNTS_FOR_USER_QUERY + _ACCOUNTS_FOR_USER_ORDER_DESC + " LIMIT ?",
+    'purga de cuentas caducadas': _DELETE_EXPIRED_ACCOUNTS_QUERY,
+    'informe de caducidad de usuarios': "SELECT user_id, name, expiry_ts FROM users WHERE expiry_ts BETWEEN ? AND ? ORDER BY expiry_ts",
+    'autorización de un usuario': "SELECT expiry_ts FROM users WHERE user_id = ?",
+    'página de /listusers': f"SELECT user_id, name, expiry_ts FROM users WHERE {_USERS_AFTER_CURSOR}{_USERS_ORDER} LIMIT ?",
+    'página anterior de /listusers': f"SELECT user_id, name, expiry_ts FROM users WHERE {_USERS_BEFORE_CURSOR}{_USERS_ORDER_DESC} LIMIT ?",
+    'búsqueda por prefijo en el selector': (
+        f"SELECT user_id, name, expiry_ts FROM users WHERE name LIKE ? ESCAPE '\\' AND user_id != ?{_USERS_ORDER} LIMIT ?", ("a%",)
+    ),
+    'página de la búsqueda por prefijo': (
+        f"SELECT user_id, name, expiry_ts FROM users WHERE +name LIKE ? ESCAPE '\\' AND name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE"
+        f" AND user_id != ? AND {_USERS_AFTER_CURSOR}{_USERS_ORDER} LIMIT ?", ("a%", "a", "b")
+    ),
+}
+_PLANNABLE_PREFIXES = ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT", "REPLACE")
+
+def _explain_plan(conn: sqlite3.Connection, sql: str, parameters: tuple = ()) -> list:
+    """Filas 'detail' de EXPLAIN QUERY PLAN; los parámetros que falten se enlazan a NULL (salvo LIKE, el plan no depende de ellos)."""
+    parameters = tuple(parameters) + (None,) * (sql.count("?") - len(parameters))
+    return [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()]
+
+def _plan_problems(plan: list, hot: bool) -> list:
+    """
+    Motivos por los que un plan no escala: tablas recorridas enteras y ordenaciones en un B-tree temporal.
+    En las consultas críticas ('hot') tampoco vale recorrer un índice completo: cada paso debe ser un SEARCH.
+    """
+    problems = [f"recorre entera {table}" for table in full_scans(plan)]
+    if hot:
+        problems += [f"sin búsqueda por índice: {detail}" for detail in plan if detail.startswith("SCAN ") and " USING " in detail]
+    problems += [f"ordena en un B-tree temporal ({detail.split(' FOR ', 1)[-1]})" for detail in plan if "TEMP B-TREE" in detail]
+    return problems
+
+def _redundant_indexes(conn: sqlite3.Connection) -> list:
+    """Índices no únicos cuyas columnas (con su collation y orden) son un prefijo de otro índice de la misma tabla."""
+    redundant = []
+    tables = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()
+    for table, table_sql in tables:
+        indexes = {}
+        for index in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+            columns = tuple(
+                (col['name'], col['coll'], col['desc'])
+                for col in conn.execute(f'PRAGMA index_xinfo("{index["name"]}")').fetchall() if col['key']
+            )
+            indexes[index['name']] = (columns, bool(index['unique']), bool(index['partial']))
+        # En una tabla con rowid, la clave INTEGER PRIMARY KEY ya es el propio árbol de la tabla
+        pk = [col for col in conn.execute(f'PRAGMA table_info("{table}")').fetchall() if col['pk']]
+        rowid_key = (pk[0]['name'],) if len(pk) == 1 and pk[0]['type'].upper() == "INTEGER" and "WITHOUT ROWID" not in (table_sql or "").upper() else None
+        for name, (columns, unique, partial) in indexes.items():
+            if unique or partial:
+                continue
+            if rowid_key and tuple(col[0] for col in columns) == rowid_key:
+                redundant.append({'index': name, 'table': table, 'covered_by': "PRIMARY KEY"})
+                continue
+            for other, (other_columns, other_unique, other_partial) in indexes.items():
+                if other == name or other_partial or other_columns[:len(columns)] != columns:
+                    continue
+                # Dos índices idénticos: sobra el no único, o el segundo por nombre
+                if len(other_columns) > len(columns) or other_unique or other < name:
+                    redundant.append({'index': name, 'table': table, 'covered_by': other})
+                    break
+    return redundant
+
+def get_index_advice(statements: list | None = None) -> dict:
+    """
+    Asesor de índices: compara los índices existentes con MANAGED_INDEXES, UNIQUE_FALLBACK_INDEXES y OBSOLETE_INDEXES, detecta
+    índices redundantes y revisa el plan de las consultas de INDEX_WORKLOAD y de 'statements' (p. ej. las
+    sentencias con más tiempo acumulado según query_log), marcando recorridos completos y ordenaciones temporales.
+    """
+    advice = {'missing': [], 'obsolete': [], 'kept': [], 'redundant': [], 'workload': [], 'statements': []}
+    try:
+        with get_connection() as conn:
+            existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            advice['missing'] = [name for name in MANAGED_INDEXES if name not in existing]
+            advice['missing'] += [
+                name for name, (table, columns) in UNIQUE_FALLBACK_INDEXES.items()
+                if name not in existing and _covering_index(conn, table, columns) is None
+            ]
+            advice['obsolete'], advice['kept'] = _obsolete_indexes(conn, existing)
+            advice['redundant'] = [r for r in _redundant_indexes(conn) if r['index'] not in OBSOLETE_INDEXES]
+
+            def review(label, sql, parameters=()):
+                plan = _explain_plan(conn, sql, parameters)
+                return {
+                    'name': label,
+                    'sql': normalize_sql(sql),
+                    'plan': plan,
+                    'full_scans': full_scans(plan),
+                    'temp_btree': any("TEMP B-TREE" in detail for detail in plan),
+                    'problems': _plan_problems(plan, hot=label is not None),
+                }
+            advice['workload'] = [
+                review(label, *query) if isinstance(query, tuple) else review(label, query)
+                for label, query in INDEX_WORKLOAD.items()
+            ]
+            for sql in statements or []:
+                if not sql.upper().startswith(_PLANNABLE_PREFIXES) or "sqlite_" in sql:
+                    continue
+                try:
+                    advice['statements'].append(review(None, sql))
+                except sqlite3.Error as e:
+                    logger.debug(f"Asesor de índices: no se pudo analizar '{sql}': {e}")
+    except sqlite3.Error as e:
+        logger.error(f"Error en el asesor de índices: {e}", exc_info=True)
+    return advice
@@ -0,0 +1,54 @@
+import functools
+
+# --- Caracteres Especiales por Versión ---
+# Markdown (v1, ParseMode.MARKDOWN): solo se pueden escapar _ * ` [
+# MarkdownV2 (ParseMode.MARKDOWN_V2): todos los de la lista oficial de la Bot API
+MARKDOWN_V1_CHARS = "_*`["
+MARKDOWN_V2_CHARS = "_*[]()~`>#+-=|{}.!"
+
+# Por versión: [(carácter, escapado)] y [(doble escapado, escapado)] para respetar lo ya escapado
+_REPLACEMENTS = {
+    version: (
+        [(char, "\\" + char) for char in chars],
+        [("\\\\" + char, "\\" + char) for char in chars],
+    )
+    for version, chars in ((1, MARKDOWN_V1_CHARS), (2, MARKDOWN_V2_CHARS))
+}
+
+MAX_CACHED_LENGTH = 128 # Solo se memorizan textos cortos (servicios, nombres, emails...)
+CACHE_SIZE = 4096
+
+# --- Escapado ---
+def _escape(text: str, version: int) -> str:
+    """
+    Una pasada de str.replace (en C) por carácter especial presente; medido, es bastante más rápido que
+    str.translate (que con reemplazos de 2 caracteres recorre el texto carácter a carácter) y que re.sub.
+    """
+    escapes, unescapes = _REPLACEMENTS[version]
+    for char, escaped in escapes:
+        if char in text:
+            text = text.replace(char, escaped)
+    if "\\\\" in text:
+        # Un carácter que ya venía escapado ha quedado como '\\' + '\c': devolverlo a '\c'
+        for double, escaped in unescapes:
+            text = text.replace(double, escaped)
+    return text
+
+_escape_cached = functools.lru_cache(maxsize=CACHE_SIZE)(_escape)
+
+def escape_markdown(text, version: int = 2) -> str:
+    """
+    Escapa los caracteres especiales de Markdown (version=1) o MarkdownV2 (version=2) en tiempo lineal.
+    Un carácter ya escapado (precedido de '\\') se deja como está. Acepta cualquier valor (se convierte a str).
+    """
+    if not isinstance(text, str):
+        text = str(text) # Asegurarse que es string
+    if version not in _REPLACEMENTS:
+        raise ValueError(f"Versión de Markdown no soportada: {version} (usa 1 o 2).")
+    if len(text) <= MAX_CACHED_LENGTH:
+        return _escape_cached(text, version)
+    return _escape(text, version)
+
+def cache_info():
+    """Estadísticas de la caché LRU (hits, misses, maxsize, currsize)."""
+    return _escape_cached.cache_info()
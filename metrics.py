@@ -0,0 +1,381 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import re
+import time
+from collections import Counter
+
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import ApplicationHandlerStop, ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración de Métricas ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1") # Solo local: las métricas no deben salir del servidor
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464")) # 0 = sin endpoint HTTP /metrics
+METRICS_PATH = "/metrics"
+
+# Buckets (segundos) de los histogramas: de 1 ms a 10 s, suficientes para handlers, BD y Bot API
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_MAX_LABELS = 500 # Valores distintos por métrica; el resto se agrupa en 'other' (el callback_data lo elige el cliente)
+_HTTP_TIMEOUT_SECONDS = 5
+_DIGITS_RE = re.compile(r"\d+")
+
+# --- Histogramas y Contadores ---
+class Histogram:
+    """Histograma de buckets fijos al estilo Prometheus (un bisect y tres sumas por observación)."""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "max")
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # El último es +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Estimación del cuantil interpolando dentro del bucket (como histogram_quantile de Prometheus)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.buckets):
+                    return self.max
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = min(self.buckets[i], self.max)
+                return lower + (upper - lower) * max(0.0, rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+class HistogramFamily:
+    """Un histograma por valor de etiqueta (p. ej. uno por handler)."""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.histograms = {}
+
+    def observe(self, label_value: str, value: float) -> None:
+        histogram = self.histograms.get(label_value)
+        if histogram is None:
+            if len(self.histograms) >= _MAX_LABELS:
+                label_value = "other"
+            histogram = self.histograms.setdefault(label_value, Histogram())
+        histogram.observe(value)
+
+class CounterFamily:
+    """Contador con una o varias etiquetas (la clave es la tupla de valores)."""
+
+    def __init__(self, name: str, help_text: str, labels: tuple):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = Counter()
+
+    def inc(self, *label_values, amount: int = 1) -> None:
+        if label_values not in self.values and len(self.values) >= _MAX_LABELS:
+            label_values = ("other",) * len(self.labels)
+        self.values[label_values] += amount
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+# --- Tiempo por Update ---
+class _UpdateTiming:
+    """Acumula el tiempo de BD y de Bot API consumido durante un update."""
+
+    __slots__ = ("start", "db", "api")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.api = 0.0
+
+# PTB procesa cada update en su propia tarea, así que la variable de contexto no se mezcla entre updates
+_current_update = contextvars.ContextVar("metrics_current_update", default=None)
+
+def update_type(update: object) -> str:
+    """Tipo de update con pocas categorías (etiqueta de baja cardinalidad)."""
+    if not isinstance(update, Update):
+        return "other"
+    if update.callback_query is not None:
+        return "callback_query"
+    message = update.message
+    if message is None:
+        return "other"
+    if message.document is not None:
+        return "document"
+    if message.text and message.text.startswith("/"):
+        return "command"
+    return "message"
+
+def callback_label(data: str | None) -> str:
+    """callback_data sin los números (ids, páginas): 'deluser_123' -> 'deluser_#'."""
+    return _DIGITS_RE.sub("#", data) if data else "none"
+
+def _is_benign_error(error: Exception) -> bool:
+    return isinstance(error, ApplicationHandlerStop) or (
+        isinstance(error, BadRequest) and "message is not modified" in str(error).lower()
+    )
+
+# --- Registro de Métricas ---
+class BotMetrics:
+    """
+    Métricas de rendimiento en memoria, pensadas para dejarse activas en producción: cada medición es
+    un perf_counter y unas pocas operaciones de dict, todo en el hilo del event loop (sin locks).
+
+    - Duración de cada update (desde que obtiene worker) y de cada handler, con el tiempo de BD
+      (async_db.run_db) y de Bot API (limitador de envíos) que ha consumido.
+    - Transiciones de estado de los ConversationHandler y errores por handler y por callback_data.
+    Se consultan en texto Prometheus (endpoint HTTP local /metrics) o resumidas con /perf.
+    """
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self.started_ts = time.time()
+        self.update_duration = HistogramFamily("bot_update_duration_seconds", "Duración del procesado de cada update.", "type")
+        self.update_db = HistogramFamily("bot_update_db_seconds", "Tiempo de BD consumido por cada update.", "type")
+        self.update_api = HistogramFamily("bot_update_api_seconds", "Tiempo de llamadas a la Bot API consumido por cada update.", "type")
+        self.handler_duration = HistogramFamily("bot_handler_duration_seconds", "Duración de cada callback de handler.", "handler")
+        self.db_duration = HistogramFamily("bot_db_call_duration_seconds", "Duración de cada llamada a la BD (incluida la espera de hilo).", "function")
+        self.api_duration = HistogramFamily("bot_api_call_duration_seconds", "Duración de cada llamada HTTP a la Bot API.", "method")
+        self.handler_errors = CounterFamily("bot_handler_errors_total", "Excepciones no controladas por handler.", ("handler",))
+        self.callback_errors = CounterFamily("bot_callback_errors_total", "Errores al procesar botones, por callback_data.", ("callback",))
+        self.transitions = CounterFamily("bot_conversation_transitions_total", "Estados alcanzados en cada conversación.", ("conversation", "state"))
+        self._server = None
+
+    # --- Updates ---
+    def begin_update(self):
+        """Empieza a medir el update de la tarea actual; devuelve el token para end_update()."""
+        if not self.enabled:
+            return None
+        return _current_update.set(_UpdateTiming())
+
+    def end_update(self, update: object, token) -> None:
+        if token is None:
+            return
+        timing = _current_update.get()
+        _current_update.reset(token)
+        if timing is None:
+            return
+        kind = update_type(update)
+        self.update_duration.observe(kind, time.perf_counter() - timing.start)
+        self.update_db.observe(kind, timing.db)
+        self.update_api.observe(kind, timing.api)
+
+    def record_db(self, function: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        self.db_duration.observe(function, seconds)
+        timing = _current_update.get()
+        if timing is not None:
+            timing.db += seconds
+
+    def record_api(self, method: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        self.api_duration.observe(method, seconds)
+        timing = _current_update.get()
+        if timing is not None:
+            timing.api += seconds
+
+    # --- Instrumentación de Handlers ---
+    def timed_callback(self, callback, label: str, conversation: str | None = None, state_names: dict | None = None):
+        """Envuelve un callback de handler para medir su duración, sus errores y (en conversaciones) el estado devuelto."""
+        if getattr(callback, "_metrics_label", None) is not None:
+            return callback # Ya instrumentado
+
+        @functools.wraps(callback)
+        async def timed(update, context):
+            start = time.perf_counter()
+            try:
+                result = await callback(update, context)
+            except Exception as e:
+                if not _is_benign_error(e):
+                    self.handler_errors.inc(label)
+                    if isinstance(update, Update) and update.callback_query is not None:
+                        self.callback_errors.inc(callback_label(update.callback_query.data))
+                raise
+            finally:
+                self.handler_duration.observe(label, time.perf_counter() - start)
+            if conversation is not None and result is not None:
+                self.transitions.inc(conversation, state_names.get(result, str(result)))
+            return result
+
+        timed._metrics_label = label
+        return timed
+
+    def time_callback_route(self, handler, key: str):
+        """Para callback_handlers.wrap_callback_routes(): una serie por ruta del router de botones."""
+        return self.timed_callback(handler, f"callback:{key}")
+
+    def instrument_handler(self, handler, conversation: ConversationHandler | None = None, state_names: dict | None = None) -> None:
+        if isinstance(handler, ConversationHandler):
+            names = _state_names(handler)
+            nested = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                nested.extend(state_handlers)
+            for child in nested:
+                self.instrument_handler(child, handler, names)
+            return
+        callback = getattr(handler, "callback", None)
+        if callback is None:
+            return
+        name = getattr(callback, "__name__", type(handler).__name__)
+        if conversation is not None:
+            handler.callback = self.timed_callback(callback, f"{conversation.name}:{name}", conversation.name, state_names)
+        else:
+            handler.callback = self.timed_callback(callback, name)
+
+    def instrument_application(self, application) -> None:
+        """Instrumenta todos los handlers registrados (incluidos los de dentro de cada conversación)."""
+        if not self.enabled:
+            logger.info("Métricas de rendimiento desactivadas (METRICS_ENABLED=false).")
+            return
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                self.instrument_handler(handler)
+
+    # --- Consulta ---
+    def render_prometheus(self) -> str:
+        """Todas las métricas en el formato de texto de Prometheus (0.0.4)."""
+        lines = []
+        for family in (self.update_duration, self.update_db, self.update_api, self.handler_duration, self.db_duration, self.api_duration):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} histogram")
+            for label_value, histogram in sorted(family.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else format(bound, "g")
+                    lines.append(f"{family.name}_bucket{_format_labels((family.label, 'le'), (label_value, le))} {cumulative}")
+                labels = _format_labels((family.label,), (label_value,))
+                lines.append(f"{family.name}_sum{labels} {histogram.sum:.6f}")
+                lines.append(f"{family.name}_count{labels} {histogram.count}")
+        for family in (self.handler_errors, self.callback_errors, self.transitions):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} counter")
+            for label_values, value in sorted(family.values.items()):
+                lines.append(f"{family.name}{_format_labels(family.labels, label_values)} {value}")
+        lines.append("# HELP bot_metrics_uptime_seconds Segundos desde que se empezó a medir.")
+        lines.append("# TYPE bot_metrics_uptime_seconds gauge")
+        lines.append(f"bot_metrics_uptime_seconds {time.time() - self.started_ts:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def get_summary(self, top: int = 8) -> dict:
+        """Resumen para /perf: updates, reparto BD/API, handlers más lentos, errores y transiciones."""
+        def stats(histogram):
+            return {
+                'count': histogram.count,
+                'total_s': round(histogram.sum, 3),
+                'p50_ms': round(histogram.quantile(0.50) * 1000, 1),
+                'p95_ms': round(histogram.quantile(0.95) * 1000, 1),
+                'max_ms': round(histogram.max * 1000, 1),
+            }
+        def merged(family):
+            total = Histogram()
+            for histogram in family.histograms.values():
+                total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                total.sum += histogram.sum
+                total.count += histogram.count
+                total.max = max(total.max, histogram.max)
+            return total
+        def slowest(family, key):
+            ranked = sorted(family.histograms.items(), key=lambda item: key(item[1]), reverse=True)
+            return [(name, stats(histogram)) for name, histogram in ranked[:top]]
+
+        updates = merged(self.update_duration)
+        return {
+            'enabled': self.enabled,
+            'uptime_seconds': int(time.time() - self.started_ts),
+            'updates': stats(updates),
+            'db_seconds': round(merged(self.update_db).sum, 3),
+            'api_seconds': round(merged(self.update_api).sum, 3),
+            'handlers': slowest(self.handler_duration, lambda h: h.quantile(0.95)),
+            'db_calls': slowest(self.db_duration, lambda h: h.sum),
+            'api_calls': slowest(self.api_duration, lambda h: h.sum),
+            'handler_errors': [(labels[0], count) for labels, count in self.handler_errors.values.most_common(top)],
+            'callback_errors': [(labels[0], count) for labels, count in self.callback_errors.values.most_common(top)],
+            'transitions': [(f"{labels[0]} → {labels[1]}", count) for labels, count in self.transitions.values.most_common(top)],
+        }
+
+    # --- Endpoint HTTP /metrics ---
+    async def start_server(self, listen: str = METRICS_LISTEN, port: int = METRICS_PORT) -> None:
+        """Servidor HTTP mínimo (asyncio, sin dependencias) con GET /metrics, en el mismo event loop que el bot."""
+        if not self.enabled or port <= 0 or self._server is not None:
+            return
+        try:
+            self._server = await asyncio.start_server(self._handle_http, listen, port)
+        except OSError as e:
+            logger.warning(f"No se pudo abrir el endpoint de métricas en {listen}:{port}: {e}")
+            return
+        logger.info(f"Métricas disponibles en http://{listen}:{port}{METRICS_PATH}")
+
+    async def stop_server(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), _HTTP_TIMEOUT_SECONDS)
+            while (await asyncio.wait_for(reader.readline(), _HTTP_TIMEOUT_SECONDS)) not in (b"\r\n", b"\n", b""):
+                pass # Cabeceras: no se usan
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == METRICS_PATH:
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.render_prometheus().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+# Nombres legibles de los estados de cada conversación: {nombre de la conversación: {estado: nombre}}
+CONVERSATION_STATE_NAMES = {}
+
+def register_state_names(conversation: str, **states: int) -> None:
+    """
+    Declara los nombres de los estados de una conversación, junto a sus constantes:
+    register_state_names("add_user", GET_USER_ID=GET_USER_ID, ...). Así las transiciones de /perf
+    y /metrics no aparecen como números.
+    """
+    names = CONVERSATION_STATE_NAMES.setdefault(conversation, {})
+    for name, value in states.items():
+        if names.get(value, name) != name:
+            raise ValueError(f"Estado {value} de '{conversation}' con dos nombres: {names[value]} y {name}.")
+        names[value] = name
+
+def _state_names(conversation: ConversationHandler) -> dict:
+    """Nombres de los estados de una conversación según register_state_names (más END y TIMEOUT)."""
+    names = {ConversationHandler.END: "END", ConversationHandler.TIMEOUT: "TIMEOUT"}
+    names.update(CONVERSATION_STATE_NAMES.get(conversation.name, {}))
+    unnamed = [state for state in conversation.states if state not in names]
+    if unnamed:
+        logger.warning(f"Conversación '{conversation.name}' con estados sin nombre en las métricas: {unnamed}.")
+    return names
+
+bot_metrics = BotMetrics()
@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import time
+from typing import NamedTuple
+
+import telegram
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+import async_db as adb
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración de la Persistencia ---
+PERSISTENCE_FLUSH_SECONDS = float(os.getenv("PERSISTENCE_FLUSH_SECONDS", "10")) # Cada cuánto se guardan los cambios pendientes
+PERSISTENCE_TTL_SECONDS = int(os.getenv("PERSISTENCE_TTL_SECONDS", "86400")) # Conversaciones y user_data sin actividad caducan tras este tiempo
+PERSISTENCE_EXPIRY_INTERVAL_SECONDS = int(os.getenv("PERSISTENCE_EXPIRY_INTERVAL_SECONDS", "900")) # Cada cuánto se purgan los caducados
+# Claves de user_data que solo viven en memoria: cargas de un paso (el backup parseado completo, los perfiles
+# que se van introduciendo) que no merece la pena reescribir en cada volcado. Tras un reinicio faltan y su
+# handler pide empezar de nuevo. El resto de claves debe ser JSON sin pérdida: el JSON no distingue tuplas
+# de listas, así que se guardan listas (como remember_prompt).
+TRANSIENT_USER_DATA_KEYS = frozenset({'parsed_accounts', 'profiles_to_add'})
+
+def _to_json(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+def persistent_conversations(application) -> list:
+    """ConversationHandler con persistent=True registrados en la Application (también los anidados)."""
+    found = []
+    pending = [handler for handlers in application.handlers.values() for handler in handlers]
+    while pending:
+        handler = pending.pop()
+        if isinstance(handler, ConversationHandler):
+            if handler.persistent and handler.name:
+                found.append(handler)
+            pending.extend(child for state_handlers in handler.states.values() for child in state_handlers)
+    return found
+
+# --- Internos de ConversationHandler ---
+# PTB no ofrece API pública para recorrer las conversaciones activas, terminarlas desde fuera de sus
+# handlers ni registrar un timeout propio. Todo acceso a esos atributos privados pasa por
+# conversation_internals, que falla con un error claro si una versión de PTB los cambia
+# (requirements.txt fija la versión mayor compatible).
+class ConversationInternals(NamedTuple):
+    conversations: dict   # clave -> estado (ConversationHandler._conversations)
+    timeout_jobs: dict    # clave -> Job del conversation_timeout
+    update_state: object  # update_state(nuevo_estado, clave) (ConversationHandler._update_state)
+
+def conversation_internals(handler: ConversationHandler) -> ConversationInternals:
+    """Atributos internos de un ConversationHandler que usa SQLitePersistence. Lanza RuntimeError si faltan."""
+    conversations = getattr(handler, '_conversations', None)
+    timeout_jobs = getattr(handler, 'timeout_jobs', None)
+    update_state = getattr(handler, '_update_state', None)
+    if not hasattr(conversations, 'keys') or not isinstance(timeout_jobs, dict) or not callable(update_state):
+        raise RuntimeError(
+            f"python-telegram-bot {telegram.__version__} no es compatible con SQLitePersistence: ConversationHandler "
+            f"'{handler.name}' no tiene _conversations, timeout_jobs o _update_state (probado con 22.x)."
+        )
+    return ConversationInternals(conversations, timeout_jobs, update_state)
+
+def conversation_ids(handler: ConversationHandler, key: tuple) -> tuple:
+    """(chat_id, user_id) de una clave de conversación según per_chat/per_user (None si no forma parte de ella)."""
+    ids = iter(key)
+    chat_id = next(ids) if handler.per_chat else None
+    user_id = next(ids) if handler.per_user else None
+    return chat_id, user_id
+
+# --- Persistencia en SQLite ---
+class SQLitePersistence(BasePersistence):
+    """
+    Persistencia de PTB sobre el mismo archivo SQLite del bot (tablas conversation_states y user_data_store).
+    - Solo se guarda user_data y el estado de los ConversationHandler con persistent=True.
+    - Cada clave de user_data es una fila JSON: en cada volcado se escriben solo las claves que cambiaron
+      respecto a lo último guardado, en vez de serializar el diccionario completo. Las claves de
+      TRANSIENT_USER_DATA_KEYS no se guardan.
+    - Las conversaciones y el user_data sin actividad durante PERSISTENCE_TTL_SECONDS no se cargan al
+      arrancar y se purgan periódicamente, también de la memoria de la Application: una conversación
+      caducada (o de un usuario caducado) se termina en su ConversationHandler, no solo en la BD.
+    - Las conversaciones restauradas al arrancar reciben su conversation_timeout (PTB solo lo programa al
+      atender un update), descontando el tiempo que ya llevaban inactivas.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_FLUSH_SECONDS, ttl_seconds: int = PERSISTENCE_TTL_SECONDS):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.ttl_seconds = ttl_seconds
+        self._written = {}       # user_id -> {clave: JSON ya guardado}
+        self._last_seen = {}     # user_id -> timestamp de su último update
+        self._conversation_ts = {}  # (nombre, clave) -> timestamp del último cambio de estado
+        self.saved_keys_count = 0
+        self.expired_users_count = 0
+        self.expired_rows_count = 0
+        self.expired_conversations_count = 0
+
+    def _min_updated_ts(self) -> int:
+        return int(time.time() - self.ttl_seconds)
+
+    # --- user_data ---
+    async def get_user_data(self) -> dict:
+        data = {}
+        for user_id, key, value in await adb.load_user_data_db(self._min_updated_ts()):
+            if key in TRANSIENT_USER_DATA_KEYS:
+                # Guardada por una versión anterior: no se carga y el siguiente volcado del usuario la borra
+                self._written.setdefault(user_id, {})[key] = value
+                continue
+            try:
+                data.setdefault(user_id, {})[key] = json.loads(value)
+            except ValueError:
+                logger.warning(f"user_data['{key}'] del usuario {user_id} no es JSON válido; se ignora.")
+                continue
+            self._written.setdefault(user_id, {})[key] = value
+        now = time.time()
+        for user_id in data:
+            self._last_seen[user_id] = now
+        if data:
+            logger.info(f"Persistencia: user_data recuperado para {len(data)} usuarios.")
+        return data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        written = self._written.get(user_id, {})
+        current = {}
+        for key, value in data.items():
+            if key in TRANSIENT_USER_DATA_KEYS:
+                continue
+            try:
+                current[str(key)] = _to_json(value)
+            except (TypeError, ValueError):
+                logger.warning(f"user_data['{key}'] del usuario {user_id} no es serializable a JSON; no se persiste.")
+        if not current and not written:
+            return # Usuario sin datos de conversación: nada que guardar
+        changed = {key: value for key, value in current.items() if written.get(key) != value}
+        removed = [key for key in written if key not in current]
+        if await adb.save_user_data_db(user_id, changed, removed, int(time.time())):
+            self.saved_keys_count += len(changed) + len(removed)
+            if current:
+                self._written[user_id] = current
+            else:
+                self._written.pop(user_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        # PTB lo llama antes de cada update del usuario: sirve para medir la actividad
+        self._last_seen[user_id] = time.time()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._written.pop(user_id, None)
+        self._last_seen.pop(user_id, None)
+        await adb.delete_user_data_db(user_id)
+
+    # --- Conversaciones ---
+    async def get_conversations(self, name: str) -> dict:
+        conversations = {}
+        for conv_key, state, updated_ts in await adb.load_conversation_states_db(name, self._min_updated_ts()):
+            try:
+                key = tuple(json.loads(conv_key))
+                conversations[key] = json.loads(state)
+            except ValueError:
+                logger.warning(f"Estado de conversación '{name}' inválido para {conv_key}; se ignora.")
+                continue
+            self._conversation_ts[(name, key)] = updated_ts
+        if conversations:
+            logger.info(f"Persistencia: {len(conversations)} conversaciones '{name}' recuperadas.")
+        return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        state = None if new_state is None else _to_json(new_state)
+        now = int(time.time())
+        if new_state is None:
+            self._conversation_ts.pop((name, key), None)
+        else:
+            self._conversation_ts[(name, key)] = now
+        await adb.save_conversation_state_db(name, _to_json(list(key)), state, now)
+
+    async def end_conversation(self, application, handler: ConversationHandler, key: tuple, notify: bool) -> None:
+        """
+        Termina una conversación sin un update suyo: cancela su timeout, ejecuta la limpieza de su estado
+        TIMEOUT (build_timeout_handlers) y la pasa a END. La clave queda marcada en el ConversationHandler,
+        así que el siguiente volcado borra su fila con la misma clave con la que se guardó.
+        """
+        internals = conversation_internals(handler)
+        job = internals.timeout_jobs.pop(key, None)
+        if job is not None:
+            job.schedule_removal()
+        chat_id, user_id = conversation_ids(handler, key)
+        context = application.context_types.context(application, chat_id=chat_id, user_id=user_id)
+        for timeout_handler in handler.states.get(ConversationHandler.TIMEOUT, []):
+            abandon = getattr(timeout_handler.callback, "abandon", None)
+            if abandon is not None:
+                await abandon(context, chat_id, user_id, notify)
+        internals.update_state(ConversationHandler.END, key)
+
+    # --- Datos no persistidos (chat_data, bot_data, callback_data) ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass # Cada update_* ya se escribe en su propia transacción
+
+    # --- Caducidad ---
+    async def expire_stale(self, context) -> None:
+        """
+        Job periódico: termina las conversaciones caducadas (sin cambios de estado en el TTL o de usuarios
+        inactivos), libera de memoria el user_data de usuarios inactivos y purga las filas caducadas.
+        """
+        now = time.time()
+        cutoff = now - self.ttl_seconds
+        application = context.application
+        stale_users = [user_id for user_id in list(application.user_data) if self._last_seen.setdefault(user_id, now) < cutoff]
+        stale_set = set(stale_users)
+        ended = 0
+        for handler in persistent_conversations(application):
+            for key in list(conversation_internals(handler).conversations):
+                _chat_id, user_id = conversation_ids(handler, key)
+                if user_id in stale_set or self._conversation_ts.get((handler.name, key), now) < cutoff:
+                    await self.end_conversation(application, handler, key, notify=False)
+                    ended += 1
+        for user_id in stale_users:
+            application.drop_user_data(user_id) # Se borra también de la BD en el siguiente volcado
+            self._last_seen.pop(user_id, None)
+        purged = await adb.purge_stale_persistence_db(int(cutoff))
+        self.expired_users_count += len(stale_users)
+        self.expired_rows_count += purged['conversations'] + purged['user_data']
+        self.expired_conversations_count += ended
+        if stale_users or ended or purged['conversations'] or purged['user_data']:
+            logger.info(
+                f"Persistencia: {len(stale_users)} usuarios inactivos liberados de memoria y {ended} conversaciones "
+                f"terminadas; purgadas {purged['conversations']} conversaciones y {purged['user_data']} claves de user_data caducadas."
+            )
+
+    # --- Timeouts de las Conversaciones Restauradas ---
+    async def schedule_restored_timeouts(self, context) -> None:
+        """Job de arranque: programa el conversation_timeout de cada conversación restaurada que siga sin atender."""
+        application = context.application
+        now = time.time()
+        scheduled = 0
+        for handler in persistent_conversations(application):
+            timeout = handler.conversation_timeout
+            if not timeout:
+                continue
+            timeout = timeout.total_seconds() if hasattr(timeout, "total_seconds") else timeout
+            internals = conversation_internals(handler)
+            for key in list(internals.conversations):
+                if key in internals.timeout_jobs:
+                    continue # Ya tuvo un update tras el arranque: PTB programó su timeout
+                updated_ts = self._conversation_ts.get((handler.name, key), now)
+                # Registrado en timeout_jobs: si llega un update, PTB lo cancela y programa el suyo
+                internals.timeout_jobs[key] = application.job_queue.run_once(
+                    self._restored_timeout, max(0.0, updated_ts + timeout - now),
+                    data=(handler, key), name=f"restored_timeout_{handler.name}",
+                )
+                scheduled += 1
+        if scheduled:
+            logger.info(f"Persistencia: programado el timeout de {scheduled} conversaciones restauradas.")
+
+    async def _restored_timeout(self, context) -> None:
+        handler, key = context.job.data
+        timeout_jobs = conversation_internals(handler).timeout_jobs
+        if timeout_jobs.get(key) is not context.job:
+            return # El usuario siguió la conversación y PTB sustituyó este timeout por el suyo
+        del timeout_jobs[key]
+        await self.end_conversation(context.application, handler, key, notify=True)
+
+    def start(self, job_queue) -> None:
+        """
+        Registra el job de caducidad y el que programa el timeout de las conversaciones restauradas.
+        Comprueba antes los internos de cada ConversationHandler persistente: con una versión de PTB
+        incompatible el bot no arranca, en vez de fallar más tarde dentro de un job.
+        """
+        for handler in persistent_conversations(job_queue.application):
+            conversation_internals(handler)
+        job_queue.run_once(self.schedule_restored_timeouts, 0, name="persistence_restored_timeouts")
+        job_queue.run_repeating(self.expire_stale, interval=PERSISTENCE_EXPIRY_INTERVAL_SECONDS, first=PERSISTENCE_EXPIRY_INTERVAL_SECONDS, name="persistence_expiry")
+
+    def get_stats(self) -> dict:
+        return {
+            'tracked_users': len(self._written),
+            'active_users': len(self._last_seen),
+            'saved_keys': self.saved_keys_count,
+            'expired_users': self.expired_users_count,
+            'expired_rows': self.expired_rows_count,
+            'expired_conversations': self.expired_conversations_count,
+        }
+
+sqlite_persistence = SQLitePersistence()
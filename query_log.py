@@ -0,0 +1,264 @@
+import functools
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del Registro de Consultas ---
+DB_QUERY_STATS_ENABLED = os.getenv("DB_QUERY_STATS_ENABLED", "true").lower() in ("1", "true", "yes")
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100")) # Sentencias más lentas que esto se registran en el log
+_MAX_STATEMENTS = 1000 # Sentencias distintas con estadísticas; el resto se agrupa en una entrada común
+_RECENT_SLOW = 50 # Ejecuciones lentas recientes guardadas para /slowqueries
+_MAX_SHAPE_ITEMS = 12
+_PLANNED_STATEMENTS = ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT", "REPLACE") # Las que admiten EXPLAIN QUERY PLAN
+_OTHER_STATEMENTS = "(otras sentencias)"
+
+_COMMENT_RE = re.compile(r"--[^\n]*")
+_WHITESPACE_RE = re.compile(r"\s+")
+_SCAN_RE = re.compile(r"^SCAN (\S+)(.*)$")
+
+# --- Normalización ---
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    """Texto de la sentencia sin comentarios ni saltos de línea (clave de las estadísticas)."""
+    return _WHITESPACE_RE.sub(" ", _COMMENT_RE.sub("", sql)).strip().rstrip(";")
+
+def parameter_shape(parameters) -> str:
+    """Tipos de los parámetros, nunca sus valores (pueden ser emails o PINs): '(int, str, NoneType)'."""
+    if parameters is None:
+        return "()"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        types = [type(value).__name__ for value in parameters]
+        if len(types) > _MAX_SHAPE_ITEMS:
+            return f"({', '.join(types[:_MAX_SHAPE_ITEMS])}, … {len(types)} en total)"
+        return "(" + ", ".join(types) + ")"
+    return type(parameters).__name__
+
+def full_scans(plan: list) -> list:
+    """Tablas recorridas enteras (SCAN sin índice) según las filas 'detail' de EXPLAIN QUERY PLAN."""
+    tables = []
+    for detail in plan:
+        match = _SCAN_RE.match(detail)
+        if match and match.group(1) != "CONSTANT" and not match.group(1).startswith("(") and "USING" not in match.group(2):
+            tables.append(match.group(1))
+    return tables
+
+# --- Estadísticas por Sentencia ---
+class StatementStats:
+    """Acumulado de una sentencia normalizada (tiempo de execute más el de sus fetch*)."""
+
+    __slots__ = ("sql", "count", "total", "max", "slow_count", "plan", "full_scans")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow_count = 0
+        self.plan = None       # Se captura en la primera ejecución lenta
+        self.full_scans = []
+
+class QueryStats:
+    """
+    Estadísticas de todas las sentencias ejecutadas por las conexiones del pool (pueden venir de
+    varios hilos del ejecutor de BD, de ahí el lock). Cada ejecución que supera DB_SLOW_QUERY_MS se
+    registra en el log con la forma de sus parámetros; la primera de cada sentencia captura además
+    su EXPLAIN QUERY PLAN y avisa si recorre alguna tabla completa.
+    """
+
+    def __init__(self, slow_threshold_ms: float = DB_SLOW_QUERY_MS):
+        self.slow_threshold = slow_threshold_ms / 1000
+        self._statements = {}  # sql normalizado -> StatementStats
+        self._recent_slow = deque(maxlen=_RECENT_SLOW)
+        self._lock = threading.Lock()
+        self.started_ts = time.time()
+
+    def _entry(self, sql: str) -> StatementStats:
+        key = normalize_sql(sql)
+        entry = self._statements.get(key)
+        if entry is None:
+            with self._lock:
+                if len(self._statements) >= _MAX_STATEMENTS:
+                    key = _OTHER_STATEMENTS
+                entry = self._statements.setdefault(key, StatementStats(key))
+        return entry
+
+    # --- Registro (llamado por InstrumentedCursor) ---
+    def record_execute(self, cursor, sql: str, parameters, elapsed: float, shape: str | None = None) -> None:
+        entry = self._entry(sql)
+        cursor._query_entry = entry
+        cursor._query_parameters = parameters
+        cursor._query_shape = shape
+        cursor._query_elapsed = elapsed
+        cursor._query_reported = False
+        with self._lock:
+            entry.count += 1
+            entry.total += elapsed
+            if elapsed > entry.max:
+                entry.max = elapsed
+        if elapsed >= self.slow_threshold:
+            self._report_slow(cursor)
+
+    def record_fetch(self, cursor, elapsed: float) -> None:
+        entry = cursor._query_entry
+        if entry is None:
+            return
+        cursor._query_elapsed += elapsed
+        with self._lock:
+            entry.total += elapsed
+            if cursor._query_elapsed > entry.max:
+                entry.max = cursor._query_elapsed
+        if not cursor._query_reported and cursor._query_elapsed >= self.slow_threshold:
+            self._report_slow(cursor)
+
+    def _report_slow(self, cursor) -> None:
+        cursor._query_reported = True
+        entry = cursor._query_entry
+        shape = cursor._query_shape or parameter_shape(cursor._query_parameters)
+        elapsed_ms = cursor._query_elapsed * 1000
+        with self._lock:
+            entry.slow_count += 1
+            capture_plan = entry.plan is None
+            if capture_plan:
+                entry.plan = [] # Marcar ya: otra ejecución lenta concurrente no la repite
+            self._recent_slow.append((int(time.time()), entry.sql, round(elapsed_ms, 1), shape))
+        logger.warning(f"🐢 Consulta lenta ({elapsed_ms:.1f} ms, parámetros {shape}): {entry.sql}")
+        if capture_plan:
+            plan = self._explain(cursor.connection, entry.sql, cursor._query_parameters)
+            scans = full_scans(plan)
+            with self._lock:
+                entry.plan = plan
+                entry.full_scans = scans
+            if scans:
+                logger.warning(f"⚠️ Recorrido completo de {', '.join(scans)} en: {entry.sql} | plan: {' / '.join(plan)}")
+            elif plan:
+                logger.info(f"Plan de la consulta lenta: {' / '.join(plan)}")
+
+    @staticmethod
+    def _explain(conn, sql: str, parameters) -> list:
+        """EXPLAIN QUERY PLAN en la misma conexión (no ejecuta la sentencia). Los valores solo se usan para enlazar."""
+        if not sql.upper().startswith(_PLANNED_STATEMENTS):
+            return []
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters if parameters is not None else ()).fetchall()
+        except sqlite3.Error as e:
+            logger.debug(f"No se pudo obtener el plan de '{sql}': {e}")
+            return []
+        return [row[-1] for row in rows]
+
+    # --- Consulta ---
+    def get_stats(self, top: int = 10, order_by: str = 'total') -> list:
+        """Sentencias con más tiempo acumulado ('total'), más lentas ('max') o más ejecutadas ('count')."""
+        with self._lock:
+            entries = sorted(self._statements.values(), key=lambda e: getattr(e, order_by), reverse=True)[:top]
+            return [
+                {
+                    'sql': e.sql,
+                    'count': e.count,
+                    'total_ms': round(e.total * 1000, 1),
+                    'avg_ms': round(e.total / e.count * 1000, 2) if e.count else 0.0,
+                    'max_ms': round(e.max * 1000, 2),
+                    'slow': e.slow_count,
+                    'plan': list(e.plan) if e.plan else [],
+                    'full_scans': list(e.full_scans),
+                }
+                for e in entries
+            ]
+
+    def get_recent_slow(self) -> list:
+        """Últimas ejecuciones lentas: (timestamp, sql, ms, forma de los parámetros)."""
+        with self._lock:
+            return list(self._recent_slow)
+
+    def get_summary(self) -> dict:
+        with self._lock:
+            return {
+                'statements': len(self._statements),
+                'executions': sum(e.count for e in self._statements.values()),
+                'total_ms': round(sum(e.total for e in self._statements.values()) * 1000, 1),
+                'slow': sum(e.slow_count for e in self._statements.values()),
+                'threshold_ms': self.slow_threshold * 1000,
+                'since_ts': int(self.started_ts),
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._statements.clear()
+            self._recent_slow.clear()
+            self.started_ts = time.time()
+
+query_stats = QueryStats()
+
+# --- Conexión y Cursor Instrumentados ---
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor que mide execute/executemany y los fetch* posteriores de cada sentencia."""
+
+    _query_entry = None
+    _query_parameters = None
+    _query_shape = None
+    _query_elapsed = 0.0
+    _query_reported = False
+
+    def execute(self, sql, parameters=(), /):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_stats.record_execute(self, sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        if isinstance(seq_of_parameters, (list, tuple)):
+            first = seq_of_parameters[0] if seq_of_parameters else None
+            shape = f"{len(seq_of_parameters)} × {parameter_shape(first)}"
+        else:
+            first, shape = None, "iterable" # Un generador no se puede inspeccionar sin consumirlo
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            query_stats.record_execute(self, sql, first, time.perf_counter() - start, shape)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            query_stats.record_fetch(self, time.perf_counter() - start)
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args, **kwargs)
+        finally:
+            query_stats.record_fetch(self, time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            query_stats.record_fetch(self, time.perf_counter() - start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Conexión cuyos cursores (también los de conn.execute/executemany) son InstrumentedCursor."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute ejecuta en C sin pasar por Cursor.execute: se redirigen al cursor
+    def execute(self, sql, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def connection_factory():
+    """Clase de conexión para sqlite3.connect(factory=...): instrumentada salvo con DB_QUERY_STATS_ENABLED=false."""
+    return InstrumentedConnection if DB_QUERY_STATS_ENABLED else sqlite3.Connection
@@ -0,0 +1,210 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import bot_metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del Limitador de Envíos ---
+# Límites documentados por Telegram: ~30 mensajes/s en total, ~1 mensaje/s por chat privado
+# y ~20 mensajes/min por grupo. Los buckets admiten una pequeña ráfaga inicial.
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "30"))
+RATE_LIMIT_PRIVATE_PER_SECOND = float(os.getenv("RATE_LIMIT_PRIVATE_PER_SECOND", "1"))
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.getenv("RATE_LIMIT_GROUP_PER_MINUTE", "20"))
+RATE_LIMIT_CHAT_BURST = int(os.getenv("RATE_LIMIT_CHAT_BURST", "3"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3")) # Reintentos tras un 429 (RetryAfter)
+
+# Prioridades: menor número = se atiende antes
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# Métodos que consumen el presupuesto del chat (los borrados y answerCallbackQuery no cuentan)
+CHAT_LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+BACKGROUND_ENDPOINTS = {"deleteMessage", "deleteMessages"}
+
+_IDLE_BUCKET_SECONDS = 60 # Buckets de chat sin uso durante este tiempo se descartan
+_MAX_CHAT_BUCKETS = 10000
+
+# --- Token Bucket ---
+class TokenBucket:
+    """Token bucket clásico: 'rate' fichas por segundo con una capacidad (ráfaga) de 'capacity'."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Segundos que faltan para poder tomar una ficha (0 si ya hay una disponible)."""
+        now = time.monotonic()
+        self._refill(now)
+        pause = self.paused_until - now
+        if self.tokens >= 1:
+            return max(pause, 0.0)
+        return max(pause, (1 - self.tokens) / self.rate)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Bloquea el bucket 'seconds' segundos (p. ej. tras un RetryAfter) y vacía la ráfaga."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def is_idle(self, now: float) -> bool:
+        return now - self.updated > _IDLE_BUCKET_SECONDS and now >= self.paused_until
+
+# --- Limitador de Envíos ---
+class SendRateLimiter(BaseRateLimiter[dict]):
+    """
+    Limitador de las llamadas salientes a la Bot API (se registra con Application.builder().rate_limiter()).
+    Cada petición espera primero al bucket de su chat y después al bucket global, que se reparte por
+    prioridad: las respuestas interactivas pasan antes que los borrados automáticos. Un 429 pausa el
+    bucket afectado el tiempo indicado por 'retry_after' y la petición se reintenta, en vez de perderse.
+    Los handlers pueden forzar la prioridad con rate_limit_args={'priority': PRIORITY_BACKGROUND}.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(RATE_LIMIT_GLOBAL_PER_SECOND, max(1.0, RATE_LIMIT_GLOBAL_PER_SECOND))
+        self._chats = {}         # chat_id -> TokenBucket
+        self._waiters = []       # min-heap de (prioridad, secuencia) esperando al bucket global
+        self._sequence = itertools.count()
+        self._condition = None   # asyncio.Condition, se crea en initialize() dentro del event loop
+        self._chat_waiting = 0
+        self.sent_count = 0
+        self.retry_count = 0
+        self.failed_count = 0
+        self.throttled_seconds = 0.0
+        self.max_queue_depth = 0
+
+    async def initialize(self) -> None:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+    async def shutdown(self) -> None:
+        pass
+
+    # --- Buckets ---
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_CHAT_BUCKETS:
+                self._prune_chat_buckets()
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(RATE_LIMIT_PRIVATE_PER_SECOND, RATE_LIMIT_CHAT_BURST)
+            else:
+                bucket = TokenBucket(RATE_LIMIT_GROUP_PER_MINUTE / 60, RATE_LIMIT_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _prune_chat_buckets(self) -> None:
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chats.items() if b.is_idle(now)]:
+            del self._chats[chat_id]
+
+    async def _acquire_chat(self, bucket: TokenBucket) -> None:
+        self._chat_waiting += 1
+        try:
+            while (wait := bucket.wait_time()) > 0:
+                self.throttled_seconds += wait
+                await asyncio.sleep(wait)
+            bucket.take()
+        finally:
+            self._chat_waiting -= 1
+
+    async def _acquire_global(self, priority: int) -> None:
+        """Espera turno (por prioridad y orden de llegada) y una ficha del bucket global."""
+        entry = (priority, next(self._sequence))
+        async with self._condition:
+            heapq.heappush(self._waiters, entry)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+            try:
+                while True:
+                    if self._waiters[0] == entry:
+                        wait = self._global.wait_time()
+                        if wait <= 0:
+                            self._global.take()
+                            return
+                        self.throttled_seconds += wait
+                        try:
+                            await asyncio.wait_for(self._condition.wait(), timeout=wait)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await self._condition.wait()
+            finally:
+                # Salir de la cola (también si la petición se cancela) y despertar al siguiente
+                if self._waiters and self._waiters[0] == entry:
+                    heapq.heappop(self._waiters)
+                else:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    # --- Procesado de Peticiones ---
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        rate_limit_args = rate_limit_args or {}
+        priority = rate_limit_args.get(
+            'priority', PRIORITY_BACKGROUND if endpoint in BACKGROUND_ENDPOINTS else PRIORITY_INTERACTIVE
+        )
+        chat_id = data.get('chat_id')
+        chat_bucket = None
+        if chat_id is not None and endpoint.startswith(CHAT_LIMITED_PREFIXES):
+            chat_bucket = self._chat_bucket(chat_id)
+        max_retries = rate_limit_args.get('max_retries', RATE_LIMIT_MAX_RETRIES)
+
+        for attempt in range(max_retries + 1):
+            if chat_bucket is not None:
+                await self._acquire_chat(chat_bucket)
+            await self._acquire_global(priority)
+            start = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent_count += 1
+                return result
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                # Un 429 en un chat concreto solo frena ese chat; sin chat, se frena todo
+                (chat_bucket or self._global).pause(retry_after)
+                if attempt >= max_retries:
+                    self.failed_count += 1
+                    logger.error(f"❌ {endpoint} descartado tras {attempt + 1} intentos por flood-wait (chat {chat_id}).")
+                    raise
+                self.retry_count += 1
+                logger.warning(f"⏳ Telegram pidió esperar {retry_after:.0f}s en {endpoint} (chat {chat_id}); reintento {attempt + 1}/{max_retries}.")
+            finally:
+                # Solo la llamada HTTP: la espera por los buckets ya se contabiliza en throttled_seconds
+                bot_metrics.record_api(endpoint, time.perf_counter() - start)
+
+    # --- Diagnóstico ---
+    def queue_depth(self) -> int:
+        """Peticiones esperando turno (bucket global + buckets de chat)."""
+        return len(self._waiters) + self._chat_waiting
+
+    def get_stats(self) -> dict:
+        return {
+            'queue_depth': self.queue_depth(),
+            'max_queue_depth': self.max_queue_depth,
+            'sent': self.sent_count,
+            'retries': self.retry_count,
+            'failed': self.failed_count,
+            'throttled_seconds': round(self.throttled_seconds, 1),
+            'chat_buckets': len(self._chats),
+        }
+
+send_rate_limiter = SendRateLimiter()
@@ -5,7 +5,7 @@ from datetime import datetime, timedelta
 from dotenv import load_dotenv
 # Import escape_markdown
 from telegram.helpers import escape_markdown
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputFile
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
 # Completed the import block for telegram.ext
 from telegram.ext import (
     Application,
@@ -17,6 +17,9 @@ from telegram.ext import (
     ContextTypes,
     JobQueue,
 )
+from backups import snapshot_file, send_document_from_memory
+from rate_limiter import send_rate_limiter
+from webhook_server import run_application
 
 # --- Configuration ---
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -1015,9 +1018,9 @@ async def backup_data_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         try:
             # Escape filename for caption
             filename_escaped = escape_markdown(os.path.basename(DATA_FILE), version=2)
-            await context.bot.send_document(
-                chat_id=chat_id,
-                document=InputFile(DATA_FILE),
+            # In-memory snapshot: sends the file contents (not its path string) with a single read
+            await send_document_from_memory(
+                context.bot, chat_id, snapshot_file(DATA_FILE), os.path.basename(DATA_FILE),
                 caption=f"Backup de cuentas \\({filename_escaped}\\) al {escape_markdown(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), version=2)}" # Escape filename and date
             )
             logger.info(f"Backup de cuentas enviado a {chat_id}")
@@ -1037,9 +1040,9 @@ async def backup_data_callback(update: Update, context: ContextTypes.DEFAULT_TYP
          try:
             # Escape filename for caption
             filename_escaped = escape_markdown(os.path.basename(REG_DATA_FILE), version=2)
-            await context.bot.send_document(
-                chat_id=chat_id,
-                document=InputFile(REG_DATA_FILE),
+            # In-memory snapshot: sends the file contents (not its path string) with a single read
+            await send_document_from_memory(
+                context.bot, chat_id, snapshot_file(REG_DATA_FILE), os.path.basename(REG_DATA_FILE),
                 caption=f"Backup de registros \\({filename_escaped}\\) al {escape_markdown(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), version=2)}" # Escape filename and date
             )
             logger.info(f"Backup de registros enviado a {chat_id}")
@@ -1247,7 +1250,7 @@ delete_reg_conv_handler = ConversationHandler(
 def main() -> None:
     """Start the bot."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).rate_limiter(send_rate_limiter).build()
 
     # --- Add Handlers ---
     # Command Handlers
@@ -1290,8 +1293,8 @@ def main() -> None:
     job_queue.run_daily(check_license, time=datetime.strptime("03:00", "%H:%M").time()) # Check daily at 3 AM bot time
 
     # --- Start the Bot ---
-    logger.info("Starting bot polling...")
-    application.run_polling()
+    logger.info("Starting bot (polling or webhook, see BOT_RUN_MODE)...")
+    run_application(application)
 
 if __name__ == '__main__':
     # Validate essential config before starting
@@ -0,0 +1,64 @@
+"""
+Pruebas del parser de backups de /importmyaccounts (backups.py): límites que protegen la memoria del bot
+frente a archivos enviados por los usuarios.
+
+Uso (desde la raíz del repositorio):
+    python -m pytest -q tests
+"""
+import asyncio
+import gzip
+import io
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import backups # noqa: E402
+
+def build_rows(count: int) -> list:
+    return [{'service': "Netflix", 'email': f"user{i}@example.com", 'profile_name': f"Perfil {i}", 'pin': "1234"} for i in range(count)]
+
+def test_load_backup_returns_rows_and_closes_buffer():
+    buffer = backups.build_jsonl_backup(1, build_rows(3), compression="gzip")
+    backup_format, rows = asyncio.run(backups.load_backup_async(buffer))
+    assert backup_format == "gzip"
+    assert [row['profile_name'] for row in rows] == ["Perfil 0", "Perfil 1", "Perfil 2"]
+    assert buffer.closed
+
+def test_backup_over_max_rows_is_rejected():
+    text_backup = backups.build_text_backup(1, build_rows(11))
+    with pytest.raises(ValueError, match="más de 10 perfiles"):
+        backups.load_backup(text_backup, max_rows=10)
+
+    _format, rows = backups.load_backup(backups.build_text_backup(1, build_rows(10)), max_rows=10)
+    assert len(rows) == 10
+
+def test_gzip_bomb_is_rejected_by_decompressed_size():
+    # 64 MB de espacios comprimidos en unos 64 KB: el límite de descarga no los frena
+    bomb = io.BytesIO()
+    with gzip.GzipFile(fileobj=bomb, mode='wb') as writer:
+        block = b" " * 1023 + b"\n"
+        for _ in range(64 * 1024):
+            writer.write(block)
+    assert bomb.tell() < backups.BOT_API_DOWNLOAD_LIMIT
+    bomb.seek(0)
+
+    backup_format, rows = backups.parse_backup_stream(bomb, max_bytes=8 * 1024 * 1024)
+    assert backup_format == "gzip"
+    with pytest.raises(ValueError, match="descomprimido"):
+        list(rows)
+
+def test_blank_line_flood_is_capped():
+    flood = io.BytesIO(gzip.compress(b"\n" * (1024 * 1024)))
+    _format, rows = backups.parse_backup_stream(flood, max_lines=1000)
+    with pytest.raises(ValueError, match="más de 1000 líneas"):
+        list(rows)
+
+def test_unterminated_line_is_capped():
+    endless_line = io.BytesIO(gzip.compress(b'{"format": "' + b"x" * (4 * 1024 * 1024)))
+    _format, rows = backups.parse_backup_stream(endless_line, max_line_length=1024 * 1024)
+    with pytest.raises(ValueError, match="línea de más de"):
+        list(rows)
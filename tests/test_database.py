@@ -0,0 +1,53 @@
+"""
+Pruebas de database.py sobre una BD temporal: migraciones de esquema y paginación keyset de los listados.
+
+Uso (desde la raíz del repositorio):
+    python -m pytest -q tests
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database as db # noqa: E402
+
+@pytest.fixture
+def legacy_database(tmp_path):
+    """BD de una versión anterior: 'users.name' admite NULL."""
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, name TEXT, payment_method TEXT, registration_ts INTEGER, expiry_ts INTEGER)")
+    conn.executemany(
+        "INSERT INTO users VALUES (?, ?, 'N/A', 0, 4102444800)",
+        [(1, "Ana"), (2, None), (3, "bob"), (4, None), (5, "Carla")],
+    )
+    conn.commit()
+    conn.close()
+
+    db.close_db()
+    original = db.DATABASE_FILE
+    db.DATABASE_FILE = path
+    db.init_db()
+    yield path
+    db.close_db()
+    db.DATABASE_FILE = original
+
+def test_null_user_names_are_migrated_and_paged(legacy_database):
+    conn = sqlite3.connect(legacy_database)
+    assert conn.execute("SELECT COUNT(*) FROM users WHERE name IS NULL").fetchone()[0] == 0
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO users (user_id, name) VALUES (6, NULL)")
+    conn.close()
+
+    seen, cursor = [], None
+    while True:
+        page = db.list_users_db(after_user_id=cursor, limit=2)
+        if not page:
+            break
+        seen += [row['user_id'] for row in page]
+        cursor = page[-1]['user_id']
+    assert seen == [2, 4, 1, 3, 5] # Los nombres vacíos primero y sin saltarse a nadie
@@ -0,0 +1,100 @@
+"""
+Pruebas de utils.DeletionScheduler sobre una BD temporal: los borrados que fallan por un error transitorio
+se reintentan y conservan su fila en pending_deletions; los definitivos se descartan.
+
+Uso (desde la raíz del repositorio):
+    python -m pytest -q tests
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter # noqa: E402
+
+import database as db # noqa: E402
+import utils # noqa: E402
+
+CHAT_ID = 700000001
+
+@pytest.fixture(autouse=True)
+def temp_database(tmp_path):
+    db.close_db()
+    original = db.DATABASE_FILE
+    db.DATABASE_FILE = str(tmp_path / "deletions_test.db")
+    db.init_db()
+    yield
+    db.close_db()
+    db.DATABASE_FILE = original
+
+class FlakyBot:
+    """Bot simulado: cada llamada lanza el siguiente error de 'errors' (None = éxito)."""
+
+    def __init__(self, errors: list):
+        self.errors = list(errors)
+        self.deleted = []
+
+    async def delete_messages(self, chat_id, message_ids):
+        error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        self.deleted.extend(message_ids)
+
+def make_due(scheduler: utils.DeletionScheduler) -> None:
+    """Adelanta todos los borrados programados para que venzan ya."""
+    scheduler.restore([(chat_id, message_id, 0) for chat_id, message_id in list(scheduler._scheduled)])
+
+def test_transient_failure_is_retried_and_kept_in_database():
+    async def scenario():
+        scheduler = utils.DeletionScheduler()
+        scheduler.schedule(CHAT_ID, 1, 0)
+        scheduler.schedule(CHAT_ID, 2, 0)
+        await scheduler.save_pending()
+        make_due(scheduler)
+
+        bot = FlakyBot([NetworkError("sin conexión"), None])
+        assert await scheduler.flush(bot) == 0
+        assert scheduler.pending_count() == 2 # De vuelta en la cola, con espera
+        assert sorted(key[:2] for key in db.load_pending_deletions_db()) == [(CHAT_ID, 1), (CHAT_ID, 2)]
+        assert await scheduler.flush(bot) == 0 # Aún no ha pasado la espera
+
+        make_due(scheduler)
+        assert await scheduler.flush(bot) == 2
+        assert bot.deleted == [1, 2]
+        assert scheduler.pending_count() == 0
+        assert db.load_pending_deletions_db() == []
+
+    asyncio.run(scenario())
+
+def test_retry_after_sets_the_backoff():
+    async def scenario():
+        scheduler = utils.DeletionScheduler()
+        scheduler.schedule(CHAT_ID, 1, 0)
+        scheduler.schedule(CHAT_ID, 2, 0)
+        make_due(scheduler)
+        await scheduler.flush(FlakyBot([RetryAfter(600)]))
+        assert min(scheduler._scheduled.values()) >= utils.time.time() + 590
+        await scheduler.save_pending() # Vencidos antes de guardarse: vuelven a _unsaved para el reintento
+        assert len(db.load_pending_deletions_db()) == 2
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("error", [BadRequest("Message to delete not found"), Forbidden("bot was blocked by the user")])
+def test_permanent_failure_is_dropped(error):
+    async def scenario():
+        scheduler = utils.DeletionScheduler()
+        scheduler.schedule(CHAT_ID, 1, 0)
+        scheduler.schedule(CHAT_ID, 2, 0)
+        await scheduler.save_pending()
+        make_due(scheduler)
+
+        assert await scheduler.flush(FlakyBot([error])) == 2
+        assert scheduler.pending_count() == 0
+        assert scheduler.failed_count == 2
+        assert db.load_pending_deletions_db() == []
+
+    asyncio.run(scenario())
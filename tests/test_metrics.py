@@ -0,0 +1,47 @@
+"""
+Pruebas de metrics.py: nombres de los estados de las conversaciones del bot en /perf y /metrics.
+
+Uso (desde la raíz del repositorio):
+    python -m pytest -q tests
+"""
+import os
+import sys
+import warnings
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram.ext import ConversationHandler # noqa: E402
+
+import metrics # noqa: E402
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore") # PTBUserWarning de per_message al construir las conversaciones
+    import admin_handlers # noqa: E402
+    import user_handlers # noqa: E402
+
+def bot_conversations() -> list:
+    return [value for module in (user_handlers, admin_handlers) for value in vars(module).values() if isinstance(value, ConversationHandler)]
+
+def test_every_conversation_state_has_its_own_name():
+    conversations = bot_conversations()
+    assert len(conversations) == 7
+    for conversation in conversations:
+        names = metrics._state_names(conversation)
+        module = sys.modules[conversation.entry_points[0].callback.__module__]
+        for state in conversation.states:
+            assert getattr(module, names[state], state) == state, f"{conversation.name}: {state} -> {names[state]}"
+
+def test_constants_with_the_same_value_do_not_hijack_state_names():
+    # utils.DELETE_DELAY_SECONDS == CONFIRM_DELETE == 15 y ambos son visibles en user_handlers
+    delete_my_account = user_handlers.deletemyaccount_conv_handler
+    assert user_handlers.DELETE_DELAY_SECONDS == user_handlers.CONFIRM_DELETE
+    assert metrics._state_names(delete_my_account)[user_handlers.CONFIRM_DELETE] == "CONFIRM_DELETE"
+
+def test_a_state_cannot_get_two_names():
+    metrics.register_state_names("test_conversation", FIRST=1)
+    with pytest.raises(ValueError, match="dos nombres"):
+        metrics.register_state_names("test_conversation", OTHER=1)
+    del metrics.CONVERSATION_STATE_NAMES["test_conversation"]
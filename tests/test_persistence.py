@@ -0,0 +1,183 @@
+"""
+Pruebas de persistence.SQLitePersistence con una Application real de PTB y la Bot API simulada de
+benchmarks/load_test.py: conversaciones restauradas desde la BD que caducan o agotan su timeout.
+
+Uso (desde la raíz del repositorio):
+    python -m pytest -q tests
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from telegram import Update # noqa: E402
+from telegram.ext import Application, CommandHandler, ConversationHandler, MessageHandler, filters # noqa: E402
+
+import database as db # noqa: E402
+import load_test # noqa: E402
+from persistence import SQLitePersistence, conversation_internals # noqa: E402
+from utils import abandoned_flows, build_timeout_handlers # noqa: E402
+
+CONVERSATION = "test_conv"
+ASKING = 1
+USER_ID = 700000001
+KEY = (USER_ID, USER_ID) # per_chat + per_user en un chat privado
+
+@pytest.fixture(autouse=True)
+def temp_database(tmp_path):
+    db.close_db()
+    original = db.DATABASE_FILE
+    db.DATABASE_FILE = str(tmp_path / "persistence_test.db")
+    db.init_db()
+    yield
+    db.close_db()
+    db.DATABASE_FILE = original
+
+def build_app(persistence: SQLitePersistence, timeout: float | None = None) -> tuple:
+    """Application con una conversación persistente de un paso; 'reached' recoge los textos que llegan al estado ASKING."""
+    reached = []
+
+    async def start(update, context):
+        context.user_data['draft'] = "borrador"
+        return ASKING
+
+    async def answer(update, context):
+        reached.append(update.message.text)
+        return ConversationHandler.END
+
+    conversation = ConversationHandler(
+        entry_points=[CommandHandler("start", start)],
+        states={
+            ASKING: [MessageHandler(filters.TEXT & ~filters.COMMAND, answer)],
+            ConversationHandler.TIMEOUT: build_timeout_handlers(CONVERSATION, ('draft',)),
+        },
+        fallbacks=[],
+        name=CONVERSATION,
+        persistent=True,
+        conversation_timeout=timeout,
+    )
+    api = load_test.FakeBotAPI()
+    application = Application.builder().token("123456:TEST").request(api).get_updates_request(api).persistence(persistence).build()
+    application.add_handler(conversation)
+    return application, conversation, reached, api
+
+def store_conversation(age_seconds: int) -> None:
+    """Deja en la BD una conversación en el estado ASKING y su user_data, como antes de un reinicio."""
+    updated_ts = int(time.time()) - age_seconds
+    db.save_conversation_state_db(CONVERSATION, json.dumps(list(KEY)), json.dumps(ASKING), updated_ts)
+    db.save_user_data_db(USER_ID, {'draft': json.dumps("borrador")}, [], updated_ts)
+
+async def send_text(application: Application, text: str) -> None:
+    await application.process_update(Update.de_json(load_test.message_update(USER_ID, text), application.bot))
+
+def test_expired_conversation_does_not_reach_old_state():
+    async def scenario():
+        store_conversation(age_seconds=60)
+        persistence = SQLitePersistence(update_interval=3600, ttl_seconds=3600)
+        application, conversation, reached, _api = build_app(persistence)
+        await application.initialize()
+        try:
+            assert conversation_internals(conversation).conversations.get(KEY) == ASKING # Restaurada desde la BD
+
+            persistence.ttl_seconds = 30 # La conversación lleva 60 s sin cambios: caduca
+            await persistence.expire_stale(application.context_types.context(application))
+            assert KEY not in conversation_internals(conversation).conversations
+            assert 'draft' not in application.user_data.get(USER_ID, {})
+
+            await application.update_persistence()
+            assert db.load_conversation_states_db(CONVERSATION, 0) == []
+
+            await send_text(application, "respuesta tardía")
+            assert reached == []
+        finally:
+            await application.shutdown()
+
+    asyncio.run(scenario())
+
+def test_restored_conversation_times_out():
+    async def scenario():
+        store_conversation(age_seconds=5)
+        before = abandoned_flows[CONVERSATION]
+        persistence = SQLitePersistence(update_interval=3600, ttl_seconds=3600)
+        application, conversation, reached, api = build_app(persistence, timeout=1)
+        persistence.start(application.job_queue)
+        await application.initialize()
+        await application.start()
+        try:
+            for _ in range(50): # El timeout restante ya venció: el job se ejecuta nada más arrancar
+                if KEY not in conversation_internals(conversation).conversations:
+                    break
+                await asyncio.sleep(0.05)
+            assert KEY not in conversation_internals(conversation).conversations
+            assert abandoned_flows[CONVERSATION] == before + 1
+            assert 'draft' not in application.user_data.get(USER_ID, {})
+            assert api.calls['sendMessage'] == 1 # Aviso de cancelación por inactividad
+
+            await send_text(application, "respuesta tardía")
+            assert reached == []
+        finally:
+            await application.stop()
+            await application.shutdown()
+
+    asyncio.run(scenario())
+
+def test_restored_conversation_continues_before_timeout():
+    async def scenario():
+        store_conversation(age_seconds=5)
+        persistence = SQLitePersistence(update_interval=3600, ttl_seconds=3600)
+        application, conversation, reached, _api = build_app(persistence, timeout=60)
+        persistence.start(application.job_queue)
+        await application.initialize()
+        await application.start()
+        try:
+            await asyncio.sleep(0.1)
+            assert KEY in conversation_internals(conversation).timeout_jobs # Timeout restante programado al arrancar
+            await send_text(application, "respuesta")
+            assert reached == ["respuesta"]
+            assert KEY not in conversation_internals(conversation).conversations
+        finally:
+            await application.stop()
+            await application.shutdown()
+
+    asyncio.run(scenario())
+
+def test_transient_user_data_keys_are_not_persisted():
+    async def scenario():
+        persistence = SQLitePersistence(update_interval=3600, ttl_seconds=3600)
+        parsed = [{'service': "Netflix", 'email': "a@b.c", 'profiles': [("Perfil 1", "1111")]}]
+        await persistence.update_user_data(USER_ID, {'parsed_accounts': parsed, 'profiles_to_add': [], 'my_service': "Netflix"})
+        stored = {key: json.loads(value) for _user, key, value in db.load_user_data_db(0)}
+        assert stored == {'my_service': "Netflix"}
+
+        # Filas de una versión anterior: no se cargan y el siguiente volcado las elimina
+        db.save_user_data_db(USER_ID, {'parsed_accounts': json.dumps(parsed)}, [], int(time.time()))
+        reloaded = SQLitePersistence(update_interval=3600, ttl_seconds=3600)
+        assert await reloaded.get_user_data() == {USER_ID: {'my_service': "Netflix"}}
+        await reloaded.update_user_data(USER_ID, {'my_service': "Netflix"})
+        assert [key for _user, key, _value in db.load_user_data_db(0)] == ['my_service']
+
+    asyncio.run(scenario())
+
+def test_conversation_internals_match_installed_ptb():
+    # Falla si una versión de python-telegram-bot cambia los internos que usa SQLitePersistence
+    _application, conversation, _reached, _api = build_app(SQLitePersistence(update_interval=3600), timeout=60)
+    internals = conversation_internals(conversation)
+    internals.update_state(ASKING, KEY)
+    assert dict(internals.conversations) == {KEY: ASKING}
+    internals.update_state(ConversationHandler.END, KEY)
+    assert KEY not in internals.conversations
+    assert internals.timeout_jobs == {}
+
+def test_missing_conversation_internals_fail_loudly(monkeypatch):
+    persistence = SQLitePersistence(update_interval=3600)
+    application, _conversation, _reached, _api = build_app(persistence)
+    monkeypatch.delattr(ConversationHandler, "_update_state")
+    with pytest.raises(RuntimeError, match="no es compatible"):
+        persistence.start(application.job_queue)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import bot_metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del Procesado Concurrente ---
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8")) # Updates de distintos chats/usuarios procesados a la vez (1 = secuencial)
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "256")) # Updates admitidos en espera (incluidos los que se procesan)
+UPDATE_WAIT_WARN_SECONDS = float(os.getenv("UPDATE_WAIT_WARN_SECONDS", "2")) # Avisar si un update espera más que esto
+_WAIT_SAMPLES = 1000 # Esperas recientes guardadas para los percentiles
+
+# --- Procesador de Updates ---
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Procesa en paralelo updates de distintos chats/usuarios, con como mucho UPDATE_WORKERS a la vez,
+    y en serie (por orden de llegada) los de un mismo par (chat, usuario), que es la misma clave que
+    usan los ConversationHandler. Así una subida lenta de un usuario no bloquea a los demás.
+
+    PTB limita con su semáforo el total de updates en curso (UPDATE_MAX_PENDING); la espera por el
+    lock del chat y por un worker ocurre dentro de do_process_update y se mide por update.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, max_pending: int = UPDATE_MAX_PENDING):
+        workers = max(1, workers)
+        # PTB solo crea una tarea por update si max_concurrent_updates > 1
+        super().__init__(max(2, max_pending, workers))
+        self.workers = workers
+        self._workers = asyncio.BoundedSemaphore(workers)
+        self._locks = {}          # (chat_id, user_id) -> [asyncio.Lock, updates que lo usan]
+        self._waits = deque(maxlen=_WAIT_SAMPLES)
+        self.processed_count = 0
+        self.max_wait = 0.0
+        self.active = 0
+
+    @staticmethod
+    def _key(update: object):
+        if not isinstance(update, Update):
+            return None
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        enqueued = time.monotonic()
+        key = self._key(update)
+        entry = None
+        if key is not None:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+        try:
+            if entry is not None:
+                await entry[0].acquire() # asyncio.Lock atiende a los que esperan en orden de llegada
+            try:
+                async with self._workers:
+                    self._record_wait(update, time.monotonic() - enqueued)
+                    self.active += 1
+                    timing = bot_metrics.begin_update() # Duración y tiempo de BD/API del update (sin la espera en cola)
+                    try:
+                        await coroutine
+                    finally:
+                        bot_metrics.end_update(update, timing)
+                        self.active -= 1
+                        self.processed_count += 1
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    async def initialize(self) -> None:
+        logger.info(f"Procesado concurrente de updates: {self.workers} workers, orden garantizado por (chat, usuario).")
+
+    async def shutdown(self) -> None:
+        pass
+
+    # --- Diagnóstico ---
+    def _record_wait(self, update: object, wait: float) -> None:
+        self._waits.append(wait)
+        self.max_wait = max(self.max_wait, wait)
+        if wait >= UPDATE_WAIT_WARN_SECONDS:
+            update_id = update.update_id if isinstance(update, Update) else None
+            logger.warning(f"⏳ El update {update_id} esperó {wait:.2f}s en cola antes de procesarse ({self.workers} workers).")
+        else:
+            logger.debug(f"Update en cola durante {wait * 1000:.1f} ms.")
+
+    def get_stats(self) -> dict:
+        waits = sorted(self._waits)
+        def percentile(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0.0
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'pending': self.current_concurrent_updates - self.active,
+            'processed': self.processed_count,
+            'wait_p50_ms': percentile(0.50),
+            'wait_p95_ms': percentile(0.95),
+            'wait_max_ms': round(self.max_wait * 1000, 1),
+        }
+
+update_processor = PerChatUpdateProcessor()
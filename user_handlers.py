@@ -1,11 +1,8 @@
+import functools
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
-import os
-import tempfile
-import re # Importar re para parseo
-import sqlite3
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, InputFile # Importar InputFile
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     ContextTypes,
     ConversationHandler,
@@ -20,8 +17,13 @@ from telegram.error import BadRequest
 
 # Importar funciones de base de datos y otros módulos necesarios
 import database as db
+import async_db as adb # Acceso a BD sin bloquear el event loop
+import backups # Parser y formatos de backup
 # Importar desde utils.py (asumiendo que las funciones de borrado están ahí o se moverán)
-from utils import ADMIN_USER_ID, get_back_to_menu_keyboard, delete_message_later, DELETE_DELAY_SECONDS, generic_cancel_conversation # Importar cancelador genérico
+from utils import ADMIN_USER_ID, get_back_to_menu_keyboard, schedule_message_deletion, DELETE_DELAY_SECONDS, SENSITIVE_DELETE_DELAY_SECONDS, generic_cancel_conversation # Importar cancelador genérico
+from utils import get_conversation_timeout, build_timeout_handlers, remember_prompt
+from utils import PAGE_SIZE, get_pagination_keyboard, parse_page_callback, split_page
+from metrics import register_state_names # Nombres de los estados en /perf y /metrics
 
 # Importar selectivamente de admin_handlers
 from admin_handlers import get_admin_specific_buttons # Importar la nueva función
@@ -40,25 +42,40 @@ logger = logging.getLogger(__name__)
 CALLBACK_ADD_MY_ACCOUNT = "add_my_account"
 # Renamed/Added states for multi-profile add
 SELECT_SERVICE, GET_MY_EMAIL, ASK_PROFILE_COUNT, GET_PROFILE_DETAILS = range(10, 14)
+register_state_names(
+    "add_my_account",
+    SELECT_SERVICE=SELECT_SERVICE, GET_MY_EMAIL=GET_MY_EMAIL,
+    ASK_PROFILE_COUNT=ASK_PROFILE_COUNT, GET_PROFILE_DETAILS=GET_PROFILE_DETAILS,
+)
 # deletemyaccount
 CALLBACK_DELETE_MY_ACCOUNT = "delete_my_account"
 SELECT_ACCOUNT_TO_DELETE, CONFIRM_DELETE = range(14, 16)
+register_state_names("delete_my_account", SELECT_ACCOUNT_TO_DELETE=SELECT_ACCOUNT_TO_DELETE, CONFIRM_DELETE=CONFIRM_DELETE)
 # editmyaccount
 CALLBACK_EDIT_MY_ACCOUNT = "edit_my_account"
 # Renamed/Added states for editing profile name
 SELECT_PROFILE_TO_EDIT, CHOOSE_EDIT_FIELD, GET_NEW_EMAIL, GET_NEW_PROFILE_NAME, GET_NEW_PIN = range(16, 21)
+register_state_names(
+    "edit_my_account",
+    SELECT_PROFILE_TO_EDIT=SELECT_PROFILE_TO_EDIT, CHOOSE_EDIT_FIELD=CHOOSE_EDIT_FIELD, GET_NEW_EMAIL=GET_NEW_EMAIL,
+    GET_NEW_PROFILE_NAME=GET_NEW_PROFILE_NAME, GET_NEW_PIN=GET_NEW_PIN,
+)
 # Backup
 CALLBACK_BACKUP_MY_ACCOUNTS = "backup_my_accounts"
+CALLBACK_BACKUP_MY_ACCOUNTS_JSONL = "backup_my_accounts_jsonl"
 # Import
 CALLBACK_IMPORT_MY_ACCOUNTS = "import_my_accounts"
+# Paginación de /list
+CALLBACK_ACCOUNTS_PAGE = "accpg_"
 GET_BACKUP_FILE, CONFIRM_IMPORT = range(21, 23) # Adjusted range
+register_state_names("import_my_accounts", GET_BACKUP_FILE=GET_BACKUP_FILE, CONFIRM_IMPORT=CONFIRM_IMPORT)
 
 # Lista de servicios predefinidos
 STREAMING_SERVICES = ["Netflix", "HBO Max", "Spotify", "Disney Plus", "Paramount Plus", "Prime Video", "YouTube Premium", "Crunchyroll", "Otro"]
 
 # --- Funciones de Teclados ---
 
-def get_main_menu_keyboard(is_admin: bool, is_authorized: bool) -> InlineKeyboardMarkup:
+def _build_main_menu_keyboard(is_admin: bool, is_authorized: bool) -> InlineKeyboardMarkup:
     """Genera el teclado del menú principal según el rol y autorización."""
     keyboard = []
     # Opciones comunes si está autorizado o es admin
@@ -73,6 +90,7 @@ def get_main_menu_keyboard(is_admin: bool, is_authorized: bool) -> InlineKeyboar
              keyboard.append([InlineKeyboardButton("✏️ Editar Mi Cuenta", callback_data=CALLBACK_EDIT_MY_ACCOUNT)])
              keyboard.append([InlineKeyboardButton("🗑️ Eliminar Mi Cuenta", callback_data=CALLBACK_DELETE_MY_ACCOUNT)])
              keyboard.append([InlineKeyboardButton("💾 Backup Mis Cuentas", callback_data=CALLBACK_BACKUP_MY_ACCOUNTS)])
+             keyboard.append([InlineKeyboardButton("🗜️ Backup JSONL (comprimido)", callback_data=CALLBACK_BACKUP_MY_ACCOUNTS_JSONL)])
              keyboard.append([InlineKeyboardButton("📥 Importar Backup", callback_data=CALLBACK_IMPORT_MY_ACCOUNTS)])
 
     # Opciones solo para Admin
@@ -87,14 +105,31 @@ def get_main_menu_keyboard(is_admin: bool, is_authorized: bool) -> InlineKeyboar
 
     return InlineKeyboardMarkup(keyboard)
 
+# Menús precalculados por rol: el menú principal es el teclado que más se envía
+_MAIN_MENU_KEYBOARDS = {
+    'admin': _build_main_menu_keyboard(is_admin=True, is_authorized=True),
+    'authorized': _build_main_menu_keyboard(is_admin=False, is_authorized=True),
+    'unauthorized': _build_main_menu_keyboard(is_admin=False, is_authorized=False),
+}
+
+def get_main_menu_keyboard(is_admin: bool, is_authorized: bool) -> InlineKeyboardMarkup:
+    """Devuelve el teclado (compartido e inmutable) del menú principal para el rol del usuario."""
+    if is_admin:
+        return _MAIN_MENU_KEYBOARDS['admin']
+    return _MAIN_MENU_KEYBOARDS['authorized' if is_authorized else 'unauthorized']
+
+@functools.lru_cache(maxsize=8)
+def get_service_keyboard(services: tuple = tuple(STREAMING_SERVICES)) -> InlineKeyboardMarkup:
+    """Teclado de selección de servicio, uno por lista de servicios (la lista debe pasarse como tupla)."""
+    return InlineKeyboardMarkup(tuple((InlineKeyboardButton(service, callback_data=f"service_{service}"),) for service in services))
+
 # --- Funciones Auxiliares ---
 
 async def _send_or_edit_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, keyboard: InlineKeyboardMarkup, schedule_delete: bool = True):
-    """Envía o edita un mensaje, opcionalmente programa su borrado."""
+    """Envía o edita un mensaje, opcionalmente programa su borrado. Devuelve el mensaje enviado/editado (o None)."""
     query = update.callback_query
     is_callback = bool(query)
     chat_id = update.effective_chat.id
-    job_queue = context.job_queue
     sent_message = None
 
     try:
@@ -114,12 +149,7 @@ async def _send_or_edit_message(update: Update, context: ContextTypes.DEFAULT_TY
             )
 
         if sent_message and schedule_delete:
-            job_queue.run_once(
-                delete_message_later,
-                when=timedelta(seconds=DELETE_DELAY_SECONDS * 2), # Usar un delay más largo para listas
-                data={'chat_id': chat_id, 'message_id': sent_message.message_id},
-                name=f'delete_{chat_id}_{sent_message.message_id}'
-            )
+            schedule_message_deletion(chat_id, sent_message.message_id, DELETE_DELAY_SECONDS * 2) # Usar un delay más largo para listas
     except BadRequest as e:
         if "Message is not modified" not in str(e):
             logger.error(f"Error al enviar/editar mensaje en _send_or_edit_message: {e}")
@@ -131,6 +161,7 @@ async def _send_or_edit_message(update: Update, context: ContextTypes.DEFAULT_TY
         if not is_callback and update.message:
             try: await update.message.reply_text("⚠️ Ocurrió un error inesperado.")
             except Exception: pass
+    return sent_message
 
 
 # --- Funciones de Comandos de Usuario ---
@@ -148,7 +179,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.info(f"Comando /start recibido de user_id: {user_id} ({user_name})")
 
         is_admin_user = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
-        is_authorized_user = db.is_user_authorized(user_id)
+        is_authorized_user = await adb.is_user_authorized(user_id)
         logger.info(f"User {user_id}: is_admin={is_admin_user}, is_authorized={is_authorized_user}")
 
         welcome_message = f"¡Hola, {user_name}! 👋\n\nBienvenido al Gestor de Cuentas."
@@ -175,7 +206,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     try:
         user_id = update.effective_user.id
         is_admin_user = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
-        is_authorized = db.is_user_authorized(user_id)
+        is_authorized = await adb.is_user_authorized(user_id)
 
         help_text = "🤖 *Comandos Disponibles*\n\n"
         help_text += "*/start* - Muestra el menú principal.\n"
@@ -194,6 +225,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                  help_text += "`/editmyaccount` - ✏️ Edita el Email o PIN de un perfil propio.\n"
                  help_text += "`/deletemyaccount` - 🗑️ Elimina un perfil propio.\n"
                  help_text += "`/backupmyaccounts` - 💾 Genera un backup de tus cuentas.\n"
+                 help_text += "`/backupmyaccounts jsonl [gz|zst]` - 🗜️ Backup en JSON Lines, opcionalmente comprimido.\n"
                  help_text += "`/importmyaccounts` - 📥 Importa cuentas desde un backup.\n"
 
         if is_admin_user:
@@ -202,6 +234,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             help_text += "`/listusers` - 🔑 Lista todos los usuarios autorizados.\n"
             help_text += "`/edituser` - ✏️ Inicia el proceso para editar el nombre o días de acceso de un usuario.\n" # Actualizado
             help_text += "`/deleteuser` - 🗑️ Inicia el proceso para eliminar un usuario autorizado.\n"
+            help_text += "`/dbinfo` - 🗄️ Muestra la configuración de rendimiento de la base de datos.\n"
             # help_text += "`/listallaccounts` - 🧾 Lista todos los perfiles registrados (eliminado del menú).\n" # Comando eliminado del menú
 
         keyboard = get_main_menu_keyboard(is_admin_user, is_authorized)
@@ -225,16 +258,26 @@ async def list_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     logger.info(f"list_accounts: user_id={user_id}, is_callback={is_callback}")
 
     is_admin_user = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
-    is_authorized = db.is_user_authorized(user_id)
+    is_authorized = await adb.is_user_authorized(user_id)
 
     if not is_authorized and not is_admin_user:
         await _send_or_edit_message(update, context, "⛔ No tienes permiso para ver cuentas.", get_back_to_menu_keyboard())
         return
 
+    # Cursor keyset de la página pedida (None = primera página)
+    direction, cursor = parse_page_callback(query.data if is_callback else None, CALLBACK_ACCOUNTS_PAGE)
+
     try:
-        user_profiles = db.get_accounts_for_user(user_id)
+        user_profiles = await _fetch_accounts_page(user_id, direction, cursor)
+        if not user_profiles and direction:
+            # El perfil usado como cursor ya no existe: volver a la primera página
+            direction, cursor = None, None
+            user_profiles = await _fetch_accounts_page(user_id, None, None)
+        user_profiles, has_prev, has_next = split_page(user_profiles, direction, PAGE_SIZE)
+
         if not user_profiles:
             message = "ℹ️ No tienes perfiles propios activos."
+            keyboard = get_back_to_menu_keyboard()
         else:
             accounts_text_list = ["📋 *Tus Perfiles Activos:*"]
             for profile in user_profiles:
@@ -245,19 +288,26 @@ async def list_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                 )
             message = "\n".join(accounts_text_list)
             message += "\n\n_Usa los botones del menú para editar/eliminar por ID._\n_Usa /get para ver detalles completos (privado)._"
+            keyboard = get_pagination_keyboard(CALLBACK_ACCOUNTS_PAGE, user_profiles[0]['profile_id'], user_profiles[-1]['profile_id'], has_prev, has_next)
 
-        await _send_or_edit_message(update, context, message, get_back_to_menu_keyboard(), schedule_delete=True)
+        # Al pasar de página se edita el mismo mensaje, cuyo borrado ya está programado
+        await _send_or_edit_message(update, context, message, keyboard, schedule_delete=(direction is None))
 
     except Exception as e:
         logger.error(f"Error al procesar list_accounts para {user_id}: {e}", exc_info=True)
         await _send_or_edit_message(update, context, "⚠️ Ocurrió un error al obtener tus cuentas.", get_back_to_menu_keyboard())
 
+async def _fetch_accounts_page(user_id: int, direction: str | None, cursor: int | None) -> list:
+    """Consulta keyset de una página de perfiles (una fila extra para saber si hay más)."""
+    if direction == 'prev':
+        return await adb.get_accounts_for_user(user_id, before_profile_id=cursor, limit=PAGE_SIZE + 1)
+    return await adb.get_accounts_for_user(user_id, after_profile_id=cursor, limit=PAGE_SIZE + 1)
+
 async def get_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """(Autorizados) Obtiene los detalles (PIN) de los perfiles propios activos."""
     user_id = update.effective_user.id
     is_admin_user = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
-    is_authorized = db.is_user_authorized(user_id)
-    job_queue = context.job_queue
+    is_authorized = await adb.is_user_authorized(user_id)
     chat_id = update.effective_chat.id
     command_message_id = update.message.message_id if update.message else None
 
@@ -266,7 +316,7 @@ async def get_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     try:
-        user_profiles = db.get_accounts_for_user(user_id)
+        user_profiles = await adb.get_accounts_for_user(user_id)
         if not user_profiles:
             await update.message.reply_text("ℹ️ No tienes perfiles propios activos para obtener detalles.")
             return
@@ -285,7 +335,9 @@ async def get_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
         confirmation_msg = None
         try:
-            await context.bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.MARKDOWN)
+            details_msg = await context.bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.MARKDOWN)
+            # Los PINs no deben quedar visibles indefinidamente en el chat
+            schedule_message_deletion(user_id, details_msg.message_id, SENSITIVE_DELETE_DELAY_SECONDS)
             if update.message and update.message.chat.type != 'private':
                  confirmation_msg = await update.message.reply_text("✅ Te he enviado los detalles por mensaje privado.")
             logger.info(f"🔑 Usuario {user_id} solicitó detalles con /get")
@@ -297,12 +349,7 @@ async def get_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             try: await context.bot.delete_message(chat_id=chat_id, message_id=command_message_id)
             except Exception: pass
         if confirmation_msg:
-             job_queue.run_once(
-                 delete_message_later,
-                 when=timedelta(seconds=DELETE_DELAY_SECONDS),
-                 data={'chat_id': chat_id, 'message_id': confirmation_msg.message_id},
-                 name=f'delete_{chat_id}_{confirmation_msg.message_id}'
-             )
+             schedule_message_deletion(chat_id, confirmation_msg.message_id, DELETE_DELAY_SECONDS)
 
     except Exception as e:
         logger.error(f"Error al procesar /get para {user_id}: {e}", exc_info=True)
@@ -334,7 +381,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         message = "👑 Eres el *administrador*. Tienes acceso permanente."
     else:
         try:
-            user_status = db.get_user_status_db(user_id)
+            user_status = await adb.get_user_status_db(user_id)
             if user_status:
                 user_name = user_status.get('name', user_name)
                 expiry_ts = user_status.get('expiry_ts')
@@ -355,7 +402,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             logger.error(f"Error al procesar status_command para {user_id}: {e}", exc_info=True)
             message = "⚠️ Ocurrió un error al verificar tu estado."
 
-    is_authorized = db.is_user_authorized(user_id)
+    is_authorized = await adb.is_user_authorized(user_id)
     final_keyboard = get_back_to_menu_keyboard() if is_callback else get_main_menu_keyboard(is_admin_user, is_authorized)
 
     if is_callback:
@@ -374,47 +421,50 @@ async def backup_my_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logger.info(f"backup_my_accounts: user_id={user_id}, is_callback={is_callback}")
 
     is_admin_user = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
-    is_authorized = db.is_user_authorized(user_id)
+    is_authorized = await adb.is_user_authorized(user_id)
 
     if not is_authorized or is_admin_user: # Solo usuarios autorizados NO admin
         await _send_or_edit_message(update, context, "⛔ Esta función es solo para usuarios autorizados.", get_back_to_menu_keyboard())
         return
 
+    # Formato: texto (por defecto) o JSON Lines, elegido por argumentos del comando o por el botón
+    args = [arg.lower() for arg in (context.args or [])] if not is_callback else []
+    use_jsonl = (is_callback and query.data == CALLBACK_BACKUP_MY_ACCOUNTS_JSONL) or "jsonl" in args
+    compression = None
+    if is_callback and use_jsonl:
+        compression = "gzip"
+    elif any(arg in ("zst", "zstd") for arg in args):
+        compression = "zstd"
+    elif any(arg in ("gz", "gzip") for arg in args):
+        compression = "gzip"
+    if compression == "zstd" and not backups.zstd_available():
+        await _send_or_edit_message(update, context, "⚠️ La compresión zstd no está disponible en este servidor. Usa `/backupmyaccounts jsonl gz`.", get_back_to_menu_keyboard())
+        return
+
     try:
-        user_accounts = db.get_accounts_for_user(user_id)
+        user_accounts = await adb.get_accounts_for_user(user_id)
         if not user_accounts:
             await _send_or_edit_message(update, context, "ℹ️ No tienes cuentas propias activas para hacer backup.", get_back_to_menu_keyboard())
             return
 
-        backup_content = f"Backup de Cuentas para Usuario ID: {user_id}\n"
-        backup_content += f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        backup_content += "=" * 30 + "\n\n"
-
-        for acc in user_accounts:
-            expiry_date = datetime.fromtimestamp(acc['expiry_ts']).strftime('%d/%m/%Y') if acc.get('expiry_ts') else 'N/A'
-            backup_content += f"ID Cuenta: {acc.get('id', 'N/A')}\n"
-            backup_content += f"Servicio: {acc.get('service', 'N/A')}\n"
-            backup_content += f"Email: {acc.get('email', 'N/A')}\n"
-            backup_content += f"Perfil: {acc.get('profile_name', 'N/A')}\n"
-            backup_content += f"PIN: {acc.get('pin', 'N/A')}\n"
-            backup_content += f"Expira: {expiry_date}\n"
-            backup_content += "-" * 30 + "\n"
-
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.txt', encoding='utf-8') as temp_file:
-            temp_file.write(backup_content)
-            temp_file_path = temp_file.name
-            file_name = f"backup_cuentas_{user_id}_{datetime.now().strftime('%Y%m%d')}.txt"
-
-        logger.info(f"Archivo de backup temporal creado en: {temp_file_path}")
+        # Documento generado en memoria: sin archivos temporales que limpiar
+        if use_jsonl:
+            buffer = backups.build_jsonl_backup(user_id, user_accounts, compression)
+            extension = backups.JSONL_COMPRESSIONS[compression]
+            caption = "📄 Aquí tienes el backup de tus cuentas activas (JSON Lines). Puedes importarlo con /importmyaccounts."
+        else:
+            buffer = backups.build_text_backup(user_id, user_accounts)
+            extension = ".txt"
+            caption = "📄 Aquí tienes el backup de tus cuentas activas."
+        file_name = f"backup_cuentas_{user_id}_{datetime.now().strftime('%Y%m%d')}{extension}"
+        logger.info(f"Backup {file_name} de {buffer.getbuffer().nbytes} bytes generado en memoria.")
 
         try:
-            with open(temp_file_path, 'rb') as file_to_send:
-                await context.bot.send_document(
-                    chat_id=user_id,
-                    document=InputFile(file_to_send, filename=file_name),
-                    caption="📄 Aquí tienes el backup de tus cuentas activas.",
-                    reply_markup=get_back_to_menu_keyboard()
-                )
+            await backups.send_document_from_memory(
+                context.bot, user_id, buffer, file_name,
+                caption=caption,
+                reply_markup=get_back_to_menu_keyboard()
+            )
             logger.info(f"Backup enviado a user_id {user_id}.")
             if is_callback:
                  try:
@@ -423,12 +473,6 @@ async def backup_my_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE)
         except Exception as send_error:
             logger.error(f"Error al enviar archivo de backup a {user_id}: {send_error}", exc_info=True)
             await _send_or_edit_message(update, context, "⚠️ Ocurrió un error al enviar el archivo de backup.", get_back_to_menu_keyboard())
-        finally:
-            try:
-                os.remove(temp_file_path)
-                logger.info(f"Archivo de backup temporal eliminado: {temp_file_path}")
-            except OSError as e:
-                logger.error(f"Error al eliminar archivo temporal {temp_file_path}: {e}")
 
     except Exception as e:
         logger.error(f"Error al procesar backup_my_accounts para {user_id}: {e}", exc_info=True)
@@ -440,7 +484,7 @@ async def add_my_account_start(update: Update, context: ContextTypes.DEFAULT_TYP
     """Inicia la conversación para que un usuario añada su cuenta."""
     user = update.effective_user
     user_id = user.id
-    is_authorized = db.is_user_authorized(user_id)
+    is_authorized = await adb.is_user_authorized(user_id)
     is_admin = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
 
     if not is_authorized or is_admin:
@@ -449,17 +493,14 @@ async def add_my_account_start(update: Update, context: ContextTypes.DEFAULT_TYP
 
     logger.info(f"User {user_id} iniciando conversación add_my_account.")
 
-    buttons = []
-    for service in STREAMING_SERVICES:
-        buttons.append([InlineKeyboardButton(service, callback_data=f"service_{service}")])
-    service_keyboard = InlineKeyboardMarkup(buttons)
+    service_keyboard = get_service_keyboard()
 
     message_text = (
         "➕ Ok, vamos a añadir un perfil de cuenta.\n"
         "1️⃣ Por favor, selecciona el *Servicio* de la lista 👇:\n\n"
         "Puedes cancelar en cualquier momento con /cancel."
     )
-    await _send_or_edit_message(update, context, message_text, service_keyboard, schedule_delete=False)
+    remember_prompt(context, await _send_or_edit_message(update, context, message_text, service_keyboard, schedule_delete=False))
 
     return SELECT_SERVICE
 
@@ -487,7 +528,7 @@ async def received_my_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = update.effective_chat.id
 
     if '@' not in email or '.' not in email.split('@')[-1]:
-        await update.message.reply_text("📧 Eso no parece un email válido. Intenta de nuevo.")
+        remember_prompt(context, await update.message.reply_text("📧 Eso no parece un email válido. Intenta de nuevo."))
         return GET_MY_EMAIL
 
     context.user_data['my_email'] = email
@@ -498,12 +539,12 @@ async def received_my_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     service = context.user_data.get('my_service', 'Servicio desconocido')
     # Ask for profile count instead of profile name
-    await update.message.reply_text(
+    remember_prompt(context, await update.message.reply_text(
         f"✔️ Servicio: {service}\n"
         f"📧 Email: {email}.\n"
         "🔢 ¿Cuántos perfiles quieres añadir para esta cuenta? (1-5)",
         parse_mode=ParseMode.MARKDOWN
-    )
+    ))
     return ASK_PROFILE_COUNT # New state
 
 async def received_profile_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -525,11 +566,11 @@ async def received_profile_count(update: Update, context: ContextTypes.DEFAULT_T
         try: await context.bot.delete_message(chat_id=chat_id, message_id=user_message_id)
         except Exception as e: logger.warning(f"No se pudo borrar mensaje (profile_count) {user_message_id}: {e}")
 
-        await update.message.reply_text(f"👤 Introduce el *Nombre* para el Perfil 1:")
+        remember_prompt(context, await update.message.reply_text(f"👤 Introduce el *Nombre* para el Perfil 1:"))
         return GET_PROFILE_DETAILS # State to get name and PIN iteratively
 
     except ValueError:
-        await update.message.reply_text("🔢 Por favor, introduce un número entre 1 y 5.")
+        remember_prompt(context, await update.message.reply_text("🔢 Por favor, introduce un número entre 1 y 5."))
         return ASK_PROFILE_COUNT
     except Exception as e:
         logger.error(f"Error en received_profile_count para user {user_id}: {e}", exc_info=True)
@@ -542,12 +583,18 @@ async def received_profile_details(update: Update, context: ContextTypes.DEFAULT
     user_id = update.effective_user.id
     user_message_id = update.message.message_id
     chat_id = update.effective_chat.id
-    job_queue = context.job_queue
 
     current_index = context.user_data.get('current_profile_index', 1)
     total_count = context.user_data.get('profile_count', 0)
     profiles_list = context.user_data.get('profiles_to_add', [])
 
+    if len(profiles_list) != current_index - 1:
+        # profiles_to_add no se persiste: tras un reinicio del bot se pierden los perfiles ya introducidos
+        logger.warning(f"User {user_id} en add_my_account: faltan perfiles ya introducidos (¿reinicio?); se reinicia el flujo.")
+        await update.message.reply_text("⚠️ Se perdieron los perfiles introducidos (el bot se reinició). Empieza de nuevo con /addmyaccount.", reply_markup=get_back_to_menu_keyboard())
+        context.user_data.clear()
+        return ConversationHandler.END
+
     # Determine if we are expecting a name or a PIN
     expecting_name = 'current_profile_name' not in context.user_data
 
@@ -560,11 +607,11 @@ async def received_profile_details(update: Update, context: ContextTypes.DEFAULT
             profile_name = update.message.text.strip()
             # Basic validation: check if name already exists in the list being added
             if any(p['name'] == profile_name for p in profiles_list):
-                 await update.message.reply_text(f"⚠️ Ya has introducido un perfil con el nombre '{profile_name}'. Por favor, usa un nombre diferente para el Perfil {current_index}:")
+                 remember_prompt(context, await update.message.reply_text(f"⚠️ Ya has introducido un perfil con el nombre '{profile_name}'. Por favor, usa un nombre diferente para el Perfil {current_index}:"))
                  return GET_PROFILE_DETAILS # Ask for name again
             context.user_data['current_profile_name'] = profile_name
             logger.info(f"User {user_id} en add_my_account: Recibido nombre '{profile_name}' para perfil {current_index}.")
-            await update.message.reply_text(f"🔑 Introduce el *PIN* para el Perfil {current_index} ('{profile_name}'):")
+            remember_prompt(context, await update.message.reply_text(f"🔑 Introduce el *PIN* para el Perfil {current_index} ('{profile_name}'):"))
             return GET_PROFILE_DETAILS # Stay in the same state to get PIN
 
         else: # Expecting PIN
@@ -579,7 +626,7 @@ async def received_profile_details(update: Update, context: ContextTypes.DEFAULT
             # Check if more profiles are needed
             if current_index < total_count:
                 context.user_data['current_profile_index'] = current_index + 1
-                await update.message.reply_text(f"👤 Introduce el *Nombre* para el Perfil {current_index + 1}:")
+                remember_prompt(context, await update.message.reply_text(f"👤 Introduce el *Nombre* para el Perfil {current_index + 1}:"))
                 return GET_PROFILE_DETAILS # Loop back to get next name
             else:
                 # All profiles collected, finalize
@@ -597,7 +644,7 @@ async def received_profile_details(update: Update, context: ContextTypes.DEFAULT
                 expiry_ts = registration_ts + (30 * 24 * 60 * 60)
                 expiry_date = datetime.fromtimestamp(expiry_ts).strftime('%d/%m/%Y')
 
-                success = db.add_account_db(
+                success = await adb.add_account_db(
                     user_id=user_id,
                     service=service,
                     email=email,
@@ -625,12 +672,7 @@ async def received_profile_details(update: Update, context: ContextTypes.DEFAULT
                     parse_mode=ParseMode.MARKDOWN,
                     reply_markup=get_back_to_menu_keyboard()
                 )
-                job_queue.run_once(
-                    delete_message_later,
-                    when=timedelta(seconds=DELETE_DELAY_SECONDS),
-                    data={'chat_id': chat_id, 'message_id': confirmation_message.message_id},
-                    name=f'delete_{chat_id}_{confirmation_message.message_id}'
-                )
+                schedule_message_deletion(chat_id, confirmation_message.message_id, DELETE_DELAY_SECONDS)
                 logger.info(f"User {user_id} completó add_my_account para {service}. Resultado: {success}")
                 context.user_data.clear()
                 return ConversationHandler.END
@@ -652,9 +694,13 @@ addmyaccount_conv_handler = ConversationHandler(
         GET_MY_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_my_email)],
         ASK_PROFILE_COUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_profile_count)],
         GET_PROFILE_DETAILS: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_profile_details)],
+        ConversationHandler.TIMEOUT: build_timeout_handlers("add_my_account", ('my_service', 'my_email', 'profile_count', 'current_profile_index', 'profiles_to_add', 'current_profile_name')),
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: generic_cancel_conversation(u, c, "add_my_account"))],
-    allow_reentry=True
+    allow_reentry=True,
+    name="add_my_account",
+    conversation_timeout=get_conversation_timeout("add_my_account"),
+    persistent=True,
 )
 
 # --- Conversación: Eliminar Cuenta Propia (/deletemyaccount) ---
@@ -663,7 +709,7 @@ async def delete_my_account_start(update: Update, context: ContextTypes.DEFAULT_
     """Inicia la conversación para que un usuario elimine SU CUENTA PRINCIPAL (y perfiles asociados)."""
     user = update.effective_user
     user_id = user.id
-    is_authorized = db.is_user_authorized(user_id)
+    is_authorized = await adb.is_user_authorized(user_id)
     is_admin = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
 
     if not is_authorized or is_admin:
@@ -671,7 +717,7 @@ async def delete_my_account_start(update: Update, context: ContextTypes.DEFAULT_
         return ConversationHandler.END
 
     logger.info(f"User {user_id} iniciando conversación delete_my_account.")
-    user_profiles = db.get_accounts_for_user(user_id)
+    user_profiles = await adb.get_accounts_for_user(user_id)
 
     if not user_profiles:
         await _send_or_edit_message(update, context, "ℹ️ No tienes perfiles propios activos para eliminar.", get_back_to_menu_keyboard())
@@ -704,7 +750,7 @@ async def delete_my_account_start(update: Update, context: ContextTypes.DEFAULT_
                     "Puedes cancelar con /cancel.")
     accounts_keyboard = InlineKeyboardMarkup(buttons)
 
-    await _send_or_edit_message(update, context, message_text, accounts_keyboard, schedule_delete=False)
+    remember_prompt(context, await _send_or_edit_message(update, context, message_text, accounts_keyboard, schedule_delete=False))
     return SELECT_ACCOUNT_TO_DELETE
 
 async def received_delete_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -753,7 +799,7 @@ async def confirm_delete_account(update: Update, context: ContextTypes.DEFAULT_T
 
     if confirmation == "delete_confirm_yes":
         logger.info(f"User {user_id} confirma eliminar CUENTA ID {account_id}.")
-        success = db.delete_account_db(account_id=account_id, user_id=user_id)
+        success = await adb.delete_account_db(account_id=account_id, user_id=user_id)
 
         if success:
             confirmation_text = f"🗑️ ¡Cuenta principal ID `{account_id}` y sus perfiles asociados eliminados correctamente!"
@@ -776,9 +822,13 @@ deletemyaccount_conv_handler = ConversationHandler(
     states={
         SELECT_ACCOUNT_TO_DELETE: [CallbackQueryHandler(received_delete_selection, pattern="^delacc_")],
         CONFIRM_DELETE: [CallbackQueryHandler(confirm_delete_account, pattern="^delete_confirm_")],
+        ConversationHandler.TIMEOUT: build_timeout_handlers("delete_my_account", ('delete_account_id',)),
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: generic_cancel_conversation(u, c, "delete_my_account"))], # Usar cancelador genérico
-    allow_reentry=True
+    allow_reentry=True,
+    name="delete_my_account",
+    conversation_timeout=get_conversation_timeout("delete_my_account"),
+    persistent=True,
 )
 
 # --- Conversación: Editar Cuenta Propia (/editmyaccount) ---
@@ -787,7 +837,7 @@ async def edit_my_account_start(update: Update, context: ContextTypes.DEFAULT_TY
     """Inicia la conversación para que un usuario edite el Email de la cuenta o el PIN de un perfil."""
     user = update.effective_user
     user_id = user.id
-    is_authorized = db.is_user_authorized(user_id)
+    is_authorized = await adb.is_user_authorized(user_id)
     is_admin = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
 
     if not is_authorized or is_admin:
@@ -795,7 +845,7 @@ async def edit_my_account_start(update: Update, context: ContextTypes.DEFAULT_TY
         return ConversationHandler.END
 
     logger.info(f"User {user_id} iniciando conversación edit_my_account.")
-    user_profiles = db.get_accounts_for_user(user_id)
+    user_profiles = await adb.get_accounts_for_user(user_id)
 
     if not user_profiles:
         await _send_or_edit_message(update, context, "ℹ️ No tienes perfiles propios activos para editar.", get_back_to_menu_keyboard())
@@ -809,7 +859,7 @@ async def edit_my_account_start(update: Update, context: ContextTypes.DEFAULT_TY
     message_text = "✏️ Selecciona el *perfil* cuyo PIN deseas editar, o cuya cuenta principal deseas modificar (Email) 👇:\n\nPuedes cancelar con /cancel."
     profiles_keyboard = InlineKeyboardMarkup(buttons)
 
-    await _send_or_edit_message(update, context, message_text, profiles_keyboard, schedule_delete=False)
+    remember_prompt(context, await _send_or_edit_message(update, context, message_text, profiles_keyboard, schedule_delete=False))
     return SELECT_PROFILE_TO_EDIT
 
 async def received_edit_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -865,17 +915,12 @@ async def received_edit_field(update: Update, context: ContextTypes.DEFAULT_TYPE
     next_state = ConversationHandler.END
 
     if field_to_edit == "email":
-        conn = sqlite3.connect(db.DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT account_id FROM account_profiles WHERE id = ?", (profile_id,))
-        acc_id_row = cursor.fetchone()
-        conn.close()
-        if not acc_id_row:
+        account_id = await adb.get_account_id_for_profile_db(profile_id, user_id)
+        if not account_id:
              logger.error(f"No se encontró account_id para profile_id {profile_id} al intentar editar email.")
              await query.edit_message_text("❌ Error interno al buscar datos de la cuenta. Intenta de nuevo.", reply_markup=get_back_to_menu_keyboard())
              context.user_data.clear()
              return ConversationHandler.END
-        account_id = acc_id_row[0]
         context.user_data['edit_account_id'] = account_id
 
         prompt_text = f"✏️ Editando Email de la cuenta principal (ID `{account_id}`) asociada al perfil `{profile_id}`.\n" \
@@ -908,7 +953,6 @@ async def received_new_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     user_message_id = update.message.message_id
     chat_id = update.effective_chat.id
-    job_queue = context.job_queue
 
     account_id = context.user_data.get('edit_account_id')
     profile_id = context.user_data.get('edit_profile_id')
@@ -920,7 +964,7 @@ async def received_new_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
          return ConversationHandler.END
 
     if '@' not in new_email or '.' not in new_email.split('@')[-1]:
-        await update.message.reply_text("📧 Eso no parece un email válido. Intenta de nuevo.")
+        remember_prompt(context, await update.message.reply_text("📧 Eso no parece un email válido. Intenta de nuevo."))
         return GET_NEW_EMAIL
 
     logger.info(f"User {user_id} en edit_my_account (Account ID {account_id}, Profile ID {profile_id}): Recibido nuevo email '{new_email}'.")
@@ -928,7 +972,7 @@ async def received_new_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try: await context.bot.delete_message(chat_id=chat_id, message_id=user_message_id)
     except Exception as e: logger.warning(f"No se pudo borrar mensaje (new_email) {user_message_id}: {e}")
 
-    success = db.update_account_email_db(account_id=account_id, user_id=user_id, new_email=new_email)
+    success = await adb.update_account_email_db(account_id=account_id, user_id=user_id, new_email=new_email)
 
     if success:
         confirmation_text = f"✅ ¡Email de la cuenta principal ID `{account_id}` actualizado correctamente!"
@@ -940,12 +984,7 @@ async def received_new_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=get_back_to_menu_keyboard()
     )
-    job_queue.run_once(
-        delete_message_later,
-        when=timedelta(seconds=DELETE_DELAY_SECONDS),
-        data={'chat_id': chat_id, 'message_id': sent_message.message_id},
-        name=f'delete_{chat_id}_{sent_message.message_id}'
-    )
+    schedule_message_deletion(chat_id, sent_message.message_id, DELETE_DELAY_SECONDS)
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -956,7 +995,6 @@ async def received_new_profile_name(update: Update, context: ContextTypes.DEFAUL
     user_id = update.effective_user.id
     user_message_id = update.message.message_id
     chat_id = update.effective_chat.id
-    job_queue = context.job_queue
 
     profile_id = context.user_data.get('edit_profile_id')
     if not profile_id:
@@ -966,7 +1004,7 @@ async def received_new_profile_name(update: Update, context: ContextTypes.DEFAUL
          return ConversationHandler.END
 
     if not new_name: # Basic validation
-        await update.message.reply_text("👤 El nombre del perfil no puede estar vacío. Intenta de nuevo.")
+        remember_prompt(context, await update.message.reply_text("👤 El nombre del perfil no puede estar vacío. Intenta de nuevo."))
         return GET_NEW_PROFILE_NAME
 
     logger.info(f"User {user_id} en edit_my_account (Profile ID {profile_id}): Recibido nuevo nombre '{new_name}'.")
@@ -975,7 +1013,7 @@ async def received_new_profile_name(update: Update, context: ContextTypes.DEFAUL
     except Exception as e: logger.warning(f"No se pudo borrar mensaje (new_name) {user_message_id}: {e}")
 
     # Call the new DB function
-    success = db.update_profile_name_db(profile_id=profile_id, user_id=user_id, new_name=new_name)
+    success = await adb.update_profile_name_db(profile_id=profile_id, user_id=user_id, new_name=new_name)
 
     if success:
         confirmation_text = f"✅ ¡Nombre del perfil ID `{profile_id}` actualizado correctamente a '{db.escape_markdown(new_name)}'!"
@@ -987,12 +1025,7 @@ async def received_new_profile_name(update: Update, context: ContextTypes.DEFAUL
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=get_back_to_menu_keyboard()
     )
-    job_queue.run_once(
-        delete_message_later,
-        when=timedelta(seconds=DELETE_DELAY_SECONDS),
-        data={'chat_id': chat_id, 'message_id': sent_message.message_id},
-        name=f'delete_{chat_id}_{sent_message.message_id}'
-    )
+    schedule_message_deletion(chat_id, sent_message.message_id, DELETE_DELAY_SECONDS)
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -1003,7 +1036,6 @@ async def received_new_pin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user_id = update.effective_user.id
     user_message_id = update.message.message_id
     chat_id = update.effective_chat.id
-    job_queue = context.job_queue
 
     profile_id = context.user_data.get('edit_profile_id')
     if not profile_id:
@@ -1018,7 +1050,7 @@ async def received_new_pin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     except Exception as e: logger.warning(f"No se pudo borrar mensaje (new_pin) {user_message_id}: {e}")
 
     # Call the renamed DB function
-    success = db.update_profile_pin_db(profile_id=profile_id, user_id=user_id, new_pin=new_pin)
+    success = await adb.update_profile_pin_db(profile_id=profile_id, user_id=user_id, new_pin=new_pin)
 
     if success:
         confirmation_text = f"✅ ¡PIN del perfil ID `{profile_id}` actualizado correctamente!"
@@ -1030,12 +1062,7 @@ async def received_new_pin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=get_back_to_menu_keyboard()
     )
-    job_queue.run_once(
-        delete_message_later,
-        when=timedelta(seconds=DELETE_DELAY_SECONDS),
-        data={'chat_id': chat_id, 'message_id': sent_message.message_id},
-        name=f'delete_{chat_id}_{sent_message.message_id}'
-    )
+    schedule_message_deletion(chat_id, sent_message.message_id, DELETE_DELAY_SECONDS)
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -1052,9 +1079,13 @@ editmyaccount_conv_handler = ConversationHandler(
         GET_NEW_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_new_email)],
         GET_NEW_PROFILE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_new_profile_name)], # New state handler
         GET_NEW_PIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_new_pin)],
+        ConversationHandler.TIMEOUT: build_timeout_handlers("edit_my_account", ('edit_profile_id', 'edit_field', 'edit_account_id')),
     },
     fallbacks=[CommandHandler("cancel", lambda u, c: generic_cancel_conversation(u, c, "edit_my_account"))],
-    allow_reentry=True
+    allow_reentry=True,
+    name="edit_my_account",
+    conversation_timeout=get_conversation_timeout("edit_my_account"),
+    persistent=True,
 )
 
 # --- Conversación: Importar Cuentas Propias (/importmyaccounts) ---
@@ -1063,7 +1094,7 @@ async def import_my_accounts_start(update: Update, context: ContextTypes.DEFAULT
     """Inicia la conversación para importar cuentas desde un backup."""
     user = update.effective_user
     user_id = user.id
-    is_authorized = db.is_user_authorized(user_id)
+    is_authorized = await adb.is_user_authorized(user_id)
     is_admin = (ADMIN_USER_ID is not None and user_id == ADMIN_USER_ID)
 
     if not is_authorized or is_admin:
@@ -1072,62 +1103,39 @@ async def import_my_accounts_start(update: Update, context: ContextTypes.DEFAULT
 
     logger.info(f"User {user_id} iniciando conversación import_my_accounts.")
     message_text = (
-        "📥 Ok, vamos a importar cuentas desde un archivo de backup (.txt).\n"
-        "Por favor, envíame el archivo de texto que descargaste previamente.\n\n"
+        "📥 Ok, vamos a importar cuentas desde un archivo de backup (.txt, .jsonl, .jsonl.gz o .jsonl.zst).\n"
+        "Por favor, envíame el archivo que descargaste previamente.\n\n"
         "Puedes cancelar en cualquier momento con /cancel."
     )
-    await _send_or_edit_message(update, context, message_text, None, schedule_delete=False)
+    remember_prompt(context, await _send_or_edit_message(update, context, message_text, None, schedule_delete=False))
     return GET_BACKUP_FILE
 
 async def received_backup_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Recibe el archivo de backup, lo parsea y pide confirmación."""
+    """
+    Recibe el archivo de backup, lo parsea fuera del event loop y pide confirmación.
+    El archivo descargado (máx. 20 MB) y los perfiles parseados (máx. backups.MAX_BACKUP_ROWS) se guardan en memoria.
+    """
     user_id = update.effective_user.id
     document = update.message.document
 
-    if not document or not document.file_name.lower().endswith('.txt'):
-        await update.message.reply_text("❌ Por favor, envía un archivo de texto (.txt) válido.")
+    if not document or not (document.file_name or "").lower().endswith(backups.ACCEPTED_BACKUP_EXTENSIONS):
+        remember_prompt(context, await update.message.reply_text("❌ Por favor, envía un archivo de backup válido (.txt, .jsonl, .jsonl.gz o .jsonl.zst)."))
         return GET_BACKUP_FILE
 
     try:
-        backup_file = await document.get_file()
-        file_content_bytes = await backup_file.download_as_bytearray()
-        file_content = file_content_bytes.decode('utf-8')
-
-        parsed_accounts = []
-        current_account = {}
-        service_re = re.compile(r"^\s*Servicio:\s*(.+)$", re.IGNORECASE)
-        email_re = re.compile(r"^\s*Email:\s*(.+)$", re.IGNORECASE)
-        profile_re = re.compile(r"^\s*Perfil:\s*(.+)$", re.IGNORECASE)
-        pin_re = re.compile(r"^\s*PIN:\s*(.+)$", re.IGNORECASE)
-
-        for line in file_content.splitlines():
-            line = line.strip()
-            if not line or line.startswith("Backup de Cuentas") or line.startswith("Fecha:") or line.startswith("="):
-                continue
-
-            service_match = service_re.match(line)
-            email_match = email_re.match(line)
-            profile_match = profile_re.match(line)
-            pin_match = pin_re.match(line)
-
-            if service_match:
-                current_account['service'] = service_match.group(1).strip()
-            elif email_match:
-                current_account['email'] = email_match.group(1).strip()
-            elif profile_match:
-                current_account['profile_name'] = profile_match.group(1).strip()
-            elif pin_match:
-                current_account['pin'] = pin_match.group(1).strip()
-
-            if all(k in current_account for k in ('service', 'email', 'profile_name', 'pin')) and (line.startswith("-") or line == ""):
-                if '@' in current_account['email'] and '.' in current_account['email'].split('@')[-1]:
-                    parsed_accounts.append(current_account)
-                else:
-                    logger.warning(f"Cuenta omitida en importación por email inválido: {current_account}")
-                current_account = {}
-
-        if all(k in current_account for k in ('service', 'email', 'profile_name', 'pin')) and '@' in current_account['email']:
-             parsed_accounts.append(current_account)
+        buffer = await backups.download_document(document)
+        size_bytes = buffer.getbuffer().nbytes
+
+        parse_start = time.perf_counter()
+        backup_format, parsed_accounts = await backups.load_backup_async(buffer)
+        parse_elapsed = time.perf_counter() - parse_start
+
+        size_mb = size_bytes / (1024 * 1024)
+        ms_per_mb = (parse_elapsed * 1000 / size_mb) if size_mb else 0.0
+        logger.info(
+            f"User {user_id} - Backup ({backup_format}) de {size_bytes} bytes parseado en {parse_elapsed * 1000:.1f} ms "
+            f"({ms_per_mb:.1f} ms/MB)."
+        )
 
         if not parsed_accounts:
             await update.message.reply_text("❌ No se encontraron cuentas válidas en el archivo o el formato es incorrecto.", reply_markup=get_back_to_menu_keyboard())
@@ -1148,9 +1156,13 @@ async def received_backup_file(update: Update, context: ContextTypes.DEFAULT_TYP
             [InlineKeyboardButton("❌ No, cancelar", callback_data="import_confirm_no")]
         ])
 
-        await update.message.reply_text(summary_text, reply_markup=confirm_keyboard, parse_mode=ParseMode.MARKDOWN)
+        remember_prompt(context, await update.message.reply_text(summary_text, reply_markup=confirm_keyboard, parse_mode=ParseMode.MARKDOWN))
         return CONFIRM_IMPORT
 
+    except (ValueError, RuntimeError, OSError) as e:
+        logger.warning(f"Backup rechazado para user {user_id}: {e}")
+        await update.message.reply_text(f"❌ No se pudo leer el backup: {e}", reply_markup=get_back_to_menu_keyboard())
+        return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error procesando archivo de backup para user {user_id}: {e}", exc_info=True)
         await update.message.reply_text("❌ Ocurrió un error al leer o procesar el archivo. Asegúrate de que es el archivo correcto y está en formato UTF-8.", reply_markup=get_back_to_menu_keyboard())
@@ -1165,43 +1177,28 @@ async def confirm_import(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     parsed_accounts = context.user_data.get('parsed_accounts')
 
     if not parsed_accounts:
+         # parsed_accounts no se persiste: tras un reinicio del bot hay que volver a enviar el archivo
          logger.error(f"User {user_id} en confirm_import: Faltan parsed_accounts.")
-         await query.edit_message_text("❌ Error interno. Intenta de nuevo.", reply_markup=get_back_to_menu_keyboard())
+         await query.edit_message_text("❌ El archivo ya no está disponible (el bot pudo reiniciarse). Envíalo de nuevo con /importmyaccounts.", reply_markup=get_back_to_menu_keyboard())
          context.user_data.clear()
          return ConversationHandler.END
 
     if confirmation == "import_confirm_yes":
         logger.info(f"User {user_id} confirma importar {len(parsed_accounts)} cuentas.")
-        imported_count = 0
-        failed_count = 0
         registration_ts = int(time.time())
         expiry_ts = registration_ts + (30 * 24 * 60 * 60)
 
-        accounts_to_import = {}
-        for acc_data in parsed_accounts:
-            key = (acc_data['service'], acc_data['email'])
-            if key not in accounts_to_import:
-                accounts_to_import[key] = {'service': acc_data['service'], 'email': acc_data['email'], 'profiles': []}
-            accounts_to_import[key]['profiles'].append({'name': acc_data['profile_name'], 'pin': acc_data['pin']})
-
-        for key, account_info in accounts_to_import.items():
-            success = db.add_account_db(
-                user_id=user_id,
-                service=account_info['service'],
-                email=account_info['email'],
-                profiles=account_info['profiles'],
-                registration_ts=registration_ts,
-                expiry_ts=expiry_ts
-            )
-            if success:
-                imported_count += 1
-            else:
-                failed_count += 1
+        # Una sola transacción para todo el backup
+        result = await adb.import_accounts_bulk_db(user_id, parsed_accounts, registration_ts, expiry_ts)
 
         confirmation_text = f"✅ Importación completada.\n" \
-                            f"- Cuentas principales importadas/actualizadas: {imported_count}\n"
-        if failed_count > 0:
-             confirmation_text += f"- Cuentas fallidas (error interno, límite de perfiles o duplicado no actualizable): {failed_count}"
+                            f"- Cuentas principales importadas/actualizadas: {result['accounts']}\n" \
+                            f"- Perfiles añadidos: {result['added']}\n" \
+                            f"- Perfiles actualizados: {result['updated']}\n"
+        if result['limit'] > 0:
+             confirmation_text += f"- Perfiles omitidos (límite de {db.MAX_PROFILES_PER_ACCOUNT} por cuenta): {result['limit']}\n"
+        if result['error'] > 0 or result['invalid'] > 0:
+             confirmation_text += f"- Perfiles fallidos (error interno o datos incompletos): {result['error'] + result['invalid']}"
 
         await _send_or_edit_message(update, context, confirmation_text, get_back_to_menu_keyboard(), schedule_delete=True)
 
@@ -1218,14 +1215,18 @@ importmyaccounts_conv_handler = ConversationHandler(
         CallbackQueryHandler(import_my_accounts_start, pattern=f"^{CALLBACK_IMPORT_MY_ACCOUNTS}$")
     ],
     states={
-        GET_BACKUP_FILE: [MessageHandler(filters.Document.TXT, received_backup_file)],
+        GET_BACKUP_FILE: [MessageHandler(filters.Document.ALL, received_backup_file)],
         CONFIRM_IMPORT: [CallbackQueryHandler(confirm_import, pattern="^import_confirm_")],
+        ConversationHandler.TIMEOUT: build_timeout_handlers("import_my_accounts", ('parsed_accounts',)),
     },
     fallbacks=[
         CommandHandler("cancel", lambda u, c: generic_cancel_conversation(u, c, "import_my_accounts")), # Usar cancelador genérico
-        MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: u.message.reply_text("Por favor, envía el archivo .txt o usa /cancel.")),
+        MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: u.message.reply_text("Por favor, envía el archivo de backup o usa /cancel.")),
     ],
-    allow_reentry=True
+    allow_reentry=True,
+    name="import_my_accounts",
+    conversation_timeout=get_conversation_timeout("import_my_accounts"),
+    persistent=True,
 )
 
 # --- Fin Conversaciones ---
@@ -1,10 +1,17 @@
 import os
 import logging
+import functools
+import heapq
+import math
+import time
+from collections import Counter
 from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardRemove
-from telegram.ext import ContextTypes, ConversationHandler
-from telegram.error import BadRequest
-from datetime import timedelta
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update, ReplyKeyboardRemove
+from telegram.ext import ContextTypes, ConversationHandler, TypeHandler
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import database as db
+import async_db as adb
 
 logger = logging.getLogger(__name__)
 
@@ -28,29 +35,327 @@ CALLBACK_BACK_TO_MENU = "back_to_menu"
 # --- Constantes de Tiempo ---
 DELETE_DELAY_SECONDS = 15 # Ajustar según preferencia
 
+# --- Constantes de Paginación ---
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "15")) # Elementos por página en los listados paginados
+
 # --- Funciones de Teclado ---
+# Los teclados fijos se construyen una sola vez: InlineKeyboardMarkup es inmutable, así que se puede
+# reutilizar la misma instancia en todos los mensajes y compararla por identidad ('is').
+_BACK_TO_MENU_KEYBOARD = InlineKeyboardMarkup(((InlineKeyboardButton("⬅️ Volver al Menú", callback_data=CALLBACK_BACK_TO_MENU),),))
+
 def get_back_to_menu_keyboard() -> InlineKeyboardMarkup:
-    """Devuelve un teclado inline con solo el botón 'Volver al Menú'."""
-    keyboard = [[InlineKeyboardButton("⬅️ Volver al Menú", callback_data=CALLBACK_BACK_TO_MENU)]]
+    """Devuelve el teclado inline (compartido) con solo el botón 'Volver al Menú'."""
+    return _BACK_TO_MENU_KEYBOARD
+
+def get_pagination_keyboard(prefix: str, first_id: int, last_id: int, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    """
+    Teclado de navegación de un listado paginado: ◀️/▶️ (si procede) y 'Volver al Menú'.
+    Los botones llevan como cursor el ID del primer/último elemento de la página: '<prefix>p_<id>' / '<prefix>n_<id>'.
+    """
+    nav_row = []
+    if has_prev:
+        nav_row.append(InlineKeyboardButton("◀️ Anterior", callback_data=f"{prefix}p_{first_id}"))
+    if has_next:
+        nav_row.append(InlineKeyboardButton("Siguiente ▶️", callback_data=f"{prefix}n_{last_id}"))
+    keyboard = [nav_row] if nav_row else []
+    keyboard.append([InlineKeyboardButton("⬅️ Volver al Menú", callback_data=CALLBACK_BACK_TO_MENU)])
     return InlineKeyboardMarkup(keyboard)
 
-# --- Funciones de Borrado de Mensajes ---
-async def delete_message_later(context: ContextTypes.DEFAULT_TYPE):
-    """Callback para borrar un mensaje específico."""
-    job = context.job
-    chat_id = job.data['chat_id']
-    message_id = job.data['message_id']
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        logger.info(f"🗑️ Mensaje {message_id} borrado automáticamente en chat {chat_id}.")
-    except BadRequest as e:
-        # Ignorar si el mensaje ya no existe o no se puede borrar
-        if "Message to delete not found" in str(e) or "message can't be deleted" in str(e):
-            logger.warning(f"⚠️ No se pudo borrar automáticamente el mensaje {message_id} en chat {chat_id}: {e}")
-        else:
-            logger.error(f"❌ Error inesperado al borrar automáticamente el mensaje {message_id} en chat {chat_id}: {e}")
-    except Exception as e:
-        logger.error(f"❌ Error general al borrar automáticamente el mensaje {message_id} en chat {chat_id}: {e}")
+def parse_page_callback(callback_data: str | None, prefix: str) -> tuple:
+    """Interpreta un callback de paginación. Devuelve ('next'|'prev', id) o (None, None) si no lo es."""
+    if not callback_data or not callback_data.startswith(prefix):
+        return None, None
+    direction, _, cursor = callback_data[len(prefix):].partition('_')
+    if direction not in ('n', 'p') or not cursor.lstrip('-').isdigit():
+        return None, None
+    return ('next' if direction == 'n' else 'prev'), int(cursor)
+
+def split_page(rows: list, direction: str | None, page_size: int) -> tuple:
+    """
+    Recorta una consulta keyset hecha con LIMIT page_size + 1 y calcula la navegación.
+    Devuelve (filas de la página, hay_anterior, hay_siguiente).
+    """
+    has_more = len(rows) > page_size
+    if direction == 'prev':
+        return rows[-page_size:], has_more, True
+    return rows[:page_size], direction == 'next', has_more
+
+# --- Programador de Borrado de Mensajes ---
+DELETION_TICK_SECONDS = float(os.getenv("DELETION_TICK_SECONDS", "1")) # Cada cuánto se revisan los borrados vencidos
+DELETION_MAX_PER_TICK = int(os.getenv("DELETION_MAX_PER_TICK", "200")) # Tope de mensajes borrados por tick (p. ej. al recuperar atrasos tras un reinicio)
+SENSITIVE_DELETE_DELAY_SECONDS = int(os.getenv("SENSITIVE_DELETE_DELAY_SECONDS", "120")) # Mensajes con credenciales (PINs de /get)
+DELETE_MESSAGES_BATCH_SIZE = 100 # Máximo de mensajes por llamada a deleteMessages (límite de la Bot API)
+DELETION_RETRY_BASE_SECONDS = 5 # Espera antes de reintentar un lote que falló por red o flood-wait (se duplica en cada fallo)
+DELETION_RETRY_MAX_SECONDS = 300 # Espera máxima entre reintentos
+
+class DeletionScheduler:
+    """
+    Cola de borrados de mensajes pendientes.
+    Los borrados se agrupan por segundo de vencimiento (bucket) y los buckets se ordenan en un
+    min-heap. Un único job repetitivo vacía en cada tick los buckets vencidos, agrupando los
+    mensajes por chat para borrarlos con deleteMessages en lotes de hasta 100.
+    La cola se replica en la tabla pending_deletions: los borrados nuevos se guardan en lote al
+    inicio de cada tick y se eliminan de la tabla una vez procesados, de modo que tras un reinicio
+    se recargan y los vencidos se drenan a razón de DELETION_MAX_PER_TICK mensajes por tick.
+    Un lote que falla por un error transitorio (red, timeout, flood-wait) vuelve a la cola con espera
+    exponencial y conserva sus filas; solo BadRequest y Forbidden descartan el borrado.
+    """
+
+    def __init__(self):
+        self._heap = []          # Buckets (segundo de vencimiento) pendientes, min-heap
+        self._buckets = {}       # bucket -> {chat_id: [message_id, ...]}
+        self._scheduled = {}     # (chat_id, message_id) -> bucket, para no duplicar borrados
+        self._unsaved = {}       # (chat_id, message_id) -> bucket aún no guardados en la BD
+        self._retries = {}       # (chat_id, message_id) -> fallos transitorios seguidos
+        self._flushing = False
+        self.deleted_count = 0
+        self.failed_count = 0
+        self.retried_count = 0
+        self.restored_count = 0
+
+    def _add(self, key: tuple, bucket: int) -> bool:
+        """Inserta un borrado en su bucket. Devuelve False si ya había uno con vencimiento igual o anterior."""
+        chat_id, message_id = key
+        current_bucket = self._scheduled.get(key)
+        if current_bucket is not None:
+            if current_bucket <= bucket:
+                return False
+            self._buckets[current_bucket][chat_id].remove(message_id)
+        self._scheduled[key] = bucket
+        chats = self._buckets.get(bucket)
+        if chats is None:
+            chats = self._buckets[bucket] = {}
+            heapq.heappush(self._heap, bucket)
+        chats.setdefault(chat_id, []).append(message_id)
+        return True
+
+    def schedule(self, chat_id: int, message_id: int, delay_seconds: float) -> None:
+        """Programa el borrado de un mensaje. Si ya estaba programado, se conserva el vencimiento más cercano."""
+        key = (chat_id, message_id)
+        bucket = math.ceil(time.time() + delay_seconds)
+        if self._add(key, bucket):
+            self._unsaved[key] = bucket
+
+    def restore(self, entries: list) -> int:
+        """Recarga borrados guardados [(chat_id, message_id, due_ts), ...]. Devuelve cuántos quedaron en cola."""
+        restored = 0
+        for chat_id, message_id, due_ts in entries:
+            if self._add((chat_id, message_id), int(due_ts)):
+                restored += 1
+        self.restored_count += restored
+        return restored
+
+    def pending_count(self) -> int:
+        """Número de mensajes pendientes de borrar."""
+        return len(self._scheduled)
+
+    def _pop_due(self, now: float, max_messages: int) -> dict:
+        """
+        Extrae hasta 'max_messages' mensajes vencidos y devuelve {chat_id: [message_id, ...]}.
+        Si un bucket no cabe entero, el resto se queda en él para el siguiente tick.
+        """
+        due = {}
+        taken = 0
+        while self._heap and self._heap[0] <= now and taken < max_messages:
+            bucket = self._heap[0]
+            chats = self._buckets.get(bucket, {})
+            for chat_id in list(chats):
+                message_ids = chats[chat_id]
+                batch = message_ids[:max_messages - taken]
+                if len(batch) < len(message_ids):
+                    chats[chat_id] = message_ids[len(batch):]
+                else:
+                    del chats[chat_id]
+                for message_id in batch:
+                    self._scheduled.pop((chat_id, message_id), None)
+                if batch:
+                    due.setdefault(chat_id, []).extend(batch)
+                taken += len(batch)
+                if taken >= max_messages:
+                    break
+            if not chats:
+                heapq.heappop(self._heap)
+                self._buckets.pop(bucket, None)
+        return due
+
+    async def save_pending(self) -> bool:
+        """Guarda en la BD los borrados programados desde el último guardado."""
+        if not self._unsaved:
+            return True
+        unsaved, self._unsaved = self._unsaved, {}
+        entries = [(chat_id, message_id, bucket) for (chat_id, message_id), bucket in unsaved.items()]
+        if await adb.save_pending_deletions_db(entries):
+            return True
+        # Reintentar en el siguiente tick sin pisar lo programado mientras tanto
+        for key, bucket in unsaved.items():
+            self._unsaved.setdefault(key, bucket)
+        return False
+
+    async def _delete_batch(self, bot, chat_id: int, message_ids: list) -> tuple:
+        """
+        Borra un lote de mensajes de un chat; usa deleteMessages si la librería lo soporta.
+        BadRequest (el mensaje ya no existe o no se puede borrar) y Forbidden (el bot ya no está en el chat)
+        son definitivos. Ante cualquier otro error devuelve (mensajes sin borrar, error) para reintentarlos;
+        si no, ([], None).
+        """
+        if len(message_ids) > 1 and hasattr(bot, 'delete_messages'):
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+                self.deleted_count += len(message_ids)
+            except (BadRequest, Forbidden) as e:
+                # Ocurre si ninguno de los mensajes existe ya o no se puede borrar
+                self.failed_count += len(message_ids)
+                logger.warning(f"⚠️ No se pudieron borrar {len(message_ids)} mensajes en chat {chat_id}: {e}")
+            except Exception as e:
+                return message_ids, e
+            return [], None
+        for index, message_id in enumerate(message_ids):
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                self.deleted_count += 1
+            except (BadRequest, Forbidden) as e:
+                # Ignorar si el mensaje ya no existe o no se puede borrar
+                self.failed_count += 1
+                logger.warning(f"⚠️ No se pudo borrar automáticamente el mensaje {message_id} en chat {chat_id}: {e}")
+            except Exception as e:
+                return message_ids[index:], e
+        return [], None
+
+    def _requeue(self, chat_id: int, message_ids: list, error: Exception, unsaved_keys: set) -> None:
+        """Vuelve a programar mensajes cuyo borrado falló por un error transitorio, con espera exponencial."""
+        now = time.time()
+        retry_after = getattr(error, 'retry_after', 0) if isinstance(error, RetryAfter) else 0
+        retry_after = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+        delay = 0
+        for message_id in message_ids:
+            key = (chat_id, message_id)
+            attempts = self._retries.get(key, 0) + 1
+            self._retries[key] = attempts
+            delay = max(retry_after, min(DELETION_RETRY_MAX_SECONDS, DELETION_RETRY_BASE_SECONDS * 2 ** (attempts - 1)))
+            bucket = math.ceil(now + delay)
+            if self._add(key, bucket) and key in unsaved_keys:
+                self._unsaved[key] = bucket # Aún sin fila en la BD: se guarda en el siguiente tick
+        self.retried_count += len(message_ids)
+        logger.warning(f"🔁 No se pudieron borrar {len(message_ids)} mensajes en chat {chat_id} ({type(error).__name__}: {error}); reintento en {delay:.0f}s.")
+
+    async def flush(self, bot) -> int:
+        """Guarda los borrados nuevos y borra los vencidos (hasta DELETION_MAX_PER_TICK). Devuelve cuántos se procesaron."""
+        if self._flushing:
+            return 0 # El tick anterior aún no ha terminado
+        self._flushing = True
+        processed = 0
+        try:
+            await self.save_pending()
+            due = self._pop_due(time.time(), DELETION_MAX_PER_TICK)
+            due_keys = [(chat_id, message_id) for chat_id, message_ids in due.items() for message_id in message_ids]
+            # Vencidos antes de poder guardarse: si hay que reintentarlos, vuelven a _unsaved
+            unsaved_keys = {key for key in due_keys if self._unsaved.pop(key, None) is not None}
+            retry_keys = set()
+            for chat_id, message_ids in due.items():
+                for i in range(0, len(message_ids), DELETE_MESSAGES_BATCH_SIZE):
+                    batch = message_ids[i:i + DELETE_MESSAGES_BATCH_SIZE]
+                    retry, error = await self._delete_batch(bot, chat_id, batch)
+                    if retry:
+                        self._requeue(chat_id, retry, error, unsaved_keys)
+                        retry_keys.update((chat_id, message_id) for message_id in retry)
+                    processed += len(batch) - len(retry)
+            done_keys = [key for key in due_keys if key not in retry_keys]
+            for key in done_keys:
+                self._retries.pop(key, None)
+            if done_keys:
+                # Los reintentos conservan su fila para no perderse si el bot se reinicia
+                await adb.remove_pending_deletions_db(done_keys)
+            if processed:
+                logger.info(f"🗑️ {processed} mensajes borrados automáticamente; pendientes: {self.pending_count()}.")
+        finally:
+            self._flushing = False
+        return processed
+
+    async def _tick(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await self.flush(context.bot)
+
+    def start(self, job_queue) -> None:
+        """Recarga los borrados guardados y registra el job repetitivo que vacía la cola."""
+        entries = db.load_pending_deletions_db()
+        if entries:
+            now = time.time()
+            overdue = sum(1 for _, _, due_ts in entries if due_ts <= now)
+            restored = self.restore(entries)
+            logger.info(f"Recuperados {restored} borrados pendientes de la BD ({overdue} ya vencidos).")
+        job_queue.run_repeating(self._tick, interval=DELETION_TICK_SECONDS, first=DELETION_TICK_SECONDS, name="message_deletions")
+        logger.info(f"Programador de borrado de mensajes iniciado (tick de {DELETION_TICK_SECONDS}s, máx. {DELETION_MAX_PER_TICK} por tick).")
+
+deletion_scheduler = DeletionScheduler()
+
+def schedule_message_deletion(chat_id: int, message_id: int, delay_seconds: float = DELETE_DELAY_SECONDS) -> None:
+    """Programa el borrado automático de un mensaje dentro de 'delay_seconds' segundos."""
+    deletion_scheduler.schedule(chat_id, message_id, delay_seconds)
+
+# --- Limpieza de Conversaciones Abandonadas ---
+CONVERSATION_TIMEOUT_SECONDS = int(os.getenv("CONVERSATION_TIMEOUT_SECONDS", "600")) # Inactividad tras la que se cancela un flujo (0 = nunca)
+CONVERSATION_PROMPTS_KEY = 'conversation_prompts' # user_data: [[chat_id, message_id], ...] de los mensajes que piden datos
+MAX_TRACKED_PROMPTS = 20
+abandoned_flows = Counter() # Nombre de conversación -> flujos cancelados por inactividad
+
+def get_conversation_timeout(name: str) -> int | None:
+    """
+    Timeout de una conversación en segundos: CONVERSATION_TIMEOUT_<NOMBRE> (p. ej. CONVERSATION_TIMEOUT_IMPORT_MY_ACCOUNTS)
+    si está definido, si no CONVERSATION_TIMEOUT_SECONDS. Devuelve None si es 0 (sin timeout).
+    """
+    value = os.getenv(f"CONVERSATION_TIMEOUT_{name.upper()}")
+    seconds = int(value) if value and value.isdigit() else CONVERSATION_TIMEOUT_SECONDS
+    return seconds if seconds > 0 else None
+
+def remember_prompt(context: ContextTypes.DEFAULT_TYPE, message) -> None:
+    """Anota un mensaje del bot que pide datos dentro de una conversación, para borrarlo si el flujo se abandona."""
+    if not isinstance(message, Message):
+        return # None o True (edición de un mensaje inline)
+    prompts = context.user_data.setdefault(CONVERSATION_PROMPTS_KEY, [])
+    entry = [message.chat_id, message.message_id]
+    if entry not in prompts:
+        prompts.append(entry)
+        del prompts[:-MAX_TRACKED_PROMPTS]
+
+async def abandon_conversation(name: str, user_data_keys: tuple, context: ContextTypes.DEFAULT_TYPE,
+                               chat_id: int | None, user_id: int | None, notify: bool = True) -> None:
+    """
+    Limpieza de un flujo abandonado: libera sus claves de user_data, programa el borrado de los prompts
+    anotados con remember_prompt, cuenta el flujo abandonado y, con 'notify', avisa al usuario.
+    'context' debe estar asociado al usuario (su user_data), aunque no venga de un update.
+    """
+    for key in user_data_keys:
+        context.user_data.pop(key, None)
+    prompts = context.user_data.pop(CONVERSATION_PROMPTS_KEY, [])
+    for prompt_chat_id, message_id in prompts:
+        schedule_message_deletion(prompt_chat_id, message_id, 0)
+    abandoned_flows[name] += 1
+    logger.info(f"⌛ Conversación '{name}' de {user_id} cancelada por inactividad; {len(prompts)} mensajes a borrar.")
+
+    if notify and chat_id is not None:
+        try:
+            notice = await context.bot.send_message(
+                chat_id=chat_id,
+                text="⌛ La operación se canceló por inactividad. Puedes empezar de nuevo desde el menú.",
+            )
+            schedule_message_deletion(chat_id, notice.message_id, DELETE_DELAY_SECONDS)
+        except Exception as e:
+            logger.warning(f"No se pudo avisar del timeout de '{name}' a {user_id}: {e}")
+
+def build_timeout_handlers(name: str, user_data_keys: tuple) -> list:
+    """
+    Handlers para el estado ConversationHandler.TIMEOUT de una conversación: ejecutan abandon_conversation.
+    La misma limpieza queda en el atributo 'abandon' del callback, para terminar la conversación sin un
+    update (la usa la persistencia con las conversaciones restauradas o caducadas).
+    """
+    async def on_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await abandon_conversation(
+            name, user_data_keys, context,
+            update.effective_chat.id if update.effective_chat else None,
+            update.effective_user.id if update.effective_user else None,
+        )
+
+    on_timeout.abandon = functools.partial(abandon_conversation, name, user_data_keys)
+    return [TypeHandler(Update, on_timeout)]
 
 # --- Nueva Función Genérica de Cancelación ---
 async def generic_cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE, conversation_name: str) -> int:
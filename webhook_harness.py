@@ -0,0 +1,133 @@
+"""
+Banco de pruebas local del modo webhook: envía updates sintéticos por POST al endpoint del bot,
+igual que lo haría Telegram, y muestra códigos de respuesta y latencias.
+
+Uso (con el bot arrancado con BOT_RUN_MODE=webhook y WEBHOOK_REGISTER=false):
+    python webhook_harness.py --count 200 --concurrency 20 --text /start
+    python webhook_harness.py --health
+La URL y el secret token se leen de WEBHOOK_LISTEN/WEBHOOK_PORT/WEBHOOK_PATH/WEBHOOK_SECRET_TOKEN.
+"""
+import argparse
+import itertools
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from webhook_server import SECRET_TOKEN_HEADER, get_webhook_config
+
+_update_ids = itertools.count(int(time.time()))
+
+# --- Updates Sintéticos ---
+def build_message_update(user_id: int, text: str) -> dict:
+    """Update de mensaje privado; si el texto empieza por '/' se marca como comando."""
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"Test{user_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+def build_callback_update(user_id: int, data: str) -> dict:
+    """Update de pulsación de botón inline con 'data' como callback_data."""
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'chat_instance': 'harness',
+            'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"Test{user_id}"},
+            'message': {
+                'message_id': next(_update_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'harness',
+            },
+        },
+    }
+
+# --- Envío ---
+def post_update(url: str, update: dict, secret_token: str | None, timeout: float = 10) -> tuple:
+    """Envía un update y devuelve (código HTTP, segundos)."""
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), method='POST')
+    request.add_header('Content-Type', 'application/json')
+    if secret_token:
+        request.add_header(SECRET_TOKEN_HEADER, secret_token)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError as e:
+        print(f"❌ No se pudo conectar con {url}: {e.reason}")
+        status = 0
+    return status, time.perf_counter() - start
+
+def check_health(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            print(f"{response.status} {response.read().decode('utf-8')}")
+            return 0
+    except urllib.error.HTTPError as e:
+        print(f"{e.code} {e.read().decode('utf-8')}")
+    except urllib.error.URLError as e:
+        print(f"❌ No se pudo conectar con {url}: {e.reason}")
+    return 1
+
+def main() -> int:
+    load_dotenv()
+    config = get_webhook_config()
+    scheme = "https" if config['tls_cert'] else "http"
+    host = "127.0.0.1" if config['listen'] in ("0.0.0.0", "::") else config['listen']
+    base_url = f"{scheme}://{host}:{config['port']}"
+
+    parser = argparse.ArgumentParser(description="Envía updates sintéticos al webhook local del bot.")
+    parser.add_argument('--url', default=base_url + config['path'], help="Endpoint del webhook.")
+    parser.add_argument('--secret', default=config['secret_token'], help="Secret token (por defecto WEBHOOK_SECRET_TOKEN).")
+    parser.add_argument('--count', type=int, default=10, help="Número de updates a enviar.")
+    parser.add_argument('--concurrency', type=int, default=4, help="Peticiones simultáneas.")
+    parser.add_argument('--users', type=int, default=5, help="Usuarios distintos entre los que repartir los updates.")
+    parser.add_argument('--first-user-id', type=int, default=900000000, help="ID del primer usuario sintético.")
+    parser.add_argument('--text', default='/start', help="Texto del mensaje (ignorado si se usa --callback).")
+    parser.add_argument('--callback', default=None, help="Enviar pulsaciones de botón con este callback_data.")
+    parser.add_argument('--health', action='store_true', help="Solo consultar el endpoint de salud.")
+    args = parser.parse_args()
+
+    if args.health:
+        return check_health(base_url + config['health_path'])
+
+    def send(i: int) -> tuple:
+        user_id = args.first_user_id + i % max(1, args.users)
+        if args.callback:
+            update = build_callback_update(user_id, args.callback)
+        else:
+            update = build_message_update(user_id, args.text)
+        return post_update(args.url, update, args.secret)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        results = list(executor.map(send, range(args.count)))
+    elapsed = time.perf_counter() - start
+
+    by_status = {}
+    for status, _ in results:
+        by_status[status] = by_status.get(status, 0) + 1
+    latencies = sorted(seconds * 1000 for _, seconds in results)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0
+    print(f"Enviados {len(results)} updates a {args.url} en {elapsed:.2f}s ({len(results) / elapsed:.1f} updates/s).")
+    print(f"Códigos: {by_status}")
+    if latencies:
+        print(f"Latencia: p50 {statistics.median(latencies):.1f} ms, p95 {p95:.1f} ms, máx. {latencies[-1]:.1f} ms")
+    return 0 if set(by_status) == {200} else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,172 @@
+import asyncio
+import contextlib
+import hmac
+import logging
+import os
+import secrets
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import Application
+
+try:
+    # Opcionales: solo necesarios en modo webhook (pip install starlette uvicorn)
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, Response
+    from starlette.routing import Route
+except ImportError:
+    uvicorn = None
+    Starlette = None
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_UPDATE_BYTES = 1024 * 1024 # Un update de Telegram nunca se acerca a este tamaño
+
+# --- Configuración ---
+def get_webhook_config() -> dict:
+    """
+    Lee la configuración del modo de ejecución del entorno. Se evalúa al arrancar (y no al importar)
+    porque cada bot carga su propio archivo .env antes de llamar a run_application().
+    """
+    path = "/" + os.getenv("WEBHOOK_PATH", "/telegram").strip("/")
+    health_path = "/" + os.getenv("WEBHOOK_HEALTH_PATH", "/health").strip("/")
+    public_url = os.getenv("WEBHOOK_URL", "").rstrip("/")
+    return {
+        'mode': os.getenv("BOT_RUN_MODE", "polling").strip().lower(),
+        'listen': os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+        'port': int(os.getenv("WEBHOOK_PORT", "8443")),
+        'path': path,
+        'health_path': health_path,
+        'url': f"{public_url}{path}" if public_url else "",
+        'secret_token': os.getenv("WEBHOOK_SECRET_TOKEN") or None,
+        'tls_cert': os.getenv("WEBHOOK_TLS_CERT") or None,
+        'tls_key': os.getenv("WEBHOOK_TLS_KEY") or None,
+        'upload_cert': os.getenv("WEBHOOK_UPLOAD_CERT", "false").lower() in ("1", "true", "yes"),
+        'register': os.getenv("WEBHOOK_REGISTER", "true").lower() in ("1", "true", "yes"),
+        'drop_pending_updates': os.getenv("WEBHOOK_DROP_PENDING_UPDATES", "false").lower() in ("1", "true", "yes"),
+    }
+
+# --- Aplicación ASGI ---
+def build_webhook_app(application: Application, config: dict):
+    """
+    Crea la aplicación Starlette con dos rutas:
+    - POST <path>: recibe updates de Telegram (verificando el secret token) y los encola en la Application.
+    - GET <health_path>: estado del bot para el balanceador / proxy inverso.
+    """
+    secret_token = config['secret_token']
+    started_ts = time.time()
+
+    async def telegram_webhook(request: Request) -> Response:
+        if secret_token is not None:
+            received = request.headers.get(SECRET_TOKEN_HEADER, "")
+            if not hmac.compare_digest(received.encode(), secret_token.encode()):
+                logger.warning(f"Petición al webhook rechazada desde {request.client.host if request.client else '?'}: secret token inválido.")
+                return Response(status_code=403)
+        body = await request.body()
+        if len(body) > MAX_UPDATE_BYTES:
+            return Response(status_code=413)
+        try:
+            update = Update.de_json(data=await request.json(), bot=application.bot)
+        except Exception as e:
+            logger.warning(f"Update inválido recibido en el webhook: {e}")
+            return Response(status_code=400)
+        await application.update_queue.put(update)
+        return Response(status_code=200)
+
+    async def health(request: Request) -> JSONResponse:
+        running = application.running
+        return JSONResponse(
+            {
+                'status': 'ok' if running else 'stopped',
+                'mode': 'webhook',
+                'uptime_seconds': int(time.time() - started_ts),
+                'update_queue': application.update_queue.qsize(),
+            },
+            status_code=200 if running else 503,
+        )
+
+    return Starlette(routes=[
+        Route(config['path'], telegram_webhook, methods=["POST"]),
+        Route(config['health_path'], health, methods=["GET"]),
+    ])
+
+# --- Ejecución ---
+if uvicorn is not None:
+    class _WebhookServer(uvicorn.Server):
+        """Servidor uvicorn sin gestión propia de señales: de eso se encarga run_webhook para detener el bot en orden."""
+
+        def install_signal_handlers(self) -> None: # uvicorn < 0.29
+            pass
+
+        @contextlib.contextmanager
+        def capture_signals(self): # uvicorn >= 0.29
+            yield
+
+async def run_webhook(application: Application, config: dict) -> None:
+    """Equivalente a Application.run_polling() pero recibiendo los updates en un servidor ASGI propio."""
+    if Starlette is None or uvicorn is None:
+        raise RuntimeError("El modo webhook requiere los paquetes 'starlette' y 'uvicorn' (pip install starlette uvicorn).")
+    if config['register'] and not config['url']:
+        raise RuntimeError("El modo webhook requiere WEBHOOK_URL (URL pública https por la que Telegram llega al bot).")
+    if config['register'] and config['secret_token'] is None:
+        # Telegram admite 1-256 caracteres A-Z, a-z, 0-9, _ y -; token_urlsafe cumple ese formato
+        config = dict(config, secret_token=secrets.token_urlsafe(32))
+        logger.info("WEBHOOK_SECRET_TOKEN no definido: se ha generado uno aleatorio para esta ejecución.")
+
+    server = _WebhookServer(uvicorn.Config(
+        build_webhook_app(application, config),
+        host=config['listen'],
+        port=config['port'],
+        ssl_certfile=config['tls_cert'],
+        ssl_keyfile=config['tls_key'],
+        log_level="warning",
+        access_log=False,
+    ))
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if config['register']:
+            certificate = None
+            if config['upload_cert'] and config['tls_cert']:
+                with open(config['tls_cert'], 'rb') as f:
+                    certificate = f.read()
+            await application.bot.set_webhook(
+                url=config['url'],
+                certificate=certificate,
+                secret_token=config['secret_token'],
+                drop_pending_updates=config['drop_pending_updates'],
+            )
+        await application.start()
+        logger.info(f"Webhook activo en {config['listen']}:{config['port']}{config['path']} (salud: {config['health_path']}).")
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, setattr, server, 'should_exit', True)
+            except (NotImplementedError, RuntimeError):
+                pass # Windows: se detiene con KeyboardInterrupt
+        try:
+            await server.serve() # Termina con SIGINT/SIGTERM
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def run_application(application: Application) -> None:
+    """Arranca el bot en modo polling (por defecto) o webhook, según BOT_RUN_MODE."""
+    config = get_webhook_config()
+    if config['mode'] == "webhook":
+        asyncio.run(run_webhook(application, config))
+    elif config['mode'] == "polling":
+        application.run_polling()
+    else:
+        raise ValueError(f"BOT_RUN_MODE no válido: {config['mode']} (usa 'polling' o 'webhook').")